@@ -23,17 +23,14 @@ class atlas_xaod_executor(executor):
         method_names.update(get_jet_methods())
         method_names.update(get_math_methods())
         super().__init__(file_names, runner_name, template_dir_name, method_names)
-        define_default_atlas_types()
 
     @staticmethod
     def build_callback(ecc, md):
         'Required due to by-reference lambda capture not working as expected in python'
         return lambda cd: ecc.get_collection(md, cd)
 
-    def reset(self):
-        '''Reset our atlas default types
-        '''
-        super().reset()
+    def define_default_types(self):
+        'Add the ATLAS xAOD default types'
         define_default_atlas_types()
 
     def get_visitor_obj(self):
@@ -13,26 +13,31 @@ def getAttribute(call_node: ast.Call):
 
 
 def get_jet_methods():
+    # The accessors look up the moment name once, in the constructor, rather than for every jet. A
+    # vector moment is not copied out of the jet - the accessor returns a reference to it.
     get_attribute_float = cpp_ast.CPPCodeSpecification(
         name='getAttributeFloat',
-        include_files=['vector'],
+        include_files=['vector', 'AthContainers/AuxElement.h'],
         arguments=['moment_name', ],
-        code=['auto result = obj_j->getAttribute<float>(moment_name);'],
+        code=['auto result = moment_accessor(*obj_j);'],
         result='result',
         cpp_return_type='float',
         method_object='obj_j',
         instance_object='xAOD::Jet_v1',
+        instance_fields=[('moment_accessor', 'SG::AuxElement::ConstAccessor<float>', 'moment_name')],
     )
     get_attribute_vector_float = cpp_ast.CPPCodeSpecification(
         name='getAttributeFloat',
-        include_files=['vector'],
+        include_files=['vector', 'AthContainers/AuxElement.h'],
         arguments=['moment_name', ],
-        code=['auto result = obj_j->getAttribute<std::vector<double>>(moment_name);'],
+        code=['const auto &result = moment_accessor(*obj_j);'],
         result='result',
         cpp_return_type='double',
         cpp_return_is_collection=True,
         method_object='obj_j',
         instance_object='xAOD::Jet_v1',
+        instance_fields=[('moment_accessor', 'SG::AuxElement::ConstAccessor<std::vector<double>>', 'moment_name')],
+        cpp_return_is_reference=True,
     )
     return {
         'getAttribute': getAttribute,
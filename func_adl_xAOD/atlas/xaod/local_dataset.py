@@ -1,9 +1,11 @@
 from pathlib import Path
 from typing import List, Optional, Union
 
+from func_adl_xAOD.common.build_cache import build_cache
 from func_adl_xAOD.common.local_dataset import LocalDataset, docker_volume_info
 from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
 from func_adl_xAOD.common.executor import executor
+from func_adl_xAOD.common.timing import span_exporter
 
 
 class xAODDataset(LocalDataset):
@@ -13,18 +15,27 @@ class xAODDataset(LocalDataset):
                  files: Union[Path, str, List[Path], List[str]],
                  docker_image: str = 'atlas/analysisbase',
                  docker_tag: str = '21.2.197',
-                 output_directory: Optional[Path] = None):
+                 output_directory: Optional[Path] = None,
+                 build_cache: Optional[build_cache] = None,
+                 max_workers: int = 1,
+                 timeout: Optional[float] = None,
+                 span_exporter: Optional[span_exporter] = None):
         '''Run on the given files
 
         Args:
             files (Path): Locally accessible files we are going to run on
             docker_image (str): The docker image name to run the executable
             docker_tag (str): The docker tag to use to run the executable
+            build_cache (Optional[build_cache]): Re-use compiled builds of identical queries
+            max_workers (int): Run the files in this many containers at once. The query is
+                compiled once and shared by all of them.
+            timeout (Optional[float]): Kill the query if it runs longer than this many seconds
+            span_exporter (Optional[span_exporter]): Send the timing of each phase of every query here
 
         Note:
             * (R21 Release Notes)[https://twiki.cern.ch/twiki/bin/viewauth/AtlasProtected/AnalysisBaseReleaseNotes21_2]
         '''
-        super().__init__(files, docker_image, docker_tag, output_directory)
+        super().__init__(files, docker_image, docker_tag, output_directory, build_cache, max_workers, timeout, span_exporter)
 
     def get_executor_obj(self) -> executor:
         '''Return the code that will actually generate the C++ we need to execute
@@ -35,5 +46,8 @@ class xAODDataset(LocalDataset):
         '''
         return atlas_xaod_executor()
 
+    def can_share_build(self) -> bool:
+        return True
+
     def docker_cache_volume(self) -> List[docker_volume_info]:
         return [docker_volume_info(docker_name='atlas_xaod_calibration_cache', mount_point='/xaod_calibration_cache')]
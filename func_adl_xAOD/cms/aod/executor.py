@@ -28,12 +28,8 @@ class cms_aod_executor(executor):
 
         super().__init__(file_names, runner_name, template_dir_name, method_names)
 
-        define_default_cms_types()
-
-    def reset(self):
-        '''Reset system to initial state
-        '''
-        super().reset()
+    def define_default_types(self):
+        'Add the CMS AOD default types'
         define_default_cms_types()
 
     @staticmethod
@@ -1,3 +1,4 @@
+import func_adl_xAOD.common.cpp_representation as crep
 from func_adl_xAOD.common.ast_to_cpp_translator import query_ast_visitor
 from func_adl_xAOD.common.statement import book_ttree, ttree_fill
 
@@ -5,26 +6,30 @@ from func_adl_xAOD.common.statement import book_ttree, ttree_fill
 class book_cms_aod_ttree(book_ttree):
     'Book an cms TTree for writing out. Meant to be in the Book method'
 
-    def __init__(self, tree_name, leaves):
+    def __init__(self, tree_name, leaves, tree_var: crep.cpp_variable):
         super().__init__(tree_name, leaves)
+        self._tree_var = tree_var
 
     def emit(self, e):
-        'Emit the book statement for a tree'
+        'Emit the book statement for a tree (in its own scope, as there may be more than one tree)'
+        e.add_line('{')
         e.add_line("edm::Service<TFileService> fs;")
-        e.add_line('myTree = fs->make<TTree>("{0}", "My analysis ntuple");'.format(
-            self._tree_name))
+        e.add_line('{0} = fs->make<TTree>("{1}", "My analysis ntuple");'.format(
+            self._tree_var.as_cpp(), self._tree_name))
         for var_pair in self._leaves:
-            e.add_line('myTree->Branch("{0}", &{1});'.format(var_pair[0], var_pair[1].as_cpp()))
+            e.add_line('{0}->Branch("{1}", &{2});'.format(self._tree_var.as_cpp(), var_pair[0], var_pair[1].as_cpp()))
+        e.add_line('}')
 
 
 class cms_aod_ttree_fill(ttree_fill):
     'Fill a CMS TTree'
 
-    def __init__(self, tree_name):
+    def __init__(self, tree_name, tree_var: crep.cpp_variable):
         super().__init__(tree_name)
+        self._tree_var = tree_var
 
     def emit(self, e):
-        e.add_line('myTree->Fill();')
+        e.add_line('{0}->Fill();'.format(self._tree_var.as_cpp()))
 
 
 class cms_aod_query_ast_visitor(query_ast_visitor):
@@ -38,7 +43,7 @@ class cms_aod_query_ast_visitor(query_ast_visitor):
         super().__init__(prefix)
 
     def create_book_ttree_obj(self, tree_name: str, leaves: list) -> book_ttree:
-        return book_cms_aod_ttree(tree_name, leaves)
+        return book_cms_aod_ttree(tree_name, leaves, self._tree_var(tree_name))
 
     def create_ttree_fill_obj(self, tree_name: str) -> ttree_fill:
-        return cms_aod_ttree_fill(tree_name)
+        return cms_aod_ttree_fill(tree_name, self._tree_var(tree_name))
@@ -26,12 +26,9 @@ class cms_miniaod_executor(executor):
         method_names.update(get_math_methods())
         method_names.update(get_cms_functions())
         super().__init__(file_names, runner_name, template_dir_name, method_names)
-        define_default_cms_types()
 
-    def reset(self):
-        '''Reset system to initial state
-        '''
-        super().reset()
+    def define_default_types(self):
+        'Add the CMS miniAOD default types'
         define_default_cms_types()
 
     @staticmethod
@@ -4,6 +4,7 @@ from typing import List, Optional, Union
 from func_adl_xAOD.common.local_dataset import LocalDataset, docker_volume_info
 from func_adl_xAOD.cms.miniaod.executor import cms_miniaod_executor
 from func_adl_xAOD.common.executor import executor
+from func_adl_xAOD.common.timing import span_exporter
 
 
 class CMSRun2miniAODDataset(LocalDataset):
@@ -13,15 +14,23 @@ class CMSRun2miniAODDataset(LocalDataset):
                  files: Union[Path, str, List[Path], List[str]],
                  docker_image: str = 'cmsopendata/cmssw_7_6_7-slc6_amd64_gcc493',
                  docker_tag: str = 'latest',
-                 output_directory: Optional[Path] = None):
+                 output_directory: Optional[Path] = None,
+                 max_workers: int = 1,
+                 timeout: Optional[float] = None,
+                 span_exporter: Optional[span_exporter] = None):
         '''Run on the given files
 
         Args:
             files (Path): Locally accessible files we are going to run on
             docker_image (str): The docker image name to run the executable
             docker_tag (str): The docker tag to use to run the executable
+            max_workers (int): Run the files in this many containers at once. Each container
+                compiles the query itself.
+            timeout (Optional[float]): Kill the query if it runs longer than this many seconds
+            span_exporter (Optional[span_exporter]): Send the timing of each phase of every query here
         '''
-        super().__init__(files, docker_image, docker_tag, output_directory)
+        super().__init__(files, docker_image, docker_tag, output_directory, max_workers=max_workers, timeout=timeout,
+                         span_exporter=span_exporter)
 
     def get_executor_obj(self) -> executor:
         '''Return the code that will actually generate the C++ we need to execute
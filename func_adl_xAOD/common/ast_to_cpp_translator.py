@@ -1,7 +1,7 @@
 import ast
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Type, Union, cast
+from typing import Any, Dict, List, Optional, Set, Type, Union, cast
 
 import func_adl_xAOD.common.cpp_ast as cpp_ast
 import func_adl_xAOD.common.cpp_representation as crep
@@ -9,13 +9,14 @@ import func_adl_xAOD.common.cpp_types as ctyp
 import func_adl_xAOD.common.result_ttree as rh
 import func_adl_xAOD.common.statement as statement
 from func_adl.ast.call_stack import argument_stack, stack_frame
-from func_adl.ast.func_adl_ast_utils import FuncADLNodeVisitor, function_call
+from func_adl.ast.func_adl_ast_utils import FuncADLNodeVisitor, function_call, is_call_of
 from func_adl.util_ast import lambda_unwrap
 from func_adl_xAOD.common.cpp_functions import FunctionAST
 from func_adl_xAOD.common.cpp_vars import unique_name
 from func_adl_xAOD.common.generated_code import generated_code
+from func_adl_xAOD.common.meta_data import CodeGenerationOptions, OutputColumnTypes
 from func_adl_xAOD.common.util_scope import (deepest_scope, gc_scope,
-                                             gc_scope_top_level,
+                                             gc_scope_top_level, same_scope,
                                              top_level_scope)
 from func_adl_xAOD.common.utils import most_accurate_type
 
@@ -58,7 +59,7 @@ class xAODTranslationError(Exception):
 def check_accumulator_type(t: ctyp.terminal):
     'We can only deal with certain types for doing an accumulation. Make sure this is one.'
     t_str = str(t)
-    return (t_str == "float") or (t_str == "double") or (t_str == "int")
+    return (t_str == "float") or (t_str == "double") or (t_str == "int") or (t_str == "bool")
 
 
 def guess_type_from_number(n):
@@ -75,14 +76,35 @@ def rep_is_collection(rep) -> bool:
     return False
 
 
+def _stored_type(t: ctyp.terminal) -> ctyp.terminal:
+    'A collection we only have a pointer to (like a moment in the aux store) is stored as a copy'
+    if isinstance(t, ctyp.collection) and t.is_a_pointer:
+        return ctyp.collection(t.element_type)
+    return t
+
+
+def _stored_value(rep: crep.cpp_value) -> crep.cpp_value:
+    'The value to store for `rep` - see `_stored_type`'
+    if isinstance(rep.cpp_type(), ctyp.collection):
+        return crep.dereference_var(rep)
+    return rep
+
+
 def get_ttree_type(rep):
     'Looking at a rep, figure out how it should get stored in a tree'
     if isinstance(rep, crep.cpp_sequence):
         if not isinstance(rep.sequence_value(), (crep.cpp_value, crep.cpp_sequence)):
             raise Exception("Nested data structures (2D arrays, etc.) in TTree's are not yet supported. Numbers or arrays of numbers only for now.")
-        return ctyp.collection(rep.sequence_value().cpp_type())
+        return ctyp.collection(_stored_type(rep.sequence_value().cpp_type()))
     else:
-        return rep.cpp_type()
+        return _stored_type(rep.cpp_type())
+
+
+def _with_number_type(t: ctyp.terminal, cpp_type: str) -> ctyp.terminal:
+    'Replace the type of the numbers in `t` (a number, or a vector of them, etc.) with `cpp_type`'
+    if isinstance(t, ctyp.collection):
+        return ctyp.collection(_with_number_type(t.element_type, cpp_type))
+    return ctyp.terminal(cpp_type)
 
 
 def determine_type_mf(parent_type: ctyp.terminal, function_name: str) -> ctyp.MethodInvokeInfo:
@@ -135,12 +157,37 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         self._arg_stack = argument_stack()
         self._prefix = prefix
 
+        # How the code should be generated (set by the executor from the query's metadata)
+        self.code_options = CodeGenerationOptions()
+
+        # The types to write the output columns as (set by the executor from the query's metadata)
+        self.column_types = OutputColumnTypes()
+
+        # Names of the trees booked so far - each must be unique.
+        self._tree_names: List[str] = []
+
+        # The class variables that hold a pointer to each output tree
+        self._tree_vars: Dict[str, crep.cpp_variable] = {}
+
+        # Objects from `FirstOrDefault` - they are `nullptr` if the sequence was empty.
+        self._null_defaults: Set[str] = set()
+
     def include_files(self):
         return self._gc.include_files()
 
     def link_libraries(self) -> List[str]:
         return self._gc.link_libraries()
 
+    def header_include_files(self) -> List[str]:
+        'Return the include files the class declaration needs'
+        return self._gc.header_include_files()
+
+    def start_query(self):
+        '''Move back to the top level so a new query can be translated. Used when more than
+        one query is translated into the same event loop.
+        '''
+        self._gc.set_scope(top_level_scope())
+
     def emit_query(self, e):
         'Emit the parsed lines'
         self._gc.emit_query_code(e)
@@ -150,7 +197,18 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         self._gc.emit_book_code(e)
 
     def class_declaration_code(self):
-        return self._gc.class_declaration_code()
+        return self._gc.class_declaration_code() \
+            + [f"{v.cpp_type()} {v.as_cpp()};\n" for v in self._tree_vars.values()]
+
+    def _tree_var(self, tree_name: str) -> crep.cpp_variable:
+        'Return the class variable that holds the pointer to the tree `tree_name`'
+        if tree_name not in self._tree_vars:
+            self._tree_vars[tree_name] = crep.cpp_variable(unique_name('tree', is_class_var=True), top_level_scope(), ctyp.terminal('TTree', p_depth=1))
+        return self._tree_vars[tree_name]
+
+    def instance_initialization(self) -> List[str]:
+        'Return the constructor initializer list entries for the class variables the query needs'
+        return self._gc.instance_initialization()
 
     def visit(self, node):
         '''Visit a node. If the node already has a rep, then it has been visited and we
@@ -211,6 +269,9 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
            key's as column names.
         1. Anything else causes an exception to be raised.
 
+        The tree is called `<prefix>_tree`. If a tree with that name has already been booked (more
+        than one query is being translated), a `_<n>` suffix is added.
+
         Args:
             node (ast.AST): Top level `func_adl` expression that is to be renered as a ROOT file.
 
@@ -230,6 +291,12 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if not isinstance(r, crep.cpp_sequence):
             raise ValueError(f'Do not know how to convert {r} into a ROOT file')
 
+        tree_name = f'{self._prefix}_tree'
+        index = 1
+        while tree_name in self._tree_names:
+            tree_name = f'{self._prefix}_tree_{index}'
+            index += 1
+
         # If this is a dict, then pull out each item and re-assemble into a tuple
         # which we can feed to the root guy.
         values = r.sequence_value()
@@ -244,7 +311,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             ast_ttree = function_call('ResultTTree',
                                       [ast_dummy_source,
                                        col_names,
-                                       ast.parse(f'"{self._prefix}_tree"').body[0].value,  # type: ignore
+                                       ast.parse(f'"{tree_name}"').body[0].value,  # type: ignore
                                        ast.parse(f'"{self._prefix}_output"').body[0].value])  # type: ignore
             result = self.get_rep(ast_ttree)
             assert isinstance(result, rh.cpp_ttree_rep)
@@ -255,7 +322,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             ast_ttree = function_call('ResultTTree',
                                       [node,
                                        col_names,
-                                       ast.parse(f'"{self._prefix}_tree"').body[0].value,  # type: ignore
+                                       ast.parse(f'"{tree_name}"').body[0].value,  # type: ignore
                                        ast.parse(f'"{self._prefix}_output"').body[0].value])  # type: ignore
             result = self.get_rep(ast_ttree)
             assert isinstance(result, rh.cpp_ttree_rep)
@@ -264,7 +331,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             ast_ttree = function_call('ResultTTree',
                                       [node,
                                        ast.parse('"col1"').body[0].value,  # type: ignore
-                                       ast.parse(f'"{self._prefix}_tree"').body[0].value,  # type: ignore
+                                       ast.parse(f'"{tree_name}"').body[0].value,  # type: ignore
                                        ast.parse(f'"{self._prefix}_output"').body[0].value])  # type: ignore
             result = self.get_rep(ast_ttree)
             assert isinstance(result, rh.cpp_ttree_rep)
@@ -296,11 +363,27 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         cpp_type = rep.cpp_type()
         assert isinstance(cpp_type, ctyp.collection)
         element_type = cpp_type.element_type
-        iterator_value = crep.cpp_value(unique_name("i_obj"), None, element_type)  # type: ignore
 
         # It could be this should deref until p_depth is 0
         collection = crep.dereference_var(rep)
 
+        # If we already loop over this same collection here, then do this in that loop too
+        # (e.g. several columns of the same jets), rather than looping again. Only other loops
+        # that nothing can depend on, and fetching things from the event (which are moved ahead
+        # of the loop), may come after it.
+        for s in reversed(self._gc.current_statements()):
+            if self._gc.is_event_statement(s):
+                continue
+            if not isinstance(s, statement.loop) or s.has_accumulator or s.exits_early:
+                break
+            if s.can_fuse(collection):
+                s.fused = True
+                self._gc.move_event_statements_before(s)
+                iterator_value = s.loop_variable()
+                self._gc.set_scope(iterator_value.scope())
+                return crep.cpp_sequence(iterator_value, iterator_value, self._gc.current_scope())
+
+        iterator_value = crep.cpp_value(unique_name("i_obj"), None, element_type)  # type: ignore
         l_statement = statement.loop(iterator_value, collection)
         self._gc.add_statement(l_statement)
         iterator_value.reset_scope(self._gc.current_scope())
@@ -336,7 +419,9 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # If this is a collection, then we need to turn it into a sequence.
         if isinstance(rep, crep.cpp_collection):
             r = self.make_sequence_from_collection(rep)
-            self._gc.set_rep(rep, r)
+            if self._gc.get_rep(rep) is None:
+                # (If we joined a loop that was already made for this rep, it is already known)
+                self._gc.set_rep(rep, r)
             return r
 
         # If it isn't a sequence or a collection, then something has gone wrong.
@@ -370,10 +455,11 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # But if this is a sequence of sequences, we are aggregating over the sequence itself. So we need to do it one level
         # up from where the iterator is running on the interior sequence.
         seq_val = seq.sequence_value()
-        if isinstance(seq_val, crep.cpp_sequence):
-            accumulator_scope = seq_val.iterator_value().scope()[-1]
-        else:
-            accumulator_scope = seq.iterator_value().scope()[-1]
+        loop_scope = seq_val.iterator_value().scope() if isinstance(seq_val, crep.cpp_sequence) else seq.iterator_value().scope()
+        accumulator_scope = loop_scope[-1]
+        loop = loop_scope.frame_statements(-1)
+        if isinstance(loop, statement.loop):
+            loop.has_accumulator = True
         accumulator = crep.cpp_variable(unique_name("aggResult"),
                                         accumulator_scope,
                                         accumulator_type,
@@ -382,54 +468,54 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         return accumulator, accumulator_scope
 
+    def _set_accumulation_scope(self, seq: crep.cpp_sequence):
+        'Set the scope to where each item of `seq` is available, which is where an accumulator is updated'
+        sv = seq.sequence_value()
+        if isinstance(sv, crep.cpp_sequence):
+            self._gc.set_scope(sv.iterator_value().scope()[-1])
+        else:
+            self._gc.set_scope(sv.scope())
+
+    def _aggregate_from_first(self, node: ast.Call, raw_seq: ast.AST, first_lambda: Optional[ast.AST], agg_lambda: ast.AST):
+        '''Aggregate a sequence, starting from its first item. The accumulator is set to `first_lambda`
+        called on the first item (or the item itself if there is no lambda), and then `agg_lambda` is
+        called to update it with each item after that. If the sequence is empty, the result is the
+        default value for its type (e.g. `0`).
+        '''
+        seq = self.as_sequence(raw_seq)
+        self._set_accumulation_scope(seq)
+        sv = seq.sequence_value()
+
+        is_first = crep.cpp_variable(unique_name("is_first"), self._gc.current_scope(), cpp_type=ctyp.terminal('bool'),
+                                     initial_value=crep.cpp_value('true', self._gc.current_scope(), ctyp.terminal('bool')))
+        self._gc.add_statement(statement.iftest(is_first))
+        if_scope = self._gc.current_scope()
+        self._gc.add_statement(statement.set_var(is_first, crep.cpp_value("false", self._gc.current_scope(), ctyp.terminal('bool'))))
+        first_value = cast(crep.cpp_value, sv if first_lambda is None else self.get_rep(ast.Call(func=first_lambda, args=[sv.as_ast()])))
+        accumulator, accumulator_scope = self._create_accumulator(seq, acc_type=first_value.cpp_type())
+        accumulator_scope.declare_variable(is_first)
+        self._gc.add_statement(statement.set_var(accumulator, first_value))
+
+        # Every item after the first one
+        self._gc.set_scope(if_scope)
+        self._gc.pop_scope()
+        self._gc.add_statement(statement.elsephrase())
+        call = ast.Call(func=agg_lambda, args=[accumulator.as_ast(), sv.as_ast()])
+        update_lambda = cast(crep.cpp_value, self.get_rep(call))
+        if update_lambda.cpp_type().type != first_value.cpp_type().type:
+            accumulator.update_type(most_accurate_type([first_value.cpp_type(), update_lambda.cpp_type()]))
+        self._gc.add_statement(statement.set_var(accumulator, update_lambda))
+
+        # Finally, since this is a terminal, we need to pop off the top.
+        self._gc.set_scope(accumulator_scope)
+        crep.set_rep(node, accumulator)
+
     def visit_Call_Aggregate_only(self, node: ast.Call, args: List[ast.AST]):
         '''
         - (acc lambda): the accumulator is set to the first element, and the lambda is called to
                         update it after that. This is called `agg_only`.
         '''
-        raise NotImplementedError()
-        # This is commented out b.c. we've not written detailed testing nor found a real
-        # use yet in code - though it may very well happen! So we'll leave our first guess in here.
-        # agg_lambda = node.args[0]
-
-        # # Get the sequence we are calling against and the accumulator
-        # if not isinstance(node.func, ast.Attribute):
-        #     raise Exception("Wrong type of function")
-        # seq = self.as_sequence(node.func.value)
-        # accumulator, accumulator_scope = self._create_accumulator(seq)
-
-        # # We have to do a simple if statement here so that the first time through we can set the
-        # # accumulator, and the second time we can add to it.
-
-        # is_first_iter = crep.cpp_variable(unique_name("is_first"), self._gc.current_scope(), cpp_type=ctyp.terminal('bool'), initial_value=crep.cpp_value('true', self._gc.current_scope(), ctyp.terminal('bool')))
-        # accumulator_scope.declare_variable(is_first_iter)
-
-        # # Set the scope where we will be doing the accumulation
-        # sv = seq.sequence_value()
-        # if isinstance(sv, crep.cpp_sequence):
-        #     self._gc.set_scope(sv.iterator_value().scope()[-1])
-        # else:
-        #     self._gc.set_scope(sv.scope())
-
-        # # Code up if statement to select out the first element.
-        # if_first = statement.iftest(is_first_iter)
-        # self._gc.add_statement(if_first)
-        # self._gc.add_statement(statement.set_var(is_first_iter, crep.cpp_value("false", self._gc.current_scope(), ctyp.terminal('bool'))))
-
-        # # Set the accumulator
-        # self._gc.add_statement(statement.set_var(accumulator, seq.sequence_value()))
-        # self._gc.pop_scope()
-
-        # # Now do the if statement and make the call to calculate the accumulation.
-        # self._gc.add_statement(statement.elsephrase())
-        # call = ast.Call(func=agg_lambda, args=[accumulator.as_ast(), seq.sequence_value().as_ast()])
-        # self._gc.add_statement(statement.set_var(accumulator, self.get_rep(call)))
-
-        # # Finally, since this is a terminal, we need to pop off the top.
-        # self._gc.set_scope(accumulator_scope)
-
-        # # Cache the results in our result in case we are skipping nodes in the AST.
-        # node.rep = accumulator
+        self._aggregate_from_first(node, node.args[0], None, node.args[1])
 
     def visit_call_Aggregate_initial(self, node: ast.Call, args: List[ast.AST]):
         '''
@@ -474,56 +560,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
                         element in the sequence, and then acc is called to update it after that.
                         This is called `agg_initial_func`
         '''
-        raise NotImplementedError()
-        # Needs testing!
-        # agg_lambda = node.args[1]
-        # init_lambda = node.args[0]
-
-        # # Get the sequence we are calling against and the accumulator
-        # seq = self.as_sequence(node.func.value)
-        # accumulator, accumulator_scope = self._create_accumulator(seq, initial_value=init_val)
-
-        # is_first_iter = crep.cpp_value(unique_name("is_first"), accumulator_scope, cpp_type=ctyp.terminal("bool"), initial_value='true')
-        # accumulator_scope.declare_variable(is_first_iter)
-
-        # # BELOW HERE NOT CONVERTED YET.
-
-        # # We have to initialized the variable to some value, and it depends on how the user
-        # # is trying to initialize things - first iteration or with a value. We've done the value case above.
-        # is_first_iter = None
-        # if use_first_element_separately:
-        #     is_first_iter = cpp_variable(unique_name("is_first"), self._gc.current_scope(), cpp_type="bool", initial_value='true')
-        #     decl_block.declare_variable(is_first_iter)
-
-        # # Now we need to emit code at the accumulator level.
-        # self._gc.set_scope(c_loop.scope())
-
-        # # If we have to use the first lambda to set the first value, then we need that code up front.
-        # if use_first_element_separately:
-        #     if_first = statement.iftest(cpp_constant(is_first_iter.as_cpp()))
-        #     self._gc.add_statement(if_first)
-        #     self._gc.add_statement(statement.set_var(is_first_iter, cpp_constant("false")))
-        #     first_scope = self._gc.current_scope()
-
-        #     if init_lambda is not None:
-        #         call = ast.Call(init_lambda, [c_iter.as_ast()])
-        #         self._gc.add_statement(statement.set_var(result, self.get_rep(call)))
-        #     else:
-        #         self._gc.add_statement(statement.set_var(result, c_iter))
-
-        #     self._gc.set_scope(first_scope)
-        #     self._gc.pop_scope()
-        #     self._gc.add_statement(statement.elsephrase())
-
-        # # Perform the aggregation function. We need to call it with the value and the accumulator.
-        # call = ast.Call(func=agg_lambda, args=[result.as_ast(), c_iter.as_ast()])
-        # self._gc.add_statement(statement.set_var(result, self.get_rep(call)))
-
-        # # Finally, since this is a terminal, we need to pop off the top.
-        # self._gc.set_scope(decl_block_scope)
-
-        # # Cache the results in our result incase we are skipping nodes in the AST.
-        # node.rep = result
+        self._aggregate_from_first(node, node.args[0], node.args[1], node.args[2])
 
     def call_Aggregate(self, node: ast.Call, args: List[ast.AST]):
         r'''Implement the aggregate algorithm in C++
@@ -547,7 +584,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if len(node.args) == 2:
             return self.visit_Call_Aggregate_only(node, args)
         elif len(node.args) == 3:
-            if isinstance(node.args[0], ast.Lambda):
+            if isinstance(node.args[1], ast.Lambda):
                 return self.visit_call_Aggregate_initial_func(node, args)
             else:
                 return self.visit_call_Aggregate_initial(node, args)
@@ -555,6 +592,116 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         # This isn't good!
         raise Exception("Unknown call to Aggregate. Must be Aggregate(func), Aggregate(const, func), or Aggregate(func, func)")
 
+    def _call_Aggregate_with(self, node: ast.Call, source: ast.AST, initial_value: int, agg_lambda: str):
+        'Implement a call as `Aggregate(source, initial_value, agg_lambda)`'
+        agg = function_call('Aggregate', [source, ast.Constant(initial_value), cast(ast.Expr, ast.parse(agg_lambda).body[0]).value])
+        crep.set_rep(node, self.get_rep(agg))
+
+    def call_Count(self, node: ast.Call, args: List[ast.AST]):
+        '''Count the items in a sequence. A collection (perhaps after some `Select` calls, which do not
+        change the number of items) is asked for its size. Anything else is counted in a loop.
+        '''
+        assert len(args) == 1
+        source = args[0]
+        while is_call_of(source, 'Select') and len(source.args) == 2:  # type: ignore
+            source = source.args[0]  # type: ignore
+
+        rep = self.get_rep(source)
+        if isinstance(rep, crep.cpp_collection):
+            # `size()` is unsigned - make it an `int` so arithmetic and tests on it are signed
+            size = f'{crep.base_type_member_access(rep)}size()'
+            crep.set_rep(node, crep.cpp_value(f'static_cast<int>({size})', rep.scope(), ctyp.terminal('int')))
+        else:
+            self._call_Aggregate_with(node, source, 0, 'lambda acc, v: acc + 1')
+
+    def call_len(self, node: ast.Call, args: List[ast.AST]):
+        'Same as `Count`'
+        self.call_Count(node, args)
+
+    def call_Sum(self, node: ast.Call, args: List[ast.AST]):
+        'Add up the items in a sequence'
+        assert len(args) == 1
+        self._call_Aggregate_with(node, args[0], 0, 'lambda acc, v: acc + v')
+
+    def _min_max(self, node: ast.Call, args: List[ast.AST], compare: str):
+        '''Find the smallest (or largest) item in the sequence. The result is set from the first item,
+        and after that from any item that `compare`s better. For an empty sequence it is `0`.
+        '''
+        assert len(args) == 1
+        seq = self.as_sequence(args[0])
+        sv = seq.sequence_value()
+        if isinstance(sv, (crep.cpp_sequence, crep.cpp_collection)):
+            raise ValueError('Min and Max can only be used on a sequence of values, not a sequence of sequences.')
+
+        accumulator, accumulator_scope = self._create_accumulator(seq, acc_type=sv.cpp_type())
+        is_first = crep.cpp_variable(unique_name("is_first"), accumulator_scope, cpp_type=ctyp.terminal('bool'),
+                                     initial_value=crep.cpp_value('true', accumulator_scope, ctyp.terminal('bool')))
+        accumulator_scope.declare_variable(is_first)
+
+        self._set_accumulation_scope(seq)
+        better = crep.cpp_value(f'{is_first.as_cpp()} || ({sv.as_cpp()}{compare}{accumulator.as_cpp()})',
+                                self._gc.current_scope(), ctyp.terminal('bool'))
+        self._gc.add_statement(statement.iftest(better))
+        self._gc.add_statement(statement.set_var(is_first, crep.cpp_value('false', self._gc.current_scope(), ctyp.terminal('bool'))))
+        self._gc.add_statement(statement.set_var(accumulator, sv))
+
+        self._gc.set_scope(accumulator_scope)
+        crep.set_rep(node, accumulator)
+
+    def call_Min(self, node: ast.Call, args: List[ast.AST]):
+        'The smallest item in a sequence'
+        self._min_max(node, args, '<')
+
+    def call_Max(self, node: ast.Call, args: List[ast.AST]):
+        'The largest item in a sequence'
+        self._min_max(node, args, '>')
+
+    def _any_all(self, node: ast.Call, args: List[ast.AST], is_any: bool):
+        '''Test if the lambda is true for any (or all) of the items in the sequence. The loop is left as
+        soon as the answer is known, unless other code needs it to run to the end.
+        '''
+        assert len(args) == 2
+        seq = self.as_sequence(args[0])
+        sv = seq.sequence_value()
+        bool_type = ctyp.terminal('bool')
+        accumulator, accumulator_scope = self._create_accumulator(seq, acc_type=bool_type,
+                                                                  initial_value=crep.cpp_value('false' if is_any else 'true', self._gc.current_scope(), bool_type))
+
+        self._set_accumulation_scope(seq)
+        test = cast(crep.cpp_value, self.get_rep(ast.Call(func=lambda_unwrap(args[1]), args=[sv.as_ast()])))
+        if not is_any:
+            test = crep.cpp_value(f'!{test.as_cpp()}', test.scope(), bool_type)
+        self._gc.add_statement(statement.iftest(test))
+        self._gc.add_statement(statement.set_var(accumulator, crep.cpp_value('true' if is_any else 'false', self._gc.current_scope(), bool_type)))
+
+        loop = self._loop_to_exit(seq, self._gc.current_scope())
+        if loop is not None:
+            loop.exits_early = True
+            self._gc.add_statement(statement.loop_break())
+
+        self._gc.set_scope(accumulator_scope)
+        crep.set_rep(node, accumulator)
+
+    def call_Any(self, node: ast.Call, args: List[ast.AST]):
+        'True if the lambda is true for at least one item in the sequence'
+        self._any_all(node, args, True)
+
+    def call_All(self, node: ast.Call, args: List[ast.AST]):
+        'True if the lambda is true for every item in the sequence (or there are none)'
+        self._any_all(node, args, False)
+
+    def check_not_null_default(self, obj: crep.cpp_value, member: str):
+        '''An object from `FirstOrDefault` is `nullptr` if its sequence is empty, so it can't be
+        used to get at `member`.
+
+        Raises:
+            ValueError: If `obj` came from `FirstOrDefault`
+        '''
+        if obj.as_cpp() in self._null_defaults:
+            raise ValueError(f"Can not get '{member}' from an object returned by FirstOrDefault - it is null if the "
+                             f"sequence is empty. Select what is needed first (like `seq.Select(lambda j: j.{member}()).FirstOrDefault()`), "
+                             "or use First.")
+
     def visit_Call_Member(self, call_node: ast.Call):
         'Method call on an object'
 
@@ -571,6 +718,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         # We support member calls that directly translate only. Here, for example, this is only for
         # obj.pt() or similar. The translation is direct.
+        self.check_not_null_default(calling_against, function_name)
         m_info = determine_type_mf(calling_against.cpp_type(), function_name)
         c_stub = crep.base_type_member_access(calling_against, m_info.deref_depth)
 
@@ -580,7 +728,13 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         if isinstance(m_info.r_type, ctyp.collection):
             crep.set_rep(call_node, crep.cpp_collection(v_name, calling_against.scope(), m_info.r_type))
         else:
-            crep.set_rep(call_node, crep.cpp_value(v_name, calling_against.scope(), m_info.r_type))
+            value = crep.cpp_value(v_name, calling_against.scope(), m_info.r_type)
+            invariant = self._gc.invariant_value(value) if self.code_options.loop_invariant_code_motion else None
+            if invariant is not None:
+                value = invariant
+            elif self.code_options.common_subexpression_elimination:
+                value = self._gc.common_value(value)
+            crep.set_rep(call_node, value)
 
     def visit_function_ast(self, call_node):
         'Drop-in replacement for a function'
@@ -631,6 +785,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         variable = node.attr
         if not isinstance(obj, crep.cpp_value):
             raise Exception("Do not know how to get member '{0}' of '{1}'".format(variable, type(obj).__name__))
+        self.check_not_null_default(obj, variable)
         m_info = determine_type_mf(obj.cpp_type(), variable)
         crep.set_rep(node, crep.cpp_value(f"{crep.base_type_member_access(obj, m_info.deref_depth)}{variable}", self._gc.current_scope(), m_info.r_type))
 
@@ -741,30 +896,54 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         We'd like to be able to use the "?" operator in C++, but the
         problem is lazy evaluation. It could be when we look at one or the
         other item, a bunch of prep work has to be done - and that will
-        show up in separate statements. So we have to use if/then/else with
-        a result value.
-        '''
-
-        # The result we'll store everything in.
-        result = crep.cpp_variable(unique_name("if_else_result"), self._gc.current_scope(), cpp_type=ctyp.terminal("double"))
-        self._gc.declare_variable(result)
+        show up in separate statements. So we use if/then/else with
+        a result value, and only turn it into a "?" if neither branch
+        needed any.
 
+        The result has the type of the branches, or the most accurate of them if
+        they are different numbers.
+        '''
         # We always have to evaluate the test.
         current_scope = self._gc.current_scope()
         test_expr = self.get_rep(node.test)
-        self._gc.add_statement(statement.iftest(test_expr))
+        if_block = statement.iftest(test_expr)
+        self._gc.add_statement(if_block)
         if_scope = self._gc.current_scope()
 
-        # Next, we do the true and false if statement.
-        self._gc.add_statement(statement.set_var(result, self.get_rep(node.body)))
+        # Next, we do the true and false if statement. The result is declared once we know its type.
+        result = crep.cpp_variable(unique_name("if_else_result"), current_scope, cpp_type=ctyp.terminal("double"))
+        body = cast(crep.cpp_value, self.get_rep(node.body))
+        set_body = statement.set_var(result, body)
+        self._gc.add_statement(set_body)
         self._gc.set_scope(if_scope)
         self._gc.pop_scope()
-        self._gc.add_statement(statement.elsephrase())
-        self._gc.add_statement(statement.set_var(result, self.get_rep(node.orelse)))
+        else_block = statement.elsephrase()
+        self._gc.add_statement(else_block)
+        orelse = cast(crep.cpp_value, self.get_rep(node.orelse))
+        set_orelse = statement.set_var(result, orelse)
+        self._gc.add_statement(set_orelse)
         self._gc.set_scope(current_scope)
 
+        types = [body.cpp_type(), orelse.cpp_type()]
+        if str(types[0]) == str(types[1]):
+            result_type = types[0]
+        elif all(not t.is_a_pointer and t.type in ['int', 'float', 'double'] for t in types):
+            result_type = most_accurate_type(types)
+        else:
+            result_type = ctyp.terminal("double")
+
+        if all(b._statements == [st] and len(b._variables) == 0 for b, st in [(if_block, set_body), (else_block, set_orelse)]):
+            # Nothing to prepare in either branch
+            self._gc.remove_statement(if_block)
+            self._gc.remove_statement(else_block)
+            r = crep.cpp_value(f'({test_expr.as_cpp()} ? {body.as_cpp()} : {orelse.as_cpp()})', current_scope, result_type)
+        else:
+            result.update_type(result_type)
+            self._gc.declare_variable(result)
+            r = result
+
         # Done, the result is the rep of this node!
-        crep.set_rep(node, result)
+        crep.set_rep(node, r)
 
     def visit_Compare(self, node):
         'A compare between two things. Python supports more than that, but not implemented yet.'
@@ -876,21 +1055,46 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
             assert isinstance(e_rep, crep.cpp_sequence), \
                 f'Do not know how to loop over a {type(e_rep)}'
 
-            def fill_collection_levels(seq: crep.cpp_sequence, accumulator: crep.cpp_value):
+            def reserve(seq: crep.cpp_sequence, accumulator: crep.cpp_value, empty_scope: Union[gc_scope, gc_scope_top_level]):
+                '''If an item is added to `accumulator` for every item of a collection, make room for them
+                all ahead of the loop. `accumulator` is empty at `empty_scope`, so this is only done if
+                the loop is not inside another loop from there. If some items are filtered out, nothing
+                is done - the accumulator keeps its memory when it is cleared.
+                '''
+                loop_scope = seq.iterator_value().scope()
+                loop = loop_scope.frame_statements(-1)
+                if not isinstance(loop, statement.loop) or loop.size() is None \
+                        or not same_scope(self._gc.current_scope(), loop_scope) or not loop_scope.starts_with(empty_scope):
+                    return
+                if any(isinstance(loop_scope.frame_statements(i), statement.loop) for i in range(len(empty_scope), len(loop_scope) - 1)):
+                    return
+                cs = self._gc.current_scope()
+                self._gc.set_scope(loop_scope[-1])
+                self._gc.add_statement_before(statement.container_reserve(accumulator, loop.size()), loop)
+                self._gc.set_scope(cs)
+
+            def fill_collection_levels(seq: crep.cpp_sequence, accumulator: crep.cpp_value, empty_scope: Union[gc_scope, gc_scope_top_level]):
                 inner = seq.sequence_value()
                 scope = seq.scope()
+                storage = None
                 if isinstance(inner, crep.cpp_sequence):
+                    # The items of an inner sequence are collected in a vector that belongs to the
+                    # query, so that its memory is reused rather than allocated for each outer item.
                     scope = seq.iterator_value().scope()
-                    storage = crep.cpp_variable(unique_name('ntuple'), scope, cpp_type=inner.cpp_type())
-                    assert not isinstance(scope, gc_scope_top_level)
-                    scope.declare_variable(storage)
-                    fill_collection_levels(inner, storage)
+                    storage = crep.cpp_variable(unique_name('ntuple', is_class_var=True), scope,
+                                                cpp_type=cast(ctyp.collection, accumulator.cpp_type()).element_type)
+                    self._gc.declare_class_variable(storage)
+                    fill_collection_levels(inner, storage, scope)
                     inner = storage
 
                 set_scope(scope, scope_fill)
-                self._gc.add_statement(statement.push_back(accumulator, inner))
+                reserve(seq, accumulator, empty_scope)
+                self._gc.add_statement(statement.push_back(accumulator, _stored_value(inner)))
+                if storage is not None:
+                    self._gc.add_statement(statement.container_clear(storage))
 
-            fill_collection_levels(e_rep, e_name)
+            # The top level accumulator is empty at the start of each event
+            fill_collection_levels(e_rep, e_name, self._gc.event_scope() if scope_fill.is_top_level() else scope_fill)
 
         else:
             # Set the scope. Normally we want to do it where the variable was calculated
@@ -912,6 +1116,19 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         return scope_fill
 
+    def _column_type(self, name: str, rep: crep.cpp_rep_base) -> ctyp.terminal:
+        'The type column `name`, holding `rep`, is written to the tree as (see `OutputColumnTypes`)'
+        t = get_ttree_type(rep)
+        number = t
+        while isinstance(number, ctyp.collection):
+            number = number.element_type
+        cpp_type = self.column_types.cpp_type(name, number.type)
+        if cpp_type is None:
+            return t
+        if not (number.is_number or str(number) == 'bool'):
+            raise ValueError(f'Column {name} holds {number}, which can not be written as {cpp_type}')
+        return _with_number_type(t, cpp_type)
+
     def call_ResultTTree(self, node: ast.Call, args: List[ast.AST]):
         '''This AST means we are taking an iterable and converting it to a ROOT file.
         '''
@@ -921,6 +1138,9 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         column_names = _extract_column_names(args[1])
         tree_name = ast.literal_eval(args[2])
         assert isinstance(tree_name, str)
+        if tree_name in self._tree_names:
+            raise ValueError(f'The tree name "{tree_name}" is used by more than one query - each must write to its own tree.')
+        self._tree_names.append(tree_name)
         # root_filename = args[3]
 
         # Get the representations for each variable. We expect some sort of structure
@@ -944,7 +1164,7 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
 
         # Next, look at each on in turn to decide if it is a vector or a simple variable.
         # Create a variable that we will fill for each one.
-        var_names = [(name, crep.cpp_variable(unique_name(name, is_class_var=True), self._gc.current_scope(), cpp_type=get_ttree_type(rep)))
+        var_names = [(name, crep.cpp_variable(unique_name(name, is_class_var=True), self._gc.current_scope(), cpp_type=self._column_type(name, rep)))
                      for name, rep in zip(column_names, seq_values.values())]
 
         # For each incoming variable, we need to declare something we are going to write.
@@ -1058,60 +1278,62 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         crep.set_rep(node, crep.cpp_sequence(new_sequence_var, seq.iterator_value(), self._gc.current_scope()))
 
     def call_Range(self, node: ast.Call, args: List[ast.AST]):
-        'Create a collection of numbers from lower_bound'
-
+        '''A sequence of the integers from the lower bound up to, but not including, the upper bound.
+        They are counted out by a loop - nothing is stored.
+        '''
         assert len(args) == 2, 'Range(lower bound, upper bound) is the only allowed form'
-        lower_bound = args[0]
-        upper_bound = args[1]
-
-        self._gc.add_statement(statement.block())
-
-        element_type = ctyp.terminal("int")
-        begin_value = crep.cpp_variable(unique_name("begin"), self._gc.current_scope(), element_type, initial_value=self.get_rep(lower_bound))  # type: ignore
-        end_value = crep.cpp_variable(unique_name("end"), self._gc.current_scope(), element_type, initial_value=self.get_rep(upper_bound))  # type: ignore
-        self._gc.declare_variable(begin_value)
-        self._gc.declare_variable(end_value)
-
-        vector_value = crep.cpp_collection(unique_name("r_obj"), self._gc.current_scope(), ctyp.collection(element_type))
-        self._gc.declare_variable(crep.cpp_variable(vector_value.as_cpp(), self._gc.current_scope(),
-                                                    ctyp.collection(element_type),
-                                                    crep.cpp_value(f"{end_value.as_cpp()} - {begin_value.as_cpp()}",
-                                                                   self._gc.current_scope(),
-                                                                   ctyp.terminal("int"))))
-
-        vector_value_begin = crep.cpp_value(f"{vector_value.as_cpp()}.begin()",
-                                            self._gc.current_scope(),
-                                            ctyp.terminal(f"std::vector<{element_type}>::iterator"))
-        vector_value_end = crep.cpp_value(f"{vector_value.as_cpp()}.end()",
-                                          self._gc.current_scope(),
-                                          ctyp.terminal(f"std::vector<{element_type}>::iterator"))
-
-        c = ast.Call(func=FunctionAST("std::iota", ["numeric"], "void"),
-                     args=[vector_value_begin.as_ast(),
-                           vector_value_end.as_ast(),
-                           begin_value.as_ast()])
-
-        self._gc.add_statement(statement.arbitrary_statement(self.get_rep(c).as_cpp()))  # type: ignore
-
-        seq = self.make_sequence_from_collection(vector_value)
-        crep.set_rep(node, seq)
-        return seq
+        begin_value = self.get_rep_value(args[0])
+        end_value = self.get_rep_value(args[1])
 
-    def call_First(self, node: ast.AST, args: List[ast.AST]) -> Any:
-        'We are in a sequence. Take the first element of the sequence and use that for future things.'
+        iterator_value = crep.cpp_value(unique_name("i_obj"), None, ctyp.terminal("int"))  # type: ignore
+        self._gc.add_statement(statement.range_loop(iterator_value, begin_value, end_value, unique_name("end")))
+        iterator_value.reset_scope(self._gc.current_scope())
 
-        # Unpack the source here
-        assert len(args) == 1
-        source = args[0]
+        seq = crep.cpp_sequence(iterator_value, iterator_value, self._gc.current_scope())
+        crep.set_rep(node, seq)
+        return seq
 
-        # Make sure we are in a loop.
-        cs = self._gc.current_scope()
-        seq = self.as_sequence(source)
+    def _loop_to_exit(self, seq: crep.cpp_sequence, scope: Union[gc_scope, gc_scope_top_level]) -> Optional[statement.loop]:
+        '''Return the loop over `seq` if a `break` at `scope` may leave it, or None if not. It may not
+        if other code was added to the loop (see `make_sequence_from_collection`), or if the
+        `break` would be inside another loop.
+        '''
+        loop_scope = seq.iterator_value().scope()
+        loop = loop_scope.frame_statements(-1)
+        if not isinstance(loop, statement.loop) or loop.fused or not scope.starts_with(loop_scope):
+            return None
+        inside = [scope.frame_statements(i) for i in range(len(loop_scope), len(scope))]
+        if any(isinstance(f, statement.loop) for f in inside):
+            return None
+        return loop
+
+    def _enter_first_item(self, seq: crep.cpp_sequence):
+        '''Set the point of insertion so that code added from here on is only run for the first
+        item of the sequence.
+
+        - If the loop is only used for this sequence and nothing is skipped over to get to the
+          item, the loop is turned into a test that the collection is not empty, and its first
+          item is used directly.
+        - If the loop is only used for this sequence (but some items are filtered out), the loop
+          is exited after the first item is found.
+        - Otherwise, the code is protected by a `if (is_first)` test, and the loop runs to the end.
+        '''
+        sv = seq.sequence_value()
+        loop_scope = seq.iterator_value().scope()
+        if not isinstance(sv, crep.cpp_sequence):
+            loop = self._loop_to_exit(seq, sv.scope())
+            if loop is not None:
+                loop.exits_early = True
+                self._gc.set_scope(sv.scope())
+                if len(sv.scope()) == len(loop_scope):
+                    loop.first_only = True
+                else:
+                    self._gc.add_statement(statement.first_only())
+                return
 
         # The First terminal works by protecting the code with a if (first_time) {} block.
         # We need to declare the first_time variable outside the block where the thing we are
-        # looping over here is defined. This is a little tricky, so we delegate to another method.
-        loop_scope = seq.iterator_value().scope()
+        # looping over here is defined.
         outside_block_scope = loop_scope[-1]
 
         # Define the variable to track this outside that block.
@@ -1127,15 +1349,66 @@ class query_ast_visitor(FuncADLNodeVisitor, ABC):
         s = statement.iftest(is_first)
         s.add_statement(statement.set_var(is_first, crep.cpp_value('false', top_level_scope(), cpp_type=ctyp.terminal('bool'))))
 
-        sv = seq.sequence_value()
         if isinstance(sv, crep.cpp_sequence):
             self._gc.set_scope(sv.iterator_value().scope()[-1])
         else:
             self._gc.set_scope(sv.scope())
         self._gc.add_statement(s)
 
+    def call_First(self, node: ast.AST, args: List[ast.AST]) -> Any:
+        'We are in a sequence. Take the first element of the sequence and use that for future things.'
+
+        # Unpack the source here
+        assert len(args) == 1
+        source = args[0]
+
+        # Make sure we are in a loop.
+        cs = self._gc.current_scope()
+        seq = self.as_sequence(source)
+        self._enter_first_item(seq)
+
         # If we just found the first sequence in a sequence, return that.
         # Otherwise return a new version of the value.
+        sv = seq.sequence_value()
         first_value = sv if isinstance(sv, crep.cpp_sequence) else sv.copy_with_new_scope(self._gc.current_scope())
 
         crep.set_rep(node, first_value, cs)
+
+    def call_FirstOrDefault(self, node: ast.AST, args: List[ast.AST]) -> Any:
+        '''Take the first element of the sequence, or, if the sequence is empty, the default for its
+        type (`0`, `false`, `nullptr`, etc.). Unlike `First`, code that uses the value is run
+        whether or not the sequence is empty.
+        '''
+        assert len(args) == 1
+        source = args[0]
+
+        seq = self.as_sequence(source)
+        sv = seq.sequence_value()
+        if isinstance(sv, (crep.cpp_sequence, crep.cpp_collection)):
+            raise ValueError('FirstOrDefault can only be used on a sequence of values, not a sequence of sequences.')
+
+        # The value is held in a variable declared outside the loop. It is only complete once the
+        # loop is done.
+        loop_scope = seq.iterator_value().scope()
+        outside_block_scope = loop_scope[-1]
+        loop = loop_scope.frame_statements(-1)
+        if isinstance(loop, statement.loop):
+            loop.has_accumulator = True
+
+        value_type = sv.cpp_type()
+        if value_type.is_a_pointer:
+            # The items of a collection are often `const`
+            value_type = ctyp.terminal(value_type.type, value_type.p_depth, is_const=True)
+        first = crep.cpp_variable(unique_name('first'),
+                                  outside_block_scope,
+                                  cpp_type=value_type,
+                                  initial_value=crep.cpp_value(value_type.default_value(), outside_block_scope, value_type))
+        outside_block_scope.declare_variable(first)
+        if value_type.is_a_pointer:
+            self._null_defaults.add(first.as_cpp())
+
+        self._enter_first_item(seq)
+        self._gc.add_statement(statement.set_var(first, sv))
+        self._gc.set_scope(outside_block_scope)
+
+        crep.set_rep(node, first)
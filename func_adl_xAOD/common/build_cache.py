@@ -0,0 +1,138 @@
+# Track compiled query builds that are kept around in docker volumes so that an identical
+# query does not have to be compiled again.
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+class build_cache:
+    '''An on-disk index of compiled query builds.
+
+    Each build is identified by a hash of the rendered source files and the docker image
+    they were built with. The built release area itself lives in a docker volume - this
+    object only keeps track of which volumes exist and when they were last used, and decides
+    which ones should be removed when there are too many (least recently used go first).
+
+    The size of the cache is capped by the number of builds, not by the disk space they use.
+    Docker does not cheaply report the size of a single volume, and how big a built release
+    area is depends on the release and the query. Choose `max_builds` from the disk you have
+    and the size of a typical build (`docker system df -v` lists the volumes).
+    '''
+    def __init__(self, cache_dir: Optional[Path] = None, max_builds: int = 20):
+        '''Create a build cache.
+
+        Args:
+            cache_dir (Optional[Path]): Directory where the cache index is stored. Defaults to
+                `~/.cache/func_adl_xAOD`. Created if it does not exist.
+            max_builds (int): The maximum number of builds to keep around, whatever their size.
+                Defaults to 20.
+        '''
+        if max_builds < 1:
+            raise ValueError(f'The build cache must be able to hold at least one build (not {max_builds})')
+
+        self._cache_dir = cache_dir if cache_dir is not None \
+            else Path.home() / '.cache' / 'func_adl_xAOD'
+        self._max_builds = max_builds
+        self._lock = threading.Lock()
+        self._build_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    @property
+    def max_builds(self) -> int:
+        'The maximum number of builds that will be kept'
+        return self._max_builds
+
+    @property
+    def _index_file(self) -> Path:
+        return self._cache_dir / 'build_cache.json'
+
+    def build_key(self, build_dir: Path, file_names: Iterable[str], docker_image: str) -> str:
+        '''Return the hash that identifies a build.
+
+        Args:
+            build_dir (Path): Directory the rendered source files were written to
+            file_names (Iterable[str]): Names of the rendered files (the order does not matter)
+            docker_image (str): The docker image and tag the build runs in
+
+        Returns:
+            str: Hex digest identifying this build
+        '''
+        h = hashlib.sha256()
+        h.update(docker_image.encode())
+        for f_name in sorted(file_names):
+            h.update(b'\0' + f_name.encode() + b'\0')
+            h.update((build_dir / f_name).read_bytes())
+        return h.hexdigest()
+
+    def volume_name(self, key: str) -> str:
+        'Return the name of the docker volume that holds the build for `key`'
+        return f'func_adl_build_{key[:32]}'
+
+    def build_lock(self, key: str) -> asyncio.Lock:
+        '''Return the lock to hold from checking if `key` has been built until the build is
+        recorded (`mark_used`) or dropped (`forget`). That way identical queries run at the same
+        time do not build into the same volume at once - the second waits, and then re-uses the
+        first one's build. There is one lock per key for each event loop.
+
+        Args:
+            key (str): The build key
+
+        Returns:
+            asyncio.Lock: The lock for this build
+        '''
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            locks = self._build_locks.setdefault(loop, {})
+            return locks.setdefault(key, asyncio.Lock())
+
+    def is_cached(self, key: str) -> bool:
+        'Return true if a build for `key` has already been made'
+        with self._lock:
+            return key in self._load()
+
+    def mark_used(self, key: str) -> List[str]:
+        '''Record that the build for `key` was made or used. If the cache is now too big,
+        the least recently used builds are dropped from the index.
+
+        Args:
+            key (str): The build key
+
+        Returns:
+            List[str]: Names of the docker volumes for the dropped builds. The caller is
+                responsible for removing them.
+        '''
+        with self._lock:
+            index = self._load()
+            index[key] = time.time()
+            evicted = sorted(index.keys(), key=lambda k: index[k])[:max(0, len(index) - self._max_builds)]
+            for k in evicted:
+                del index[k]
+            self._save(index)
+        return [self.volume_name(k) for k in evicted]
+
+    def forget(self, key: str):
+        'Remove `key` from the index (for example, because the build is no longer good)'
+        with self._lock:
+            index = self._load()
+            if key in index:
+                del index[key]
+                self._save(index)
+
+    def _load(self) -> Dict[str, float]:
+        if not self._index_file.exists():
+            return {}
+        try:
+            return json.loads(self._index_file.read_text())
+        except json.JSONDecodeError:
+            # A corrupt index just means we build again
+            return {}
+
+    def _save(self, index: Dict[str, float]):
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_file = self._index_file.with_suffix('.tmp')
+        temp_file.write_text(json.dumps(index))
+        temp_file.replace(self._index_file)
@@ -2,8 +2,10 @@
 #
 # This is one mechanism to allow for a leaky abstraction.
 import ast
-from dataclasses import dataclass
-from typing import Callable, Dict, List, Optional, cast
+import copy
+import sys
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple, cast
 
 import func_adl_xAOD.common.cpp_types as ctyp
 import func_adl_xAOD.common.statement as statements
@@ -17,6 +19,17 @@ from func_adl_xAOD.common.util_scope import gc_scope
 # None or a cpp_ast.
 method_names = {}
 
+# The nodes `ast.parse` uses for a constant. Before python 3.8 each kind of constant has its own node.
+if sys.version_info >= (3, 8):
+    _constant_nodes: Tuple[type, ...] = (ast.Constant,)
+else:  # pragma: no cover
+    _constant_nodes = (ast.Constant, ast.Str, ast.Num, ast.NameConstant, ast.Bytes)
+
+
+def _is_constant(node: ast.AST) -> bool:
+    'True if `node` is a constant, whatever version of python parsed it'
+    return isinstance(node, _constant_nodes)
+
 
 class CPPCodeValue (ast.AST):
     r'''
@@ -29,6 +42,9 @@ class CPPCodeValue (ast.AST):
     '''
 
     def __init__(self):
+        # Name of the function or method (used in error messages)
+        self.name: Optional[str] = None
+
         # Files that need to be included at the top of the generated C++ file
         self.include_files = []
 
@@ -59,10 +75,27 @@ class CPPCodeValue (ast.AST):
         # A lambda that takes teh scope as an argument and returns a cpp variable to hold things.
         self.result_rep: Optional[Callable[[gc_scope], cpp_variable]] = None
 
+        # If true, `result` is a reference to something that outlives the code block (like a
+        # `const &` into the xAOD aux store). The result variable is then a pointer to it, rather
+        # than a copy of it.
+        self.result_is_reference = False
+
         # Instance declaration and initialization. The instance is initialized in the constructor.
         # The element is a tuple:(cpp_rep:instance_declaration, str: instance_initialization)
         self.fields = []
 
+        # Instance variables that are initialized in the constructor's initializer list (so
+        # their type does not need a default constructor). Each is a tuple: (str: the name used
+        # for it in the code, str: C++ type, str: initialization). The name and any arguments
+        # in the initialization are replaced. Identical fields (same type and initialization)
+        # are declared only once and shared by everything that uses them.
+        self.instance_fields: List[Tuple[str, str, str]] = []
+
+        # If true, the running code depends only on the event (e.g. fetching a collection), so if the
+        # identical code has already been run in a scope we can see, we can reuse its result
+        # rather than running it again.
+        self.shareable = False
+
 
 # Info used to build a code spec
 @dataclass
@@ -95,6 +128,14 @@ class CPPCodeSpecification:
     # The name of the object if this is being used as a method (e.g. the `self` variable)
     instance_object: Optional[str] = None
 
+    # Instance variables initialized once in the constructor: (name in the code, C++ type,
+    # initialization). Any arguments used in the initialization must be constants.
+    instance_fields: List[Tuple[str, str, str]] = field(default_factory=list)
+
+    # True if the result is bound by reference to something that lives longer than the code
+    # (e.g. `const auto &result = acc(*obj);`). It is then held by a const pointer rather than copied.
+    cpp_return_is_reference: bool = False
+
 
 def build_CPPCodeValue(spec: CPPCodeSpecification, call_node: ast.Call) -> ast.Call:
     '''
@@ -126,6 +167,7 @@ def build_CPPCodeValue(spec: CPPCodeSpecification, call_node: ast.Call) -> ast.C
 
     # Create an AST to hold onto all of this.
     r = CPPCodeValue()
+    r.name = spec.name
     # We need TVector2 included here
     r.include_files += spec.include_files
 
@@ -134,11 +176,16 @@ def build_CPPCodeValue(spec: CPPCodeSpecification, call_node: ast.Call) -> ast.C
 
     # The code is three steps
     r.running_code += spec.code
+    r.instance_fields += spec.instance_fields
     r.result = spec.result
+    r.result_is_reference = spec.cpp_return_is_reference
+    p_depth = 1 if spec.cpp_return_is_reference else 0
     if spec.cpp_return_is_collection:
-        r.result_rep = lambda scope: cpp_collection(unique_name(spec.name), scope=scope, collection_type=ctyp.collection(ctyp.terminal(spec.cpp_return_type)))  # type: ignore
+        r.result_rep = lambda scope: cpp_collection(unique_name(spec.name), scope=scope,  # type: ignore
+                                                    collection_type=ctyp.collection(ctyp.terminal(spec.cpp_return_type), p_depth=p_depth, is_const=spec.cpp_return_is_reference))
     else:
-        r.result_rep = lambda scope: cpp_variable(unique_name(spec.name), scope=scope, cpp_type=ctyp.terminal(spec.cpp_return_type))
+        r.result_rep = lambda scope: cpp_variable(unique_name(spec.name), scope=scope,
+                                                  cpp_type=ctyp.terminal(spec.cpp_return_type, p_depth=p_depth, is_const=spec.cpp_return_is_reference))
 
     # If this is a mehtod, copy the info over to generate the obj reference.
     if spec.method_object is not None:
@@ -202,14 +249,23 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     '''
 
     # We write everything into a new scope to prevent conflicts. So we have to declare the result ahead of time.
+    # Code that only depends on the event (like fetching a collection) is run once per event, where
+    # it is first needed (but outside any loop). It is moved up if something that can't see it
+    # needs it later. That way a collection is only read for events that pass the cuts made before
+    # it is used.
     cpp_ast_node = cast(CPPCodeValue, call_node.func)
-    result_rep = cpp_ast_node.result_rep(gc.current_scope())  # type: ignore
-
-    gc.declare_variable(result_rep)
+    hoist = cpp_ast_node.shareable \
+        and all(_is_constant(a) for a in call_node.args) \
+        and gc.can_add_event_statement()
+    decl_scope = gc.current_scope()
+    result_rep = cpp_ast_node.result_rep(decl_scope)  # type: ignore
 
     # Include files and link libraries
     for i in cpp_ast_node.include_files:
         gc.add_include(i)
+        if len(cpp_ast_node.instance_fields) > 0:
+            # The types of the instance fields are needed in the class declaration
+            gc.add_header_include(i)
     for i in cpp_ast_node.link_libraries:
         gc.add_link_library(i)
 
@@ -217,35 +273,79 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     # against, if any.
     repl_list = []
     if cpp_ast_node.replacement_instance_obj is not None:
-        repl_list += [(cpp_ast_node.replacement_instance_obj[0], visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep.as_cpp())]
+        instance = visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep
+        visitor.check_not_null_default(instance, cpp_ast_node.name)
+        repl_list += [(cpp_ast_node.replacement_instance_obj[0], instance.as_cpp())]
 
     # Process the arguments that are getting passed to the function
     for arg, dest in zip(cpp_ast_node.args, call_node.args):
         rep = visitor.get_rep(dest)
         repl_list += [(arg, rep.as_cpp())]
 
-    # Emit the statements.
+    def replace(line: str) -> str:
+        for src, dest in repl_list:
+            line = line.replace(src, str(dest))
+        return line
+
+    # Instance variables that are set up in the constructor. The constructor can only see
+    # constants.
+    for f_name, f_type, f_init in cpp_ast_node.instance_fields:
+        for arg, dest in zip(cpp_ast_node.args, call_node.args):
+            if arg in f_init and not _is_constant(dest):
+                raise ValueError(f'The argument {arg} must be a constant (it is used to initialize {f_name}), not "{ast.dump(dest)}".')
+        f_var = gc.declare_instance_field(f_name, ctyp.terminal(f_type), replace(f_init))
+        repl_list.append((f_name, f_var.as_cpp()))
+
+    running_code = [replace(s) for s in cpp_ast_node.running_code]
+
+    # If this exact code has already been run where we can see it, reuse the result. A copy
+    # is returned so that anything cached against the original (like a loop over it) is not
+    # picked up by accident. With common subexpression elimination on, any code can be reused -
+    # the result then belongs to where it is used (e.g. inside a `Where`), as it would have
+    # been had the code been run again.
+    share_key = ('shared_cpp_code', tuple(running_code), cpp_ast_node.result)
+    if hoist:
+        shared = gc.get_rep(share_key)
+        if shared is not None:
+            shared_rep, shared_blk = shared
+            return shared_rep.copy_with_new_scope(gc.use_event_statement(shared_blk))
+    shareable = cpp_ast_node.shareable or visitor.code_options.common_subexpression_elimination
+    if shareable and not hoist:
+        shared_rep = gc.get_rep(share_key)
+        if shared_rep is not None:
+            return copy.copy(shared_rep) if cpp_ast_node.shareable else shared_rep.copy_with_new_scope(gc.current_scope())
+
+    # Emit the statements. The result of something run once per event is declared at the top, so
+    # it can still be seen if the code is moved. Its scope is where the code is, so anything
+    # that can't see that comes back here.
     blk = statements.block()
-    visitor._gc.add_statement(blk)
+    return_scope = gc.current_scope()
+    if hoist:
+        result_rep = result_rep.copy_with_new_scope(gc.add_event_statement(blk))
+        gc.event_scope().declare_variable(result_rep)
+    else:
+        decl_scope.declare_variable(result_rep)
+        gc.add_statement(blk)
 
-    for s in cpp_ast_node.running_code:
-        l_s = s
-        for src, dest in repl_list:
-            l_s = l_s.replace(src, str(dest))
-        blk.add_statement(statements.arbitrary_statement(l_s))
+    for s in running_code:
+        blk.add_statement(statements.arbitrary_statement(s))
 
     # Emit the instance declaration and intialization code.
     for i in cpp_ast_node.fields:
-        l_s = i[1]
         gc.declare_class_variable(i[0])
-        for src, dest in repl_list:
-            l_s = l_s.replace(src, str(dest))
-        token_set_var = statements.set_var(i[0], cpp_value(l_s, None, None))
+        token_set_var = statements.set_var(i[0], cpp_value(replace(i[1]), None, None))
         gc.add_book_statement(token_set_var)
 
-    # Set the result and close the scope
+    # Set the result and close the scope. A result that is a reference is not copied - we keep
+    # a pointer to it.
     assert cpp_ast_node.result is not None
-    blk.add_statement(statements.set_var(result_rep, cpp_value(cpp_ast_node.result, gc.current_scope(), result_rep.cpp_type())))
-    gc.pop_scope()
+    result = f'&{cpp_ast_node.result}' if cpp_ast_node.result_is_reference else cpp_ast_node.result
+    blk.add_statement(statements.set_var(result_rep, cpp_value(result, gc.current_scope(), result_rep.cpp_type())))
+    gc.set_scope(return_scope)
+
+    if hoist:
+        gc.event_scope().frame_statements(-1).set_rep(share_key, (result_rep, blk))
+    elif shareable:
+        decl_scope.frame_statements(-1).set_rep(share_key, result_rep)
 
     return result_rep
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Dict, Optional, Union
+from typing import Dict, Iterator, Optional, Union
 
 
 @dataclass
@@ -50,6 +52,12 @@ def parse_type(t_name: str) -> CPPParsedTypeInfo:
     return CPPParsedTypeInfo(t_name, ptr_depth, is_const)
 
 
+# The built in number types
+_number_types = {'char', 'short', 'int', 'long', 'long long', 'float', 'double',
+                 'unsigned char', 'unsigned short', 'unsigned int', 'unsigned long', 'unsigned long long',
+                 'int8_t', 'int16_t', 'int32_t', 'int64_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t'}
+
+
 class terminal:
     'Represents something we cannot see inside, like float, or int, or bool'
 
@@ -96,8 +104,20 @@ class terminal:
         'Returns true if this terminal is a const type'
         return self._is_const
 
-    def default_value(self):
-        raise NotImplementedError()
+    @property
+    def is_number(self) -> bool:
+        'Returns true if this is a number (like `int` or `float`), and not a pointer to one'
+        return not self.is_a_pointer and self.type in _number_types
+
+    def default_value(self) -> str:
+        'The C++ value of this type when nothing has been set (`0`, `nullptr`, etc.)'
+        if self.is_a_pointer:
+            return 'nullptr'
+        if self.type == 'bool':
+            return 'false'
+        if self.type in _number_types:
+            return '0'
+        return f'{self.type}{{}}'
 
     @property
     def type(self) -> str:
@@ -117,7 +137,8 @@ class terminal:
 class collection (terminal):
     'Represents a collection/list/vector of the same type'
 
-    def __init__(self, element_type: terminal, array_type: Optional[Union[str, CPPParsedTypeInfo]] = None, p_depth: int = 0):
+    def __init__(self, element_type: terminal, array_type: Optional[Union[str, CPPParsedTypeInfo]] = None, p_depth: int = 0,
+                 is_const: bool = False):
         '''Create a collection type, like `vector<float>`.
 
         Args:
@@ -125,13 +146,15 @@ class collection (terminal):
             array_type (Optional[Union[str, CPPParsedTypeInfo]], optional): The type of the array. Defaults to None. Everything
                     is lifted from `array_type` if it is a `CPPParsedTypeInfo`.
             p_depth (int, optional): If the array type is a pointer or not. Defaults to 0. Ignored if `array_type` is `CPPParsedTypeInfo`.
+            is_const (bool, optional): If the array is const (e.g. `const std::vector<float>*`). Defaults to False. Ignored
+                    if `array_type` is `CPPParsedTypeInfo`.
         '''
         if array_type is None:
-            super().__init__(f"std::vector<{element_type}>", p_depth=p_depth)
+            super().__init__(f"std::vector<{element_type}>", p_depth=p_depth, is_const=is_const)
         elif isinstance(array_type, CPPParsedTypeInfo):
             super().__init__(array_type)
         else:
-            super().__init__(array_type, p_depth=p_depth)
+            super().__init__(array_type, p_depth=p_depth, is_const=is_const)
 
         # And the element type we are representing
         self._element_type = element_type
@@ -165,7 +188,30 @@ class MethodInvokeInfo:
     deref_depth: int
 
 
+# Method type information known to every translation. When a translation context is active
+# (see `translation_context`), new information is added to that context, and it is searched
+# before this global dictionary.
 g_method_type_dict: Dict[str, Dict[str, MethodInvokeInfo]] = {}
+_active_method_type_dict: ContextVar[Optional[Dict[str, Dict[str, MethodInvokeInfo]]]] = \
+    ContextVar('method_type_dict', default=None)
+
+
+def _method_type_dict() -> Dict[str, Dict[str, MethodInvokeInfo]]:
+    d = _active_method_type_dict.get()
+    return g_method_type_dict if d is None else d
+
+
+@contextmanager
+def method_type_scope(type_dict: Dict[str, Dict[str, MethodInvokeInfo]]) -> Iterator[None]:
+    '''
+    All method type information added or looked up inside this scope uses `type_dict`
+    rather than the global dictionary. Scopes are tracked per thread and per asyncio task.
+    '''
+    token = _active_method_type_dict.set(type_dict)
+    try:
+        yield
+    finally:
+        _active_method_type_dict.reset(token)
 
 
 def add_method_type_info(type_string: str, method_name: str, t: terminal, deref_depth: int = 0):
@@ -176,17 +222,17 @@ def add_method_type_info(type_string: str, method_name: str, t: terminal, deref_
     method_name         Name of the object
     t                   The type (terminal, collection, etc.) of return type
     '''
-    if type_string not in g_method_type_dict:
-        g_method_type_dict[type_string] = {}
-    g_method_type_dict[type_string][method_name] = MethodInvokeInfo(t, deref_depth)
+    type_dict = _method_type_dict()
+    if type_string not in type_dict:
+        type_dict[type_string] = {}
+    type_dict[type_string][method_name] = MethodInvokeInfo(t, deref_depth)
 
 
 def method_type_info(type_string: str, method_name: str) -> Optional[MethodInvokeInfo]:
     '''
     Return the type of the method's return value
     '''
-    if type_string not in g_method_type_dict:
-        return None
-    if method_name not in g_method_type_dict[type_string]:
-        return None
-    return g_method_type_dict[type_string][method_name]
+    for type_dict in (_method_type_dict(), g_method_type_dict):
+        if method_name in type_dict.get(type_string, {}):
+            return type_dict[type_string][method_name]
+    return None
@@ -1,8 +1,46 @@
 # Utility routines to help with variables
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
 
-# A global counter to help with unique variable numbering.
 
-unique_var_index = 0
+class name_counter:
+    r'''Hands out the index used to make variable names unique.
+
+    Each translation of a query should use its own counter (see `unique_name_scope`), so that
+    the names depend only on the query being translated, and not on what was translated
+    before it in the same process.
+    '''
+    def __init__(self):
+        self._index = 0
+
+    def unique_name(self, name: str, is_class_var: bool = False) -> str:
+        'Return a new name - see the module level `unique_name` for details'
+        v_name = ("_" if is_class_var else "") + name + str(self._index)
+        self._index += 1
+        return v_name
+
+
+# Used when no translation is in progress (e.g. at module import time).
+_global_counter = name_counter()
+_active_counter: ContextVar[name_counter] = ContextVar('unique_name_counter', default=_global_counter)
+
+
+@contextmanager
+def unique_name_scope(counter: Optional[name_counter] = None) -> Iterator[name_counter]:
+    r'''All names handed out by `unique_name` inside this scope are numbered by `counter`
+    (a fresh one if none is given). Scopes are tracked per thread and per asyncio task.
+
+    Args:
+        counter (Optional[name_counter]): The counter to use. If `None`, a new one starting
+            at zero.
+    '''
+    c = counter if counter is not None else name_counter()
+    token = _active_counter.set(c)
+    try:
+        yield c
+    finally:
+        _active_counter.reset(token)
 
 
 def unique_name(name, is_class_var=False):
@@ -15,8 +53,4 @@ def unique_name(name, is_class_var=False):
 
     String of a new variable number.
     '''
-
-    global unique_var_index
-    v_name = ("_" if is_class_var else "") + name + str(unique_var_index)
-    unique_var_index += 1
-    return v_name
+    return _active_counter.get().unique_name(name, is_class_var)
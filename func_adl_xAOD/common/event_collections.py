@@ -80,6 +80,9 @@ class event_collection_coder(ABC):
         self.get_running_code_CPPCodeValue(r, md)
         r.result = 'result'
 
+        # Fetching a collection from the event gives the same answer everywhere in the event.
+        r.shareable = True
+
         if issubclass(type(md.container_type), event_collection_collection_container):
             r.result_rep = lambda scope: crep.cpp_collection(unique_name(md.name.lower()), scope=scope, collection_type=md.container_type)  # type: ignore
         else:
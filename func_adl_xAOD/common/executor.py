@@ -1,9 +1,11 @@
 # Drive the translate of the AST from start into a set of files, which one can then do whatever
 # is needed to.
 import ast
+import copy
+import functools
 from func_adl_xAOD.common.event_collections import EventCollectionSpecification
-from typing import Any, Callable, Dict, List
-from func_adl_xAOD.common.meta_data import InjectCodeBlock, JobScriptSpecification, process_metadata
+from typing import Any, Callable, Dict, List, Type
+from func_adl_xAOD.common.meta_data import CodeGenerationOptions, InjectCodeBlock, JobScriptSpecification, OutputColumnTypes, process_metadata
 import os
 import sys
 from abc import ABC, abstractmethod
@@ -14,15 +16,18 @@ import itertools
 import func_adl_xAOD.common.cpp_ast as cpp_ast
 import func_adl_xAOD.common.cpp_representation as crep
 import jinja2
-from func_adl.ast.aggregate_shortcuts import aggregate_node_transformer
-from func_adl.ast.func_adl_ast_utils import change_extension_functions_to_calls
+from func_adl.ast.func_adl_ast_utils import change_extension_functions_to_calls, default_list_of_functions
 from func_adl.ast.function_simplifier import simplify_chained_calls
 from func_adl.ast import extract_metadata
 from func_adl_xAOD.common.ast_to_cpp_translator import query_ast_visitor
 from func_adl_xAOD.common.cpp_functions import find_known_functions
+from func_adl_xAOD.common.filter_pushdown import push_down_filters
+from func_adl_xAOD.common.timing import query_timings
+from func_adl_xAOD.common.translation_context import translation_context
 from func_adl_xAOD.common.util_scope import top_level_scope
 
-ExecutionInfo = namedtuple('ExecutionInfo', 'result_rep output_path main_script all_filenames')
+# `timings` holds how long each phase of the translation took (a `query_timings`)
+ExecutionInfo = namedtuple('ExecutionInfo', 'result_rep output_path main_script all_filenames timings', defaults=(None,))
 
 
 class _cpp_source_emitter:
@@ -60,10 +65,25 @@ def _find(pathname: str, matchFunc=os.path.isfile):
     raise RuntimeError(f"Can't find file '{pathname}'. Looked in {all_dirs}")
 
 
+@functools.lru_cache(maxsize=None)
 def _find_dir(path):
     return _find(path, matchFunc=os.path.isdir)  # type: ignore
 
 
+@functools.lru_cache(maxsize=None)
+def _template_environment(template_dir: str) -> jinja2.Environment:
+    '''Return the jinja2 environment for a template directory. The environment is kept
+    around so that each template is only compiled once per process.
+
+    Args:
+        template_dir (str): Directory the templates are loaded from
+
+    Returns:
+        jinja2.Environment: The environment to use to load the templates
+    '''
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
+
+
 def _is_format_request(a: ast.AST) -> bool:
     '''Return true if the top level ast is a call to generate a ROOT file output.
 
@@ -80,15 +100,38 @@ def _is_format_request(a: ast.AST) -> bool:
     return a.func.id == 'ResultTTree'
 
 
+def _copy_ast(a: ast.AST) -> ast.AST:
+    '''Return a deep copy of a query `ast`, so that it can be transformed and annotated during
+    translation without altering the caller's copy (which might be being translated
+    at the same time). Python objects hung off the `ast` nodes (like the dataset
+    object or a `rep`) are shared, not copied.
+
+    Args:
+        a (ast.AST): The query to copy
+
+    Returns:
+        ast.AST: The copy
+    '''
+    shared = {}
+    for node in ast.walk(a):
+        for k, v in vars(node).items():
+            if k not in node._fields and k not in node._attributes:
+                shared[id(v)] = v
+    return copy.deepcopy(a, shared)
+
+
 class executor(ABC):
+    # The translation context with the default types, one per executor class. New queries
+    # start with a copy of these.
+    _default_contexts: Dict[Type['executor'], translation_context] = {}
+
     def __init__(self, file_names: list, runner_name: str, template_dir_name: str,
                  method_names: Dict[str, Callable[[ast.Call], ast.Call]]):
         self._file_names = file_names
         self._runner_name = runner_name
         self._template_dir_name = template_dir_name
         self._method_names = method_names
-        self._job_option_blocks = []
-        self._inject_blocks: List[InjectCodeBlock] = []
+        self.reset()
 
     def _copy_template_file(self, j2_env, info, template_file, final_dir: Path):
         'Copy a file to a final directory'
@@ -97,50 +140,95 @@ class executor(ABC):
     def reset(self):
         '''Called before any work is done on a new ast. Resets object to ground zero.
 
-        If anyone who inherits has global state, it should be reset here too.
-
-        TODO: The fact this is here is because we are dealing with global variables, either
-        the instance variables here or actual global state. We really should not have this.
-        Some subtle bugs have already occurred because of this. Especially in running locally
-        vs running up in ServiceX.
+        All the per-query state lives in the job option and inject blocks, the code generation
+        options and output column types, along with a new translation context (which holds type information and variable
+        naming state), and the phase timings.
         '''
-        # Reset out object
         self._job_option_blocks = []
-        self._inject_blocks = []
+        self._inject_blocks: List[InjectCodeBlock] = []
+        self._code_options = CodeGenerationOptions()
+        self._column_types = OutputColumnTypes()
+        self._context = self._default_context().copy()
+        self._timings = query_timings()
+
+    def _default_context(self) -> translation_context:
+        'Return the translation context with the default types for this executor class'
+        context = executor._default_contexts.get(type(self))
+        if context is None:
+            context = translation_context()
+            with context.activate():
+                self.define_default_types()
+            context = executor._default_contexts.setdefault(type(self), context)
+        return context
+
+    def define_default_types(self):
+        '''Subclasses can override this to add the backend's method type information
+        (e.g. the return type of a jet's `pt` method). Called with the new translation context
+        active, once per executor class - the results are copied into the context of every query.
+        '''
 
-        # Reset the type system
-        import func_adl_xAOD.common.cpp_types as ctyp
-        ctyp.g_method_type_dict = {}
+    @property
+    def translation_context(self) -> translation_context:
+        'The translation context for the query currently being processed'
+        return self._context
+
+    @property
+    def code_options(self) -> CodeGenerationOptions:
+        'The code generation options asked for (via metadata) by the queries processed so far'
+        return self._code_options
+
+    @property
+    def column_types(self) -> OutputColumnTypes:
+        'The types (asked for via metadata by the queries processed so far) to write columns as'
+        return self._column_types
+
+    @property
+    def timings(self) -> query_timings:
+        'How long each phase of the translation of the current query has taken so far'
+        return self._timings
 
     def apply_ast_transformations(self, a: ast.AST):
         r'''
         Run through all the transformations that we have on tap to be run on the client side.
         Return a (possibly) modified ast.
         '''
-        # Do tuple resolutions. This might eliminate a whole bunch fo code!
-        a, meta_data = extract_metadata(a)
-        cpp_functions = process_metadata(meta_data)
-        a = change_extension_functions_to_calls(a)
-        a = aggregate_node_transformer().visit(a)
-        a = simplify_chained_calls().visit(a)
-        a = find_known_functions().visit(a)
-
-        # Any C++ custom code needs to be threaded into the ast
-        method_names = dict(self._method_names)
-        method_names.update({
-            md.name:
-                (lambda call_node, md=md: cpp_ast.build_CPPCodeValue(md, call_node)) if isinstance(md, cpp_ast.CPPCodeSpecification)  # type: ignore
-                else self.build_collection_callback(md)
-            for md in cpp_functions if isinstance(md, (cpp_ast.CPPCodeSpecification, EventCollectionSpecification))
-        })
-        a = cpp_ast.cpp_ast_finder(method_names).visit(a)
-
-        # Save the injection blocks
-        self._inject_blocks = [md for md in cpp_functions if isinstance(md, InjectCodeBlock)]
-
-        # Pull off any joboption blocks
+        timings = self._timings
+        with self._context.activate():
+            # Do tuple resolutions. This might eliminate a whole bunch fo code!
+            with timings.phase('extract_metadata'):
+                a, meta_data = extract_metadata(_copy_ast(a))
+                cpp_functions = process_metadata(meta_data, self._context)
+            with timings.phase('change_extension_functions_to_calls'):
+                a = change_extension_functions_to_calls(a, default_list_of_functions + ['FirstOrDefault', 'Any', 'All'])
+            with timings.phase('simplify_chained_calls'):
+                a = simplify_chained_calls().visit(a)
+            with timings.phase('push_down_filters'):
+                a = push_down_filters().visit(a)
+            with timings.phase('find_known_functions'):
+                a = find_known_functions().visit(a)
+
+            # Any C++ custom code needs to be threaded into the ast
+            method_names = dict(self._method_names)
+            method_names.update({
+                md.name:
+                    (lambda call_node, md=md: cpp_ast.build_CPPCodeValue(md, call_node)) if isinstance(md, cpp_ast.CPPCodeSpecification)  # type: ignore
+                    else self.build_collection_callback(md)
+                for md in cpp_functions if isinstance(md, (cpp_ast.CPPCodeSpecification, EventCollectionSpecification))
+            })
+            with timings.phase('cpp_ast_finder'):
+                a = cpp_ast.cpp_ast_finder(method_names).visit(a)
+
+        # Save the injection and joboption blocks. Several queries might be translated
+        # together (see `write_cpp_files_multi`), and they might ask for the same blocks. They
+        # also share the generated code, so an option any of them turns on is on for all.
         for m in cpp_functions:
-            if isinstance(m, JobScriptSpecification):
+            if isinstance(m, CodeGenerationOptions):
+                self._code_options = self._code_options.merge(m)
+            if isinstance(m, OutputColumnTypes):
+                self._column_types = self._column_types.merge(m)
+            if isinstance(m, InjectCodeBlock) and m not in self._inject_blocks:
+                self._inject_blocks.append(m)
+            if isinstance(m, JobScriptSpecification) and m not in self._job_option_blocks:
                 self._job_option_blocks.append(m)
 
         # And return the modified ast
@@ -215,25 +303,60 @@ class executor(ABC):
         Given the AST generate the C++ files that need to run. Return them along with
         the input files.
         """
+        return self.write_cpp_files_multi([ast], output_path)[0]
+
+    def write_cpp_files_multi(self, asts: List[ast.AST], output_path: Path) -> List[ExecutionInfo]:
+        r"""
+        Generate the C++ files for several queries that run in a single pass over the same
+        input files. Each query writes its own tree into the output file, and collections
+        that more than one query reads from the event are only fetched once.
+
+        Each query must have been through `apply_ast_transformations` on this executor.
 
-        # Find the base file dataset and mark it.
-        from func_adl import find_EventDataset
-        file = find_EventDataset(ast)
-        iterator = crep.cpp_variable("bogus-do-not-use", top_level_scope(), cpp_type=None)
-        crep.set_rep(file, crep.cpp_sequence(iterator, iterator, top_level_scope()))
-
-        # Visit the AST to generate the code structure and find out what the
-        # result is going to be.
-        qv = self.get_visitor_obj()
-        result_rep = qv.get_rep(ast) if _is_format_request(ast) \
-            else qv.get_as_ROOT(ast)
-
-        # Emit the C++ code into our dictionaries to be used in template generation below.
-        query_code = _cpp_source_emitter()
-        qv.emit_query(query_code)
-        book_code = _cpp_source_emitter()
-        qv.emit_book(book_code)
-        class_decl_code = qv.class_declaration_code()
+        Args:
+            asts (List[ast.AST]): The queries to translate. They should all run against the same
+                files.
+            output_path (Path): Directory to write the files into
+
+        Returns:
+            List[ExecutionInfo]: One per query, in the same order. Everything but the `result_rep`
+                is common to all of them.
+
+        Exceptions:
+            ValueError: If no queries are given, or two queries write to the same tree.
+        """
+        if len(asts) == 0:
+            raise ValueError('At least one query must be given to generate C++ files')
+
+        # All type lookups and variable names come from this query's translation context. We
+        # work on a copy of the ast as the translation annotates it.
+        asts = [_copy_ast(a) for a in asts]
+        timings = self._timings
+        with self._context.activate():
+            # Visit each AST to generate the code structure and find out what the
+            # result is going to be. They all share the same event loop.
+            qv = self.get_visitor_obj()
+            qv.code_options = self.code_options
+            qv.column_types = self.column_types
+            result_reps = []
+            for a in asts:
+                # Find the base file dataset and mark it.
+                from func_adl import find_EventDataset
+                file = find_EventDataset(a)
+                iterator = crep.cpp_variable("bogus-do-not-use", top_level_scope(), cpp_type=None)
+                crep.set_rep(file, crep.cpp_sequence(iterator, iterator, top_level_scope()))
+
+                with timings.phase('query_ast_visitor'):
+                    qv.start_query()
+                    result_reps.append(qv.get_rep(a) if _is_format_request(a) else qv.get_as_ROOT(a))
+
+            # Emit the C++ code into our dictionaries to be used in template generation below.
+            with timings.phase('emit'):
+                query_code = _cpp_source_emitter()
+                qv.emit_query(query_code)
+                book_code = _cpp_source_emitter()
+                qv.emit_book(book_code)
+                class_decl_code = qv.class_declaration_code()
         includes = qv.include_files() + self.body_include_files
         link_libraries = qv.link_libraries() + self.link_libraries
 
@@ -243,26 +366,25 @@ class executor(ABC):
         info['class_decl'] = class_decl_code
         info['book_code'] = book_code.lines_of_query_code()
         info['body_include_files'] = includes
-        info['header_include_files'] = self.header_include_files
+        info['header_include_files'] = qv.header_include_files() + self.header_include_files
         info['private_members'] = self.private_members
-        info['instance_initialization'] = self.instance_initialization
+        info['instance_initialization'] = qv.instance_initialization() + self.instance_initialization
         info['initialize_lines'] = self.initialize_lines
         info['ctor_lines'] = self.ctor_lines
         info['link_libraries'] = link_libraries
         info.update(self.add_to_replacement_dict())
 
         # We use jinja2 templates. Write out everything.
-        template_dir = _find_dir(self._template_dir_name)
-        j2_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_dir))
+        with timings.phase('render_templates'):
+            j2_env = _template_environment(_find_dir(self._template_dir_name))
 
-        for file_name in self._file_names:
-            self._copy_template_file(j2_env, info, file_name, output_path)
+            for file_name in self._file_names:
+                self._copy_template_file(j2_env, info, file_name, output_path)
 
         (output_path / self._runner_name).chmod(0o755)
 
-        # Reset our object for the next call (e.g. reset global state)
+        # Reset our object for the next call
         self.reset()
 
-        # Build the return object.
-        return ExecutionInfo(result_rep, output_path, self._runner_name, self._file_names)
+        # Build the return objects.
+        return [ExecutionInfo(r, output_path, self._runner_name, self._file_names, timings) for r in result_reps]
@@ -0,0 +1,123 @@
+# Move filters (`Where`) as early in a query as they can go, and order the tests in them so the
+# cheap ones are done first.
+import ast
+import copy
+from typing import List, Optional, Set
+
+from func_adl.ast.func_adl_ast_utils import is_call_of
+
+# Calls that run over a sequence. Anything that uses one of these loops over a collection.
+_sequence_calls = {'Select', 'SelectMany', 'Where', 'Aggregate', 'Count', 'len', 'Sum', 'Min', 'Max',
+                   'Any', 'All', 'First', 'FirstOrDefault', 'Range'}
+
+# Calls that return an empty sequence if their source is empty
+_empty_preserving_calls = {'Select', 'SelectMany', 'Where'}
+
+
+def _names(node: ast.AST) -> Set[str]:
+    'Return the name of every variable referenced in `node`'
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def filter_cost(node: ast.AST) -> int:
+    '''A rough guess at how expensive a test is to evaluate:
+
+    - 0: Member calls, constants, and arithmetic
+    - 1: Calls to functions (like `DeltaR` or `abs`), which may run arbitrary C++
+    - 2: Anything that runs over a sequence (like `Count`, or indexing a collection)
+
+    Args:
+        node (ast.AST): The test
+
+    Returns:
+        int: The cost
+    '''
+    cost = 0
+    for n in ast.walk(node):
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Name):
+            cost = max(cost, 2 if n.func.id in _sequence_calls else 1)
+        elif isinstance(n, ast.Subscript) and isinstance(n.value, ast.Call):
+            cost = 2
+    return cost
+
+
+def _conjuncts(node: ast.AST) -> List[ast.AST]:
+    'Split `a and (b and c)` into `[a, b, c]`'
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [c for v in node.values for c in _conjuncts(v)]
+    return [node]
+
+
+def _and(values: List[ast.AST]) -> ast.AST:
+    'Join tests back together with `and`, cheapest first. Tests of the same cost keep their order.'
+    values = sorted(values, key=filter_cost)
+    return values[0] if len(values) == 1 else ast.BoolOp(op=ast.And(), values=values)
+
+
+def _where(source: ast.AST, arg: ast.arguments, tests: List[ast.AST]) -> ast.Call:
+    return ast.Call(func=ast.Name(id='Where', ctx=ast.Load()),
+                    args=[source, ast.Lambda(args=copy.deepcopy(arg), body=_and(tests))],
+                    keywords=[])
+
+
+class push_down_filters(ast.NodeTransformer):
+    r'''Make filters run as early, and as cheaply, as they can:
+
+    - In `seq.SelectMany(e: f(e).Where(x: g(e) and h(x)))`, the test `g(e)` does not depend on
+      `x`. If it is false the result for `e` is empty, so it is moved out to
+      `seq.Where(e: g(e)).SelectMany(e: f(e).Where(x: h(x)))`. This way, for example, an event
+      level cut is made once per event rather than once per jet. `f` may be any chain of
+      `Select`, `SelectMany`, and `Where` calls.
+    - The tests in a filter that are and-ed together are ordered by `filter_cost`, so the cheap
+      ones run first (the C++ stops at the first one that fails). The tests are assumed to have
+      no side effects, and tests of the same cost are left in the order they were written.
+
+    This should be run after `simplify_chained_calls`, which moves filters ahead of `Select`
+    calls and joins chained filters.
+    '''
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        if is_call_of(node, 'Where') and len(node.args) == 2 and isinstance(node.args[1], ast.Lambda):
+            node.args[1].body = _and(_conjuncts(node.args[1].body))
+        elif is_call_of(node, 'SelectMany') and len(node.args) == 2 and isinstance(node.args[1], ast.Lambda):
+            return self._lift_filters(node)
+        return node
+
+    def _lift_filters(self, node: ast.Call) -> ast.AST:
+        'Move the tests in the filters of a `SelectMany` that do not depend on its items out of it'
+        selection = node.args[1]
+        assert isinstance(selection, ast.Lambda)
+
+        lifted: List[ast.AST] = []
+        parent: Optional[ast.Call] = None
+        call = selection.body
+        while isinstance(call, ast.Call) and isinstance(call.func, ast.Name) \
+                and call.func.id in _empty_preserving_calls and len(call.args) == 2:
+            source = call.args[0]
+            if is_call_of(call, 'Where') and isinstance(call.args[1], ast.Lambda) and len(call.args[1].args.args) == 1:
+                item = call.args[1].args.args[0].arg
+                tests = _conjuncts(call.args[1].body)
+                keep = [t for t in tests if item in _names(t)]
+                lifted += [t for t in tests if item not in _names(t)]
+                if len(keep) == 0:
+                    # The whole filter has moved - drop it.
+                    if parent is None:
+                        selection.body = source
+                    else:
+                        parent.args[0] = source
+                    call = source
+                    continue
+                call.args[1].body = _and(keep)
+            parent = call
+            call = source
+
+        if len(lifted) == 0:
+            return node
+        source = node.args[0]
+        if is_call_of(source, 'Where') and isinstance(source.args[1], ast.Lambda) \
+                and [a.arg for a in source.args[1].args.args] == [a.arg for a in selection.args.args]:
+            # Join with a filter that is already there
+            source.args[1].body = _and(_conjuncts(source.args[1].body) + lifted)
+        else:
+            node.args[0] = _where(source, selection.args, lifted)
+        return node
@@ -1,23 +1,77 @@
 # Hold onto the generated code
-from typing import List, Union
+import re
+from typing import Dict, List, Optional, Tuple, Union
 
-from func_adl_xAOD.common.statement import block
+import func_adl_xAOD.common.cpp_types as ctyp
+from func_adl_xAOD.common.cpp_representation import cpp_value, cpp_variable
+from func_adl_xAOD.common.cpp_vars import unique_name
+
+from func_adl_xAOD.common.statement import block, declare_value, iftest, loop
 from func_adl_xAOD.common.util_scope import gc_scope, gc_scope_top_level
 
 
+def _index_of(parent: block, st) -> int:
+    'Return where `st` is in the statements of `parent`'
+    return next(i for i, s in enumerate(parent._statements) if s is st)
+
+
+def _can_move_out_of(frames: Tuple[block, ...]) -> bool:
+    '''Return true if a value that does not depend on any of `frames` can be moved out of all of
+    them. Loops are fine. An `if` is only fine if it tests the variable of an enclosing loop that
+    is also in `frames`.
+    '''
+    loop_vars: List[str] = []
+    for f in frames:
+        if isinstance(f, loop):
+            loop_vars.append(f.loop_variable().as_cpp())
+        elif isinstance(f, iftest):
+            if len(loop_vars) == 0 or not re.search(r'\b(' + '|'.join(re.escape(v) for v in loop_vars) + r')\b', f._expr.as_cpp()):
+                return False
+        elif type(f) is not block:
+            return False
+    return True
+
+
 class generated_code:
     def __init__(self):
         self._block = block()
         self._book_block = block()
         self._class_vars = []
+        self._instance_fields: Dict[Tuple[str, str], cpp_variable] = {}
         self._scope_stack = (self._block,)
         self._include_files = []
+        self._header_include_files: List[str] = []
         self._link_libraries = []
+        self._event_statements: Dict[int, Tuple[block, Tuple[block, ...]]] = {}
 
     def declare_class_variable(self, var):
         'Declare a variable as an instance of the query class. var must be a cpp_rep'
         self._class_vars += [var]
 
+    def declare_instance_field(self, name: str, cpp_type: ctyp.terminal, initialization: str) -> cpp_variable:
+        '''Declare a variable as an instance of the query class that is initialized in the
+        constructor. If an identical one (same type and initialization) has already been
+        declared, that one is returned instead.
+
+        Args:
+            name (str): Base name for the variable (it is made unique)
+            cpp_type (ctyp.terminal): The type of the variable
+            initialization (str): The C++ constructor arguments
+
+        Returns:
+            cpp_variable: The class variable
+        '''
+        key = (str(cpp_type), initialization)
+        if key not in self._instance_fields:
+            v = cpp_variable(unique_name(name, is_class_var=True), gc_scope_top_level(), cpp_type)
+            self.declare_class_variable(v)
+            self._instance_fields[key] = v
+        return self._instance_fields[key]
+
+    def instance_initialization(self) -> List[str]:
+        'Return the constructor initializer list entries for the instance fields'
+        return [f'{v.as_cpp()}({init})' for (_, init), v in self._instance_fields.items()]
+
     def declare_variable(self, v):
         'Declare a variable at the current scope'
         self._scope_stack[-1].declare_variable(v)
@@ -31,6 +85,78 @@ class generated_code:
         'Set a representation for later recall'
         self._scope_stack[-1].set_rep(name, value)
 
+    def common_value(self, value: cpp_value) -> cpp_variable:
+        '''Return a variable that holds `value`. The first time a value is asked for, the variable
+        is declared and set at the current point in the code. After that, anything that can see the
+        variable gets it back rather than evaluating the value again.
+
+        Args:
+            value (cpp_value): The value. Evaluating it must not have side effects.
+
+        Returns:
+            cpp_variable: The variable that holds the value. Its scope is the deeper of where it
+                was declared and the scope of `value`.
+        '''
+        key = ('common_value', value.as_cpp())
+        v = self.get_rep(key)
+        if v is None:
+            v = cpp_variable(unique_name('cse'), self.current_scope(), value.cpp_type())
+            self.add_statement(declare_value(v, value))
+            self.set_rep(key, v)
+        elif value.scope().starts_with(v.scope()):
+            # Used somewhere deeper (e.g. after a `Where`) - code that depends on it belongs there.
+            v = v.copy_with_new_scope(value.scope())
+        return v
+
+    def invariant_value(self, value: cpp_value) -> Optional[cpp_variable]:
+        '''If `value` does not change in some of the loops we are in, declare a variable set to it
+        just ahead of the outermost of those loops, and return it. Anything that can see the
+        variable gets it back rather than evaluating the value again.
+
+        The value is not moved out of an `if` unless the test uses the variable of a loop it is
+        also moved out of (a filter on the objects in the loop rather than a guard on the value).
+
+        Args:
+            value (cpp_value): The value. Evaluating it must not have side effects.
+
+        Returns:
+            Optional[cpp_variable]: The variable that holds the value, or None if the value can't
+                be moved out of any loop.
+        '''
+        stack = self._scope_stack
+        if stack[0] is not self._block:
+            return None
+        if value.scope().is_top_level():
+            depth = 1
+        elif self.current_scope().starts_with(value.scope()):
+            depth = len(value.scope()._scope_stack)
+        else:
+            return None
+
+        key = ('invariant_value', value.as_cpp())
+        for i in range(max(depth, 1), len(stack)):
+            if isinstance(stack[i], loop) and _can_move_out_of(stack[i:]):
+                parent = stack[i - 1]
+                v = self.get_rep(key)
+                if v is None:
+                    v = cpp_variable(unique_name('inv'), gc_scope(stack[:i]), value.cpp_type())
+                    parent._statements.insert(_index_of(parent, stack[i]), declare_value(v, value))
+                    parent.set_rep(key, v)
+                return v
+        return None
+
+    def add_statement_before(self, st, before) -> None:
+        '''Add `st` to the current block, just ahead of `before` (which must already be in it). The
+        point of insertion is not changed.
+        '''
+        parent = self._scope_stack[-1]
+        parent._statements.insert(_index_of(parent, before), st)
+
+    def remove_statement(self, st) -> None:
+        'Remove `st` (which must be there) from the current block'
+        parent = self._scope_stack[-1]
+        del parent._statements[_index_of(parent, st)]
+
     def add_statement(self, st, below=None):
         '''
         Add a statement. By default it is added to whereever the current
@@ -62,12 +188,99 @@ class generated_code:
     def include_files(self):
         return self._include_files
 
+    def add_header_include(self, path: str):
+        'Add an include file needed by the class declaration (e.g. for the type of a class variable)'
+        if path not in self._header_include_files:
+            self._header_include_files.append(path)
+
+    def header_include_files(self) -> List[str]:
+        return self._header_include_files
+
     def add_link_library(self, library: str):
         self._link_libraries += [library]
 
     def link_libraries(self) -> List[str]:
         return self._link_libraries
 
+    def event_scope(self) -> gc_scope:
+        'Return the scope of the top level block - code here runs once per event'
+        return gc_scope((self._block,))
+
+    def can_add_event_statement(self) -> bool:
+        'Return true if `add_event_statement` can be used from where we are now'
+        return self._scope_stack[0] is self._block
+
+    def add_event_statement(self, st: block) -> gc_scope:
+        '''Add a block that only depends on the event (like fetching a collection). It is added
+        where we are now, but ahead of any loop we are in, so it runs once per event, and only for
+        events that pass the tests we are inside of. The point of insertion is not changed. Call
+        `use_event_statement` each time it is needed again.
+
+        st - The block to add
+
+        Returns the scope of the block the statement was added to.
+        '''
+        assert self.can_add_event_statement()
+        stack = self._scope_stack
+        n_parents = next((i for i, s in enumerate(stack) if isinstance(s, loop)), len(stack))
+        parents = stack[:n_parents]
+        if n_parents == len(stack):
+            parents[-1].add_statement(st)
+        else:
+            parents[-1]._statements.insert(_index_of(parents[-1], stack[n_parents]), st)
+        self._event_statements[id(st)] = (st, parents)
+        return gc_scope(parents)
+
+    def use_event_statement(self, st: block) -> gc_scope:
+        '''A block added with `add_event_statement` is needed at the current point of insertion. If
+        it does not already run before here, move it up to where it runs before both this and
+        everything that used it before.
+
+        st - The block
+
+        Returns the scope of the block the statement is now in.
+        '''
+        _, parents = self._event_statements[id(st)]
+        stack = self._scope_stack
+        n_common = next((i for i, (a, b) in enumerate(zip(parents, stack)) if a is not b), min(len(parents), len(stack)))
+        if n_common == len(parents):
+            # We are inside the block it is in. It is fine, unless we are in a statement ahead of it
+            # (e.g. a loop being filled again).
+            if len(stack) == n_common or _index_of(parents[-1], stack[n_common]) > _index_of(parents[-1], st):
+                return gc_scope(parents)
+            ahead_of = stack[n_common]
+        else:
+            # Move it up to the innermost block it has in common with here, ahead of both.
+            ahead_of = parents[n_common]
+            if len(stack) > n_common and _index_of(parents[n_common - 1], stack[n_common]) < _index_of(parents[n_common - 1], ahead_of):
+                ahead_of = stack[n_common]
+
+        parents[-1]._statements.remove(st)
+        parents = parents[:n_common]
+        parents[-1]._statements.insert(_index_of(parents[-1], ahead_of), st)
+        self._event_statements[id(st)] = (st, parents)
+        return gc_scope(parents)
+
+    def is_event_statement(self, st) -> bool:
+        'Return true if `st` was added with `add_event_statement`'
+        return id(st) in self._event_statements and self._event_statements[id(st)][0] is st
+
+    def move_event_statements_before(self, st):
+        '''Move all the statements added with `add_event_statement` that come after `st` in the
+        current block to just ahead of it (keeping their order). This way they run before anything
+        that is later added to `st`.
+        '''
+        statements = self._scope_stack[-1]._statements
+        index = _index_of(self._scope_stack[-1], st)
+        moving = [s for s in statements[index + 1:] if self.is_event_statement(s)]
+        for s in moving:
+            statements.remove(s)
+        statements[index:index] = moving
+
+    def current_statements(self) -> list:
+        'Return the statements already added at the current point of insertion, in order'
+        return list(self._scope_stack[-1]._statements)
+
     def pop_scope(self):
         self._scope_stack = self._scope_stack[:-1]
 
@@ -80,8 +293,9 @@ class generated_code:
         if scope_info is None:
             raise Exception("Scope can't be set to null")
         if scope_info.is_top_level():
-            # Special case this guy as it is a unicorn.
-            self._scope_stack = self._scope_stack[:1]
+            # Special case this guy as it is a unicorn. The stack may have been popped
+            # clean by a terminal, so rebuild it.
+            self._scope_stack = (self._block,)
             return
 
         # Restore it to whatever it was.
@@ -1,17 +1,25 @@
 import ast
+import asyncio
+import contextlib
 from dataclasses import dataclass
+import functools
+import heapq
 import logging
 import shutil
 import tempfile
+import threading
+import uuid
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
 from pathlib import Path
-from typing import Any, Callable, List, Optional, Union
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple, Union
 
 import python_on_whales
-from func_adl import EventDataset
-from func_adl_xAOD.common.executor import executor
+from func_adl import EventDataset, ObjectStream
+from func_adl_xAOD.common.build_cache import build_cache
+from func_adl_xAOD.common.executor import ExecutionInfo, executor
 from func_adl_xAOD.common.result_ttree import cpp_ttree_rep
+from func_adl_xAOD.common.timing import query_timings, span_exporter
 from python_on_whales import docker
 
 
@@ -28,6 +36,40 @@ def _docker_volume_name(info: docker_volume_info) -> str:
     return 'func_adl_' + info.docker_name
 
 
+# Where a cached build area volume is mounted in the container
+_build_area_mount_point = '/func_adl_build'
+
+
+def _balance_files(files: List[Path], n_groups: int) -> List[List[Path]]:
+    '''Split the files into at most `n_groups` groups with about the same total size. Each
+    file, largest first, goes to the group with the smallest total so far.
+
+    Args:
+        files (List[Path]): The files to split up
+        n_groups (int): The maximum number of groups
+
+    Returns:
+        List[List[Path]]: The groups of files. None are empty.
+    '''
+    n_groups = min(n_groups, len(files))
+    groups: List[List[Path]] = [[] for _ in range(n_groups)]
+    totals = [(0, i) for i in range(n_groups)]
+    for f in sorted(files, key=lambda f: f.stat().st_size, reverse=True):
+        total, i = heapq.heappop(totals)
+        groups[i].append(f)
+        heapq.heappush(totals, (total + f.stat().st_size, i))
+    return groups
+
+
+class result_files(list):
+    '''The output files from running a query (a list of `Path`), along with how long
+    each phase of the translation and run took (`timings`, a `query_timings`).
+    '''
+    def __init__(self, files: List[Path], timings: Optional[query_timings]):
+        super().__init__(files)
+        self.timings = timings
+
+
 class LocalDataset(EventDataset, ABC):
     '''A dataset running locally
     '''
@@ -35,11 +77,17 @@ class LocalDataset(EventDataset, ABC):
                  files: Union[Path, str, List[Path], List[str]],
                  docker_image: str,
                  docker_tag: str,
-                 output_directory: Optional[Path] = None):
+                 output_directory: Optional[Path] = None,
+                 build_cache: Optional[build_cache] = None,
+                 max_workers: int = 1,
+                 timeout: Optional[float] = None,
+                 span_exporter: Optional[span_exporter] = None):
         '''Run on the given files locally using a docker image to process them.
 
-        When using `.value()` a list of `Path` objects is returned. All input files
-        are combined into a single file. And the file is always called `ANALYSIS.root`
+        When using `.value()` a list of `Path` objects is returned. Unless `max_workers` is
+        more than one, all input files are combined into a single file. And the file is
+        always called `ANALYSIS.root`. The list's `timings` attribute holds how long each phase
+        of the translation and the run took.
 
         NOTE:
 
@@ -55,9 +103,26 @@ class LocalDataset(EventDataset, ABC):
             output_directory (Optional[Path], optional): The directory to write the output to.
                 If `None` then will be written to the temp directory. Any directory passed in must
                 already exist. Defaults to `None`.
+            build_cache (Optional[build_cache], optional): If given, compiled queries are kept
+                in docker volumes and re-used when an identical query is run again. The
+                backend's runner script must support the `-b` (build area) option.
+                Defaults to `None`.
+            max_workers (int): The number of containers that can run at once. If more than
+                one, the input files are split into that many groups of about the same total
+                size, and each group is run in its own container. One output file is returned
+                per group (`ANALYSIS_part0.root`, etc.). Defaults to 1.
+            timeout (Optional[float]): If the query takes longer than this many seconds, its
+                containers are killed and `asyncio.TimeoutError` is raised. Defaults to `None`
+                (no limit).
+            span_exporter (Optional[span_exporter]): If given, the timing of each phase of
+                every query is sent here as spans, when the query finishes (or fails).
+                Defaults to `None`.
         '''
         super().__init__()
 
+        if max_workers < 1:
+            raise ValueError(f'At least one worker is needed to run a query (not {max_workers})')
+
         if isinstance(files, str):
             f_list = [files]
         else:
@@ -75,6 +140,10 @@ class LocalDataset(EventDataset, ABC):
 
         self._output_directory = output_directory if output_directory is not None \
             else Path(tempfile.tempdir)  # type: ignore
+        self._build_cache = build_cache
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._span_exporter = span_exporter
 
         # Put everything into the ast so that we can safely be carried over qastle and used in
         # determining a hash key to see when things change.
@@ -90,6 +159,16 @@ class LocalDataset(EventDataset, ABC):
             executor: Return the executor
         '''
 
+    def can_share_build(self) -> bool:
+        '''Return true if the backend's runner script can build into, and run from, a build
+        area given with the `-b` option. If it can, when files are run in parallel, the query
+        is compiled once and all containers run from that build.
+
+        Returns:
+            bool: True if the build area can be shared. Defaults to False.
+        '''
+        return False
+
     @abstractmethod
     def docker_cache_volume(self) -> List[docker_volume_info]:
         '''Return info for a cache volume that can be mounted to the docker container.
@@ -101,15 +180,23 @@ class LocalDataset(EventDataset, ABC):
         '''
 
     async def execute_result_async(self, a: ast.AST, title: str) -> Any:
-        '''Take the `ast` and turn it into code and run it in docker, async.
+        '''Take the `ast` and turn it into code and run it in docker, async. The containers
+        are run without blocking the event loop. If the query is cancelled (or times out) the
+        containers are killed.
 
         Args:
             a (ast.AST): The AST fo the query to run
             title (str): Title of the query
 
         Returns:
-            Any: List of files
+            Any: List of files (a `result_files`)
         '''
+        if self._timeout is None:
+            return await self._execute_result(a)
+        return await asyncio.wait_for(self._execute_result(a), self._timeout)
+
+    async def _execute_result(self, a: ast.AST) -> List[Path]:
+        'Translate and run the query - see `execute_result_async`'
         # Build everything in the local temp file directory.
         with tempfile.TemporaryDirectory() as local_run_dir_p:
 
@@ -117,64 +204,351 @@ class LocalDataset(EventDataset, ABC):
             local_run_dir = Path(local_run_dir_p)
             local_run_dir.chmod(0o777)
 
-            # Get the files that we can run
-            exe = self.get_executor_obj()
-            f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), local_run_dir)
-
-            # Write out a file with the mapped in directories.
-            # Until we better figure out how to deal with this, there are some restrictions
-            # on file locations.
-            datafile_dir: Optional[Path] = None
-            with open(f'{local_run_dir}/filelist.txt', 'w') as flist_out:
-                for u in self.files:
-
-                    ds_path = u.parent
-                    datafile = u.name
-                    flist_out.write(f'/data/{datafile}\n')
-                    if datafile_dir is None:
-                        datafile_dir = ds_path
-                    else:
-                        if ds_path != datafile_dir:
-                            raise RuntimeError(f'Data files must be from the same directory. Have seen {ds_path} and {datafile_dir} so far.')
-
-            # Build the docker command and run it.
-            volumes_to_mount = [
-                (f_spec.output_path, '/scripts', 'ro'),
-                (f_spec.output_path, '/results', ''),
-                (datafile_dir, '/data/', 'ro'),
-            ]
-
-            # Add any docker volumes in
-            for v_info in self.docker_cache_volume():
-                # Make sure the volume has been created
-                v_name = _docker_volume_name(v_info)
-                # if not docker.volume.exists(v_name):
-                #     docker.volume.create(v_name)
-                volumes_to_mount.append((v_name, v_info.mount_point))
-
-            output: str = ""
+            f_spec, datafile_dir = self._write_query(a, local_run_dir)
             try:
-                output_generator = docker.run(
-                    self._docker_image, [f'/scripts/{f_spec.main_script}'],
-                    volumes=volumes_to_mount,
-                    remove=True,
-                    stream=True,
-                )
-                for stream_type, stream_content in output_generator:
-                    if stream_type == 'stdout':
-                        output += f'{stream_content.decode()}'
-                    else:
-                        output += f'(stderr) {stream_content.decode()}'
-                self._dump_info(logging.DEBUG, output, local_run_dir, f_spec.main_script, self._docker_image)
+                return result_files(await self._run_query(f_spec, local_run_dir, datafile_dir), f_spec.timings)
+            finally:
+                self._export_timings(f_spec.timings)
+
+    async def _run_query(self, f_spec: ExecutionInfo, local_run_dir: Path, datafile_dir: Path) -> List[Path]:
+        'Run the query, written out in `local_run_dir`, over all the files'
+        if self._max_workers > 1 and len(self.files) > 1:
+            parts = [r async for r in self._run_parts(f_spec, local_run_dir, datafile_dir,
+                                                      _balance_files(self.files, self._max_workers))]
+            return [p for _, p in sorted(parts)]
+
+        # Build the docker command and run it.
+        volumes_to_mount = [
+            (f_spec.output_path, '/scripts', 'ro'),
+            (f_spec.output_path, '/results', ''),
+            (datafile_dir, '/data/', 'ro'),
+        ]
+        runner_args = [f'/scripts/{f_spec.main_script}']
+
+        # If this query has been built before, re-use the build area. Only one query at a time
+        # builds (or checks for) a given build.
+        async with contextlib.AsyncExitStack() as build_lock:
+            build_key = None
+            if self._build_cache is not None:
+                build_key = self._build_cache.build_key(f_spec.output_path, f_spec.all_filenames, self._docker_image)
+                await build_lock.enter_async_context(self._build_cache.build_lock(build_key))
+                build_volume = self._build_cache.volume_name(build_key)
+                if self._build_cache.is_cached(build_key):
+                    # Nothing to build, so others can run from it at the same time
+                    runner_args.append('-r')
+                    await build_lock.aclose()
+                elif await _in_thread(docker.volume.exists, build_volume):
+                    # Left over from a build that never finished - start from scratch.
+                    await _in_thread(docker.volume.remove, build_volume)
+                runner_args += ['-b', _build_area_mount_point]
+                volumes_to_mount.append((build_volume, _build_area_mount_point))
 
+            try:
+                # Unless the build is being re-used, this container also compiles the query.
+                with f_spec.timings.phase('container_run', compile='-r' not in runner_args):
+                    await self._run_docker(runner_args, volumes_to_mount, local_run_dir, f_spec.main_script)
             except python_on_whales.exceptions.DockerException as e:
-                self._dump_info(logging.ERROR, output, local_run_dir, f_spec.main_script, self._docker_image)
+                if build_key is not None:
+                    # We do not know if the build area is still good.
+                    self._build_cache.forget(build_key)  # type: ignore
                 raise e
 
-            # Now that we have run, we can pluck out the result.
-            assert isinstance(f_spec.result_rep, cpp_ttree_rep), 'Unknown return type'
+            if build_key is not None:
+                await _in_thread(self._remove_build_volumes, self._build_cache.mark_used(build_key))  # type: ignore
+
+        # Now that we have run, we can pluck out the result.
+        assert isinstance(f_spec.result_rep, cpp_ttree_rep), 'Unknown return type'
+        with f_spec.timings.phase('extract_result'):
             return [_extract_result_TTree(f_spec.result_rep, local_run_dir, self._output_directory)]
 
+    async def iterate_results_async(self, query: Union[ObjectStream, ast.AST]) -> AsyncIterator[Path]:
+        '''Run a query against this dataset, and return each output file as soon as it is
+        ready, rather than waiting for all the input files to be processed.
+
+        If the build can be shared (see `can_share_build`), the query is compiled once and
+        each input file is run in its own container, up to `max_workers` at a time, largest
+        file first. Otherwise, the input files are split into `max_workers` groups, each run
+        in its own container (which compiles the query).
+
+        ```python
+        async for f in ds.iterate_results_async(ds.Select(...).AsROOTTTree(...)):
+            fill_histograms(f)
+        ```
+
+        Args:
+            query (Union[ObjectStream, ast.AST]): The query to run. It must be built on this
+                dataset.
+
+        Returns:
+            AsyncIterator[Path]: The output files (`ANALYSIS_part<n>.root`), in the order they
+                finish.
+        '''
+        a = query.query_ast if isinstance(query, ObjectStream) else query
+        loop = asyncio.get_running_loop()
+        deadline = None if self._timeout is None else loop.time() + self._timeout
+
+        with tempfile.TemporaryDirectory() as local_run_dir_p:
+            local_run_dir = Path(local_run_dir_p)
+            local_run_dir.chmod(0o777)
+
+            f_spec, datafile_dir = self._write_query(a, local_run_dir)
+
+            parts = [[f] for f in sorted(self.files, key=lambda f: f.stat().st_size, reverse=True)] \
+                if self.can_share_build() \
+                else _balance_files(self.files, self._max_workers)
+            try:
+                async for _, p in self._run_parts(f_spec, local_run_dir, datafile_dir, parts, deadline):
+                    yield p
+            finally:
+                self._export_timings(f_spec.timings)
+
+    def _export_timings(self, timings: query_timings):
+        'Send the phase timings of a query to the span exporter, if there is one'
+        if self._span_exporter is not None:
+            timings.export(self._span_exporter)
+
+    def _write_query(self, a: ast.AST, local_run_dir: Path) -> Tuple[ExecutionInfo, Path]:
+        '''Write out the files needed to run the query, along with the list of input files.
+
+        Args:
+            a (ast.AST): The query
+            local_run_dir (Path): Directory to write the files into
+
+        Returns:
+            Tuple[ExecutionInfo, Path]: Info on the files written, and the directory holding
+                the input files.
+        '''
+        # Get the files that we can run
+        exe = self.get_executor_obj()
+        f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), local_run_dir)
+
+        # Write out a file with the mapped in directories.
+        # Until we better figure out how to deal with this, there are some restrictions
+        # on file locations.
+        datafile_dir: Optional[Path] = None
+        with open(f'{local_run_dir}/filelist.txt', 'w') as flist_out:
+            for u in self.files:
+
+                ds_path = u.parent
+                datafile = u.name
+                flist_out.write(f'/data/{datafile}\n')
+                if datafile_dir is None:
+                    datafile_dir = ds_path
+                else:
+                    if ds_path != datafile_dir:
+                        raise RuntimeError(f'Data files must be from the same directory. Have seen {ds_path} and {datafile_dir} so far.')
+        assert datafile_dir is not None
+        return f_spec, datafile_dir
+
+    async def _run_parts(self, f_spec: ExecutionInfo, local_run_dir: Path, datafile_dir: Path,
+                         parts: List[List[Path]], deadline: Optional[float] = None) -> AsyncIterator[Tuple[int, Path]]:
+        '''Run the query over each group of files, up to `max_workers` containers at once.
+
+        If the build area can be shared, the query is compiled once (or taken from the build
+        cache), and each container just runs. Otherwise every container compiles the query itself.
+        If any part fails (or the deadline passes), the containers still running are killed.
+
+        Args:
+            f_spec (ExecutionInfo): The files written out for the query
+            local_run_dir (Path): The directory the query files were written to
+            datafile_dir (Path): The directory holding all the input files
+            parts (List[List[Path]]): The groups of files. Each is run in its own container.
+            deadline (Optional[float]): Event loop time by which everything must be done.
+
+        Returns:
+            AsyncIterator[Tuple[int, Path]]: The index of each part and its output file, as
+                they finish.
+        '''
+        loop = asyncio.get_running_loop()
+
+        def time_left() -> Optional[float]:
+            return None if deadline is None else max(0.0, deadline - loop.time())
+
+        base_volumes = [
+            (f_spec.output_path, '/scripts', 'ro'),
+            (datafile_dir, '/data/', 'ro'),
+        ]
+        runner = f'/scripts/{f_spec.main_script}'
+
+        # Build once into a volume that all the containers can share. If there is
+        # no build cache, the volume is thrown away when we are done.
+        build_key = None
+        build_volume = None
+        run_args: List[str] = []
+        if self.can_share_build():
+            if self._build_cache is not None:
+                build_key = self._build_cache.build_key(f_spec.output_path, f_spec.all_filenames, self._docker_image)
+                build_volume = self._build_cache.volume_name(build_key)
+            else:
+                build_volume = f'func_adl_build_tmp_{uuid.uuid4().hex}'
+            build_volumes = base_volumes + [(f_spec.output_path, '/results', ''), (build_volume, _build_area_mount_point)]
+            run_args = ['-r', '-b', _build_area_mount_point]
+
+            async with contextlib.AsyncExitStack() as build_lock:
+                if build_key is not None:
+                    await build_lock.enter_async_context(self._build_cache.build_lock(build_key))  # type: ignore
+                if build_key is None or not self._build_cache.is_cached(build_key):  # type: ignore
+                    if build_key is not None and await _in_thread(docker.volume.exists, build_volume):
+                        await _in_thread(docker.volume.remove, build_volume)
+                    try:
+                        with f_spec.timings.phase('container_compile'):
+                            await asyncio.wait_for(self._run_docker([runner, '-c', '-b', _build_area_mount_point],
+                                                                    build_volumes, local_run_dir, f_spec.main_script),
+                                                   time_left())
+                    except (python_on_whales.exceptions.DockerException, asyncio.CancelledError, asyncio.TimeoutError) as e:
+                        if build_key is not None:
+                            self._build_cache.forget(build_key)  # type: ignore
+                        else:
+                            await _in_thread(self._remove_build_volumes, [build_volume])
+                        raise e
+                if build_key is not None:
+                    await _in_thread(self._remove_build_volumes, self._build_cache.mark_used(build_key))  # type: ignore
+
+        # Now run each group of files in its own container, each writing to its own
+        # results directory.
+        assert isinstance(f_spec.result_rep, cpp_ttree_rep), 'Unknown return type'
+        result_rep = f_spec.result_rep
+        workers = asyncio.Semaphore(self._max_workers)
+
+        async def run_part(index: int, files: List[Path]) -> Tuple[int, Path]:
+            async with workers:
+                results_dir = local_run_dir / f'part_{index}'
+                results_dir.mkdir()
+                results_dir.chmod(0o777)
+                volumes = base_volumes + [(results_dir, '/results', '')]
+                if build_volume is not None:
+                    volumes.append((build_volume, _build_area_mount_point))
+                args = [runner] + run_args
+                for f in files:
+                    args += ['-d', f'/data/{f.name}']
+                with f_spec.timings.phase('container_run', part=index, compile=build_volume is None):
+                    await self._run_docker(args, volumes, local_run_dir, f_spec.main_script)
+                with f_spec.timings.phase('extract_result', part=index):
+                    return index, _extract_result_TTree(result_rep, results_dir, self._output_directory, part=index)
+
+        runs = [asyncio.ensure_future(run_part(i, files)) for i, files in enumerate(parts)]
+        try:
+            for next_done in asyncio.as_completed(runs, timeout=time_left()):
+                yield await next_done
+        finally:
+            # Stop anything still running, and wait for it to go away - the build volume
+            # can't be removed while something is still using it.
+            for r in runs:
+                r.cancel()
+            await asyncio.gather(*runs, return_exceptions=True)
+            if build_volume is not None and build_key is None:
+                await _in_thread(self._remove_build_volumes, [build_volume])
+
+    async def _run_docker(self, runner_args: List[str], volumes_to_mount: List[Tuple], local_run_dir: Path, main_script: str) -> str:
+        '''Run the runner script in a container, and wait for it to finish. Any docker
+        cache volumes the backend needs are mounted as well. If cancelled, the container
+        is killed.
+
+        Args:
+            runner_args (List[str]): The runner script and its arguments
+            volumes_to_mount (List[Tuple]): Volumes to mount in the container
+            local_run_dir (Path): Where the query files are (dumped on error)
+            main_script (str): The name of the runner script
+
+        Returns:
+            str: The output of the container
+
+        Exceptions:
+            DockerException: If the run failed. The output is logged first.
+        '''
+        volumes_to_mount = list(volumes_to_mount)
+
+        # Add any docker volumes in
+        for v_info in self.docker_cache_volume():
+            # Make sure the volume has been created
+            v_name = _docker_volume_name(v_info)
+            # if not docker.volume.exists(v_name):
+            #     docker.volume.create(v_name)
+            volumes_to_mount.append((v_name, v_info.mount_point))
+
+        container_name = f'func_adl_{uuid.uuid4().hex}'
+        output: str = ""
+        try:
+            async for stream_type, stream_content in self._stream_docker(container_name, runner_args, volumes_to_mount):
+                if stream_type == 'stdout':
+                    output += f'{stream_content.decode()}'
+                else:
+                    output += f'(stderr) {stream_content.decode()}'
+            self._dump_info(logging.DEBUG, output, local_run_dir, main_script, self._docker_image)
+
+        except python_on_whales.exceptions.DockerException as e:
+            self._dump_info(logging.ERROR, output, local_run_dir, main_script, self._docker_image)
+            raise e
+
+        return output
+
+    async def _stream_docker(self, container_name: str, runner_args: List[str], volumes_to_mount: List[Tuple]) -> AsyncIterator[Tuple[str, bytes]]:
+        '''Run a container and return its output as it arrives. The `docker` calls block,
+        so they are made on a thread of their own, and the output is passed back to the
+        event loop. If cancelled, the container is killed - or never started, if it has not
+        been yet.
+
+        Args:
+            container_name (str): Name to give the container (so it can be killed)
+            runner_args (List[str]): The command to run in the container
+            volumes_to_mount (List[Tuple]): Volumes to mount in the container
+
+        Returns:
+            AsyncIterator[Tuple[str, bytes]]: The stream name (`stdout` or `stderr`) and the output
+        '''
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        cancelled = threading.Event()
+
+        def post(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop has gone away - no one is listening any longer.
+                pass
+
+        def run():
+            if cancelled.is_set():
+                return
+            try:
+                for item in docker.run(self._docker_image, runner_args,
+                                       volumes=volumes_to_mount,
+                                       remove=True,
+                                       stream=True,
+                                       name=container_name):
+                    post(item)
+                post(done)
+            except Exception as e:
+                post(e)
+
+        run_thread = threading.Thread(target=run, daemon=True)
+        run_thread.start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        except asyncio.CancelledError:
+            cancelled.set()
+            await _in_thread(_kill_container, container_name, run_thread)
+            raise
+
+    def _remove_build_volumes(self, volume_names: List[str]):
+        '''Remove docker volumes holding builds that have been evicted from the build cache.
+
+        Args:
+            volume_names (List[str]): Names of the docker volumes to remove
+        '''
+        for v_name in volume_names:
+            try:
+                docker.volume.remove(v_name)
+            except python_on_whales.exceptions.DockerException as e:
+                logging.getLogger(__name__).warning(f'Unable to remove build cache volume {v_name}: {e}')
+
     def _dump_info(self, level, running_string: str, local_run_dir: Path, source_file_name: str, docker_image: str):
         '''Dump the logging info from a docker run.
 
@@ -195,12 +569,34 @@ class LocalDataset(EventDataset, ABC):
                     _dump_split_string(f.read(), lambda l: lg.log(level, f'  {l}'))
 
 
+async def _in_thread(f: Callable, *args) -> Any:
+    'Make a blocking call (like one to `docker`) on a thread, so the event loop is not held up'
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(f, *args))
+
+
+def _kill_container(container_name: str, run_thread: threading.Thread):
+    '''Kill a container started by `run_thread`. The container may not exist yet (`docker run`
+    has been called, but has not created it), so keep trying until it can be killed, or the
+    thread is done (it never started, or it has finished).
+
+    Args:
+        container_name (str): The name of the container
+        run_thread (threading.Thread): The thread running the container
+    '''
+    while run_thread.is_alive():
+        try:
+            docker.kill(container_name)
+            return
+        except python_on_whales.exceptions.DockerException:
+            run_thread.join(0.1)
+
+
 def _dump_split_string(s: str, dump: Callable[[str], None]):
     for ll in s.split('\n'):
         dump(ll)
 
 
-def _extract_result_TTree(rep: cpp_ttree_rep, run_dir, output_dir: Path):
+def _extract_result_TTree(rep: cpp_ttree_rep, run_dir, output_dir: Path, part: Optional[int] = None):
     '''Copy the final file into a place that is "safe", and return that as a path.
 
     The reason for this is that the temp directory we are using is about to be deleted!
@@ -208,11 +604,15 @@ def _extract_result_TTree(rep: cpp_ttree_rep, run_dir, output_dir: Path):
     Args:
         rep (cpp_base_rep): The representation of the final result
         run_dir ([type]): Directory where it ran
+        part (Optional[int]): If the result is one of several parts, its index. It is added
+            to the file name (`ANALYSIS_part0.root`).
 
     Raises:
         Exception: [description]
     '''
     current_path = run_dir / rep.filename
     new_path = output_dir / rep.filename
+    if part is not None:
+        new_path = new_path.with_name(f'{new_path.stem}_part{part}{new_path.suffix}')
     shutil.copy(current_path, new_path)
     return new_path
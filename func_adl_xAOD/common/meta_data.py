@@ -2,8 +2,9 @@ from func_adl_xAOD.common.event_collections import EventCollectionSpecification
 from func_adl_xAOD.common.cpp_ast import CPPCodeSpecification
 from func_adl_xAOD.common.cpp_types import add_method_type_info, collection, terminal
 from func_adl_xAOD.common.cpp_types import CPPParsedTypeInfo, parse_type
-from typing import Any, Dict, List, Union
-from dataclasses import dataclass, field
+from func_adl_xAOD.common.translation_context import translation_context
+from typing import Any, Dict, List, Optional, Union
+from dataclasses import dataclass, field, fields
 
 
 @dataclass
@@ -42,7 +43,96 @@ class InjectCodeBlock:
     link_libraries: List[str] = field(default_factory=list)
 
 
-SpecificationTypes = Union[CPPCodeSpecification, EventCollectionSpecification, JobScriptSpecification, InjectCodeBlock]
+@dataclass
+class CodeGenerationOptions:
+    'Options that change how the C++ for a query is generated. All are off by default.'
+
+    # Evaluate a repeated expression (like `j.pt()` used in both a `Where` and a `Select`, or a
+    # `DeltaR` with the same arguments) once, and hold the result in a temporary. Member calls and
+    # C++ functions are assumed to have no side effects.
+    common_subexpression_elimination: bool = False
+
+    # Evaluate a member call that does not change inside a loop (like `mu.eta()` in a loop over
+    # jets) once, just ahead of the outermost loop it does not change in. It is not moved out of an
+    # `if` unless the test depends on one of the loops it is moved out of.
+    loop_invariant_code_motion: bool = False
+
+    def merge(self, other: 'CodeGenerationOptions') -> 'CodeGenerationOptions':
+        '''Return options where everything turned on in either this or `other` is turned on.
+
+        Args:
+            other (CodeGenerationOptions): The options to combine with these
+
+        Returns:
+            CodeGenerationOptions: The combined options
+        '''
+        return CodeGenerationOptions(**{f.name: getattr(self, f.name) or getattr(other, f.name) for f in fields(self)})
+
+
+# The types a column can be written out as, and the C++ type used for each
+output_column_cpp_types: Dict[str, str] = {
+    'double': 'double',
+    'float': 'float',
+    'int': 'int',
+    'int16': 'short',
+    'int8': 'signed char',
+    'bool': 'bool',
+}
+
+
+@dataclass
+class OutputColumnTypes:
+    '''The types columns are written to the output tree as. By default a column is written as the
+    type it is calculated as (often `double`). A column of vectors has the type of its numbers changed.
+    '''
+
+    # The type to write a column as, by column name. One of the keys of `output_column_cpp_types`.
+    columns: Dict[str, str] = field(default_factory=dict)
+
+    # Write every `double` column that is not listed in `columns` as a `float`
+    double_as_float: bool = False
+
+    def __post_init__(self):
+        for name, t in self.columns.items():
+            if t not in output_column_cpp_types:
+                raise ValueError(f'Unknown type "{t}" for column {name} - must be one of {", ".join(output_column_cpp_types)}')
+
+    def merge(self, other: 'OutputColumnTypes') -> 'OutputColumnTypes':
+        '''Return the column types asked for by either this or `other`.
+
+        Args:
+            other (OutputColumnTypes): The column types to combine with these
+
+        Raises:
+            ValueError: If both give a different type for the same column
+
+        Returns:
+            OutputColumnTypes: The combined column types
+        '''
+        for name, t in other.columns.items():
+            if self.columns.get(name, t) != t:
+                raise ValueError(f'Column {name} can not be written as both {self.columns[name]} and {t}')
+        return OutputColumnTypes({**self.columns, **other.columns}, self.double_as_float or other.double_as_float)
+
+    def cpp_type(self, name: str, calculated_type: str) -> Optional[str]:
+        '''The C++ type to write the numbers in a column as.
+
+        Args:
+            name (str): The column name
+            calculated_type (str): The C++ type the numbers in the column are calculated as
+
+        Returns:
+            Optional[str]: The C++ type, or None if they should be written as calculated.
+        '''
+        if name in self.columns:
+            return output_column_cpp_types[self.columns[name]]
+        if self.double_as_float and calculated_type == 'double':
+            return 'float'
+        return None
+
+
+SpecificationTypes = Union[CPPCodeSpecification, EventCollectionSpecification, JobScriptSpecification, InjectCodeBlock, CodeGenerationOptions,
+                           OutputColumnTypes]
 
 
 def ok_to_add_code_block(spec, cpp_funcs: List[SpecificationTypes]) -> bool:
@@ -65,15 +155,21 @@ def ok_to_add_code_block(spec, cpp_funcs: List[SpecificationTypes]) -> bool:
     return True
 
 
-def process_metadata(md_list: List[Dict[str, Any]]) -> List[SpecificationTypes]:
+def process_metadata(md_list: List[Dict[str, Any]], context: Optional[translation_context] = None) -> List[SpecificationTypes]:
     '''Process a list of metadata, in order.
 
     Args:
         md (List[Dict[str, str]]): The metadata to process
+        context (Optional[translation_context]): Method type information is added to this
+            translation context. If `None`, the currently active context is used.
 
     Returns:
         List[X]: Metadata we've found
     '''
+    if context is not None:
+        with context.activate():
+            return process_metadata(md_list)
+
     cpp_funcs: List[SpecificationTypes] = []
     for md in md_list:
         md_type = md.get('metadata_type')
@@ -103,6 +199,20 @@ def process_metadata(md_list: List[Dict[str, Any]]) -> List[SpecificationTypes]:
                     raise ValueError(f'Bad inject_code block item: {str(e)}')
                 if ok_to_add_code_block(spec, cpp_funcs):
                     cpp_funcs.append(spec)
+        elif md_type == 'code_generation_options':
+            info = dict(md)
+            del info['metadata_type']
+            try:
+                cpp_funcs.append(CodeGenerationOptions(**info))
+            except TypeError as e:
+                raise ValueError(f'Bad code_generation_options item: {str(e)}')
+        elif md_type == 'output_column_types':
+            info = dict(md)
+            del info['metadata_type']
+            try:
+                cpp_funcs.append(OutputColumnTypes(**info))
+            except TypeError as e:
+                raise ValueError(f'Bad output_column_types item: {str(e)}')
         elif md_type == 'add_job_script':
             spec = JobScriptSpecification(
                 name=md['name'],
@@ -121,6 +231,8 @@ def process_metadata(md_list: List[Dict[str, Any]]) -> List[SpecificationTypes]:
                 bool(md['return_is_collection']) if 'return_is_collection' in md else False,
                 md['method_object'] if 'method_object' in md else None,
                 md['instance_object'] if 'instance_object' in md else None,
+                [tuple(f) for f in md['instance_fields']] if 'instance_fields' in md else [],
+                bool(md['return_is_reference']) if 'return_is_reference' in md else False,
             )
             cpp_funcs.append(spec)
         elif md_type == 'add_atlas_event_collection_info':
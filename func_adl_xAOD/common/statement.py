@@ -1,6 +1,6 @@
 # Statements
 from abc import ABC, abstractmethod  # For declaring abstract base class
-from typing import Any
+from typing import Any, Optional
 
 import func_adl_xAOD.common.cpp_representation as crep
 
@@ -29,12 +29,16 @@ class block:
     def emit(self, e):
         'Render the block of code'
         e.add_line("{")
+        self.emit_contents(e)
+        e.add_line("}")
+
+    def emit_contents(self, e):
+        'Render the variable declarations and statements in the block, without the brackets'
         for v in self._variables:
             init_value = "" if not isinstance(v, crep.cpp_variable) or not v.initial_value() else " ({0})".format(v.initial_value().as_cpp())
             e.add_line("{0} {1}{2};".format(v.cpp_type(), v.as_cpp(), init_value))
         for s in self._statements:
             s.emit(e)
-        e.add_line("}")
 
     def get_rep(self, name: Any) -> Any:
         '''Return the representation for some object. If we do not know its value
@@ -77,10 +81,84 @@ class loop(block):
         self._collection = collection_rep
         self._loop_variable = loop_var_rep
 
+        # True if something declared outside the loop is accumulated inside it (e.g. a `Sum`).
+        # That value is not complete until the loop is done, so nothing that might use it can be
+        # added to the loop, or moved ahead of it.
+        self.has_accumulator = False
+
+        # True if the body of another sequence has been added to this loop (see `can_fuse`)
+        self.fused = False
+
+        # True if the loop stops after its first item (see `First`). Nothing else can be added.
+        self.exits_early = False
+
+        # True if only the first item is wanted, and there is nothing to skip over to find it. The
+        # loop is then just a test that the collection is not empty.
+        self.first_only = False
+
+    def loop_variable(self) -> crep.cpp_value:
+        'The variable holding the current item in the loop'
+        return self._loop_variable
+
+    def size(self) -> Optional[str]:
+        'The C++ for the number of items the loop runs over, or None if it is not known before it starts'
+        collection = self._collection.as_cpp()
+        return f'{collection[1:]}->size()' if collection.startswith('*') else f'{collection}.size()'
+
+    def can_fuse(self, collection_rep: crep.cpp_value) -> bool:
+        '''Return true if the body of a loop over `collection_rep` can be added to this loop
+        rather than getting its own loop.
+        '''
+        return not self.has_accumulator and not self.exits_early \
+            and self._collection.as_cpp() == collection_rep.as_cpp()
+
     def emit(self, e):
         'Emit a for loop enclosed by a block of code'
-        e.add_line(f"for (auto &&{self._loop_variable.as_cpp()} : {self._collection.as_cpp()})")
-        block.emit(self, e)
+        if self.first_only:
+            collection = f'({self._collection.as_cpp()})'
+            e.add_line(f"if (!{collection}.empty())")
+            e.add_line("{")
+            e.add_line(f"auto &&{self._loop_variable.as_cpp()} = {collection}.front();")
+            self.emit_contents(e)
+            e.add_line("}")
+        else:
+            e.add_line(f"for (auto &&{self._loop_variable.as_cpp()} : {self._collection.as_cpp()})")
+            block.emit(self, e)
+
+
+class range_loop(loop):
+    'A for loop over the integers from `begin` up to, but not including, `end`'
+
+    def __init__(self, loop_var_rep: crep.cpp_value, begin_rep: crep.cpp_value, end_rep: crep.cpp_value,
+                 end_var: str):
+        '''
+        Count `loop_var_rep` from `begin_rep` to `end_rep`. The end is evaluated once, into `end_var`.
+        '''
+        loop.__init__(self, loop_var_rep, end_rep)
+        self._begin = begin_rep
+        self._end = end_rep
+        self._end_var = end_var
+
+    def size(self) -> Optional[str]:
+        'The end might be before the beginning'
+        return None
+
+    def can_fuse(self, collection_rep: crep.cpp_value) -> bool:
+        'Only loops over collections are joined'
+        return False
+
+    def emit(self, e):
+        'Emit a counting for loop enclosed by a block of code'
+        var = self._loop_variable.as_cpp()
+        if self.first_only:
+            e.add_line(f"if ({self._begin.as_cpp()} < {self._end.as_cpp()})")
+            e.add_line("{")
+            e.add_line(f"int {var} = {self._begin.as_cpp()};")
+            self.emit_contents(e)
+            e.add_line("}")
+        else:
+            e.add_line(f"for (int {var} = {self._begin.as_cpp()}, {self._end_var} = {self._end.as_cpp()}; {var} < {self._end_var}; {var}++)")
+            block.emit(self, e)
 
 
 class iftest(block):
@@ -95,6 +173,16 @@ class iftest(block):
         block.emit(self, e)
 
 
+class first_only(block):
+    'Code run for the first item of a loop that gets here. The loop is then exited.'
+
+    def emit(self, e):
+        e.add_line("{")
+        self.emit_contents(e)
+        e.add_line("break;")
+        e.add_line("}")
+
+
 class elsephrase(block):
     'An else statement. Must come after you pop and if statement off'
 
@@ -147,6 +235,20 @@ class set_var:
         e.add_line('{0} = {1};'.format(self._target.as_cpp(), self._value.as_cpp()))
 
 
+class declare_value:
+    'Declare a variable, and set it to a value'
+
+    def __init__(self, var, value):
+        r'''
+        var, value: representations we will use. The variable's type is deduced from the value.
+        '''
+        self._var = var
+        self._value = value
+
+    def emit(self, e):
+        e.add_line('auto {0} = {1};'.format(self._var.as_cpp(), self._value.as_cpp()))
+
+
 class push_back:
     'push a variable onto a vector'
 
@@ -174,6 +276,28 @@ class container_clear:
         e.add_line('{0}.clear();'.format(self._collection.as_cpp()))
 
 
+class loop_break:
+    'Leave the loop we are in'
+
+    def emit(self, e):
+        e.add_line('break;')
+
+
+class container_reserve:
+    'Make room in a vector for a number of items'
+
+    def __init__(self, collection, size: str):
+        r'''
+        collection: representation of the vector
+        size: C++ for the number of items
+        '''
+        self._collection = collection
+        self._size = size
+
+    def emit(self, e):
+        e.add_line('{0}.reserve({1});'.format(self._collection.as_cpp(), self._size))
+
+
 class arbitrary_statement:
     'An arbitrary line of C++ code. Avoid if possible, as it makes analysis impossible'
 
@@ -0,0 +1,136 @@
+# Record how long each phase of translating and running a query takes.
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+
+@dataclass
+class phase_timing:
+    'The time taken by one run of a phase'
+
+    # Name of the phase (e.g. `simplify_chained_calls` or `container_run`)
+    name: str
+
+    # Wall clock time, in seconds
+    wall: float
+
+    # CPU time used by the thread the phase ran on, in seconds. For the container phases this
+    # is only the local book keeping (the work is done in the container). Phases that run at
+    # the same time on one thread (like several containers) each count all of it.
+    cpu: float
+
+    # Start and end, in nanoseconds since the epoch
+    start_ns: int
+    end_ns: int
+
+    # Anything else worth knowing about this run of the phase
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class span_exporter(ABC):
+    '''Something that can receive timing spans. Each span is a dictionary laid out like an
+    OpenTelemetry span: `name`, `trace_id`, `span_id`, `start_time_unix_nano`,
+    `end_time_unix_nano`, and `attributes`.
+    '''
+    @abstractmethod
+    def export(self, spans: List[Dict[str, Any]]):
+        '''Record some spans.
+
+        Args:
+            spans (List[Dict[str, Any]]): The spans
+        '''
+
+
+class jsonl_span_exporter(span_exporter):
+    'Append spans to a file, one JSON object per line'
+    def __init__(self, path: Path):
+        '''Create the exporter.
+
+        Args:
+            path (Path): The file to append to. Created if it does not exist.
+        '''
+        self._path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Dict[str, Any]]):
+        with self._lock, self._path.open('a') as f:
+            for s in spans:
+                f.write(json.dumps(s) + '\n')
+
+
+class query_timings:
+    '''The time taken by each phase of translating (and running) a query.
+
+    A phase may run more than once (for example, one container run per group of files). All
+    the runs are kept in `phases`, and `wall`, `cpu`, and `as_dict` add them up.
+    '''
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.phases: List[phase_timing] = []
+
+    @contextmanager
+    def phase(self, name: str, **attributes: Any) -> Iterator[None]:
+        '''Time the code run in this context as phase `name`.
+
+        Args:
+            name (str): Name of the phase
+            attributes (Any): Extra information to record with the phase
+        '''
+        start_ns = time.time_ns()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.phases.append(phase_timing(name,
+                                            time.perf_counter() - wall_start,
+                                            time.thread_time() - cpu_start,
+                                            start_ns, time.time_ns(), attributes))
+
+    def wall(self, name: str) -> float:
+        'Total wall clock time of phase `name`, in seconds'
+        return sum(p.wall for p in self.phases if p.name == name)
+
+    def cpu(self, name: str) -> float:
+        'Total CPU time of phase `name`, in seconds'
+        return sum(p.cpu for p in self.phases if p.name == name)
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        '''Return the totals for each phase, in the order the phases first ran.
+
+        Returns:
+            Dict[str, Dict[str, float]]: For each phase name, the `wall` and `cpu` time in seconds,
+                and the number of times it ran (`count`).
+        '''
+        result: Dict[str, Dict[str, float]] = {}
+        for p in self.phases:
+            t = result.setdefault(p.name, {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+            t['wall'] += p.wall
+            t['cpu'] += p.cpu
+            t['count'] += 1
+        return result
+
+    def export(self, exporter: span_exporter):
+        '''Send a span for each run of each phase to an exporter. All the spans share this
+        query's `trace_id`.
+
+        Args:
+            exporter (span_exporter): Where to send the spans
+        '''
+        exporter.export([
+            {
+                'name': f'func_adl_xAOD.{p.name}',
+                'trace_id': self.trace_id,
+                'span_id': uuid.uuid4().hex[:16],
+                'start_time_unix_nano': p.start_ns,
+                'end_time_unix_nano': p.end_ns,
+                'attributes': dict(p.attributes, cpu_time_s=p.cpu),
+            }
+            for p in self.phases
+        ])
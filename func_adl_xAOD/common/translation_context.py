@@ -0,0 +1,39 @@
+# The state needed to translate a single query into C++
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from func_adl_xAOD.common.cpp_types import MethodInvokeInfo, method_type_scope
+from func_adl_xAOD.common.cpp_vars import name_counter, unique_name_scope
+
+
+class translation_context:
+    r'''All the state needed while translating a single query into C++.
+
+    This holds the method return type information (see `cpp_types.add_method_type_info`) and
+    the counter used to make variable names unique. Anything that runs inside `activate`
+    uses this context rather than the global state. Contexts are activated per thread (and
+    per asyncio task), so different queries can be translated at the same time as long as
+    each has its own context.
+    '''
+    def __init__(self, method_types: Optional[Dict[str, Dict[str, MethodInvokeInfo]]] = None):
+        '''Create a new context.
+
+        Args:
+            method_types (Optional[Dict[str, Dict[str, MethodInvokeInfo]]]): Method type
+                information to start with. It is copied. If `None` start with no type information.
+        '''
+        self.method_types: Dict[str, Dict[str, MethodInvokeInfo]] = \
+            {} if method_types is None else {k: dict(v) for k, v in method_types.items()}
+        self.names = name_counter()
+
+    def copy(self) -> 'translation_context':
+        '''Return a new context with a copy of this context's method type information, and
+        with fresh variable naming.
+        '''
+        return translation_context(self.method_types)
+
+    @contextmanager
+    def activate(self) -> Iterator['translation_context']:
+        'Make this the context used by all type lookups and variable naming in this scope'
+        with method_type_scope(self.method_types), unique_name_scope(self.names):
+            yield self
@@ -0,0 +1,204 @@
+# A long running service that translates qastle queries into the C++ files that run them.
+#
+#   python -m func_adl_xAOD.common.translation_service --port 8080
+#
+# Everything that is expensive to set up (imports, compiled templates, default type
+# information) is done once when the service starts, so each query only pays for its own
+# translation.
+import argparse
+import json
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import qastle
+from func_adl_xAOD.common.executor import executor
+from func_adl_xAOD.common.result_ttree import cpp_ttree_rep
+
+
+def default_executors() -> Dict[str, Callable[[], executor]]:
+    'Return the backends the service knows about, by name'
+    from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
+    from func_adl_xAOD.cms.aod.executor import cms_aod_executor
+    from func_adl_xAOD.cms.miniaod.executor import cms_miniaod_executor
+    return {
+        'atlas_xaod': atlas_xaod_executor,
+        'cms_aod': cms_aod_executor,
+        'cms_miniaod': cms_miniaod_executor,
+    }
+
+
+class translation_service:
+    '''Translate qastle queries into file bundles, keeping everything warm between queries.
+
+    The last `max_cached_queries` bundles are remembered, so asking for the same query
+    against the same backend again does not translate it a second time. Queries can be
+    translated from several threads at once - each translation gets its own executor.
+    '''
+    def __init__(self, executors: Optional[Dict[str, Callable[[], executor]]] = None,
+                 max_cached_queries: int = 100):
+        '''Create the service.
+
+        Args:
+            executors (Optional[Dict[str, Callable[[], executor]]]): Factory for the executor of
+                each backend, by backend name. Defaults to `default_executors()`.
+            max_cached_queries (int): Number of translated bundles to remember. Zero turns off
+                the cache.
+        '''
+        if max_cached_queries < 0:
+            raise ValueError(f'The number of cached queries can not be negative ({max_cached_queries})')
+        self._executors = executors if executors is not None else default_executors()
+        self._max_cached_queries = max_cached_queries
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Do all the one-time work (template compilation, default types) now rather than
+        # on the first query.
+        for backend in self._executors:
+            self._warm(backend)
+
+    @property
+    def backends(self) -> List[str]:
+        'Names of the backends queries can be translated for'
+        return list(self._executors.keys())
+
+    def _warm(self, backend: str):
+        'Translate a trivial query so everything the backend needs is loaded'
+        self._translate("(call ResultTTree (call Select (call EventDataset 'warm.root') (lambda (list e) 1.0)) "
+                        "(list 'col1') 'warm' 'warm.root')", backend)
+
+    def translate(self, query: str, backend: str) -> Dict[str, Any]:
+        '''Translate a qastle query for a backend.
+
+        Args:
+            query (str): The query, encoded as qastle text
+            backend (str): The name of the backend (see `backends`)
+
+        Returns:
+            Dict[str, Any]: The bundle. `files` maps each file name to its contents, `main_script`
+                is the name of the file to run, and `result` gives the `filename` and `treename`
+                the output will be written to.
+
+        Exceptions:
+            ValueError: If the backend is not known
+        '''
+        if backend not in self._executors:
+            raise ValueError(f'Unknown backend "{backend}" - known backends are {", ".join(self.backends)}')
+
+        key = (backend, query)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        bundle = self._translate(query, backend)
+
+        if self._max_cached_queries > 0:
+            with self._lock:
+                self._cache[key] = bundle
+                while len(self._cache) > self._max_cached_queries:
+                    self._cache.popitem(last=False)
+        return bundle
+
+    def _translate(self, query: str, backend: str) -> Dict[str, Any]:
+        a = qastle.text_ast_to_python_ast(query).body[0].value  # type: ignore
+        exe = self._executors[backend]()
+        with tempfile.TemporaryDirectory() as d:
+            f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), Path(d))
+            files = {f: (Path(d) / f).read_text() for f in f_spec.all_filenames}
+
+        rep = f_spec.result_rep
+        return {
+            'files': files,
+            'main_script': f_spec.main_script,
+            'result': {'filename': rep.filename, 'treename': rep.treename} if isinstance(rep, cpp_ttree_rep) else None,
+        }
+
+
+class _translation_request_handler(BaseHTTPRequestHandler):
+    '''Handle requests for the translation service:
+
+        - `POST /translate/<backend>` with the qastle query as the body returns the bundle as JSON.
+        - `GET /backends` returns the list of backend names as JSON.
+    '''
+    service: translation_service
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/backends':
+            self._reply(200, self.service.backends)
+        else:
+            self._reply(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'translate':
+            self._reply(404, {'error': f'Unknown path {self.path}'})
+            return
+        if parts[1] not in self.service.backends:
+            self._reply(404, {'error': f'Unknown backend "{parts[1]}"'})
+            return
+
+        query = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        try:
+            bundle = self.service.translate(query, parts[1])
+        except Exception as e:
+            self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self._reply(200, bundle)
+
+    def _reply(self, status: int, body: Any):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+
+def make_server(service: Optional[translation_service] = None, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    '''Create the http server for a translation service. Call `serve_forever` on the
+    result to start answering requests.
+
+    Args:
+        service (Optional[translation_service]): The service to use. A new one with the
+            default backends if `None`.
+        host (str): Address to listen on. Defaults to the local machine only.
+        port (int): Port to listen on. If 0, a free port is picked (see `server_address`).
+
+    Returns:
+        ThreadingHTTPServer: The server
+    '''
+    handler = type('translation_request_handler', (_translation_request_handler,),
+                   {'service': service if service is not None else translation_service()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Translate qastle queries into C++ over http')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--cache-size', type=int, default=100, help='Number of translated queries to remember')
+    opts = parser.parse_args(args)
+
+    # Warnings about assumed method types are not useful in a long running service
+    logging.getLogger('func_adl_xAOD').setLevel(logging.ERROR)
+
+    server = make_server(translation_service(max_cached_queries=opts.cache_size), opts.host, opts.port)
+    print(f'Listening on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,10 @@ class gc_scope:
 
         return gc_scope(self._scope_stack[:key])
 
+    def __len__(self) -> int:
+        'The number of blocks in the scope, from the top down'
+        return len(self._scope_stack)
+
     def frame_statements(self, key):
         'Return the nth frame block. -1 means the last one, 0 means the deepest (top) one.'
         return self._scope_stack[key]
@@ -79,3 +83,10 @@ def deepest_scope(v1, v2):
     if s1.starts_with(s2):
         return v1
     return v2
+
+
+def same_scope(s1, s2) -> bool:
+    'Returns true if the two scopes are the same'
+    if s1.is_top_level() or s2.is_top_level():
+        return s1.is_top_level() and s2.is_top_level()
+    return len(s1) == len(s2) and s1.starts_with(s2)
@@ -11,16 +11,17 @@ set -e
 output_method="cp"
 output_dir="/results"
 input_method="filelist"
-input_file=""
+input_files=""
 compile=1
 run=1
 calib_cache="/xaod_calibration_cache"
+build_dir=""
 
-while getopts "d:o:cr" opt; do
+while getopts "d:o:b:cr" opt; do
     case "$opt" in
     d)
         input_method="cmd"
-        input_file=$OPTARG
+        input_files="$input_files $OPTARG"
         ;;
     c)
         run=0
@@ -31,6 +32,9 @@ while getopts "d:o:cr" opt; do
     o)
         output_dir=$OPTARG
         ;;
+    b)
+        build_dir=$OPTARG
+        ;;
     ?)
         exit 10
     esac
@@ -50,6 +54,14 @@ source /home/atlas/release_setup.sh
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 local=`pwd`
 
+# If we have been given a build area (which may already contain a build), work in there.
+if [ -n "$build_dir" ]; then
+   if [ ! -w $build_dir ]; then
+      sudo -i chmod a+w $build_dir
+   fi
+   cd $build_dir
+fi
+
 # Create a release directory
 if [ $compile = 1 ]; then
    mkdir rel
@@ -169,6 +181,12 @@ fi
 # Sort out the input file location
 if [ $run = 1 ]; then
    source ${AnalysisBaseExternals_PLATFORM}/setup.sh
+
+   # Run in a private directory, as several containers may be running from the same build area
+   eljob=`pwd`/../source/analysis/share/ATestRun_eljob.py
+   run_dir=`mktemp -d -p . run_XXXXXX`
+   cd $run_dir
+
    if [ "$input_method" == "filelist" ]; then
       if [ -e $DIR/filelist.txt ]; then
          cp $DIR/filelist.txt .
@@ -176,12 +194,9 @@ if [ $run = 1 ]; then
          cp $local/filelist.txt .
       fi
    elif [ "$input_method" == "cmd" ]; then
-      echo $input_file > filelist.txt
-   fi
-
-   # Do the run
-   if [ -e ./bogus ]; then
-     rm -rf bogus
+      for f in $input_files; do
+         echo $f >> filelist.txt
+      done
    fi
 
    # If there is a calibration path, lets try to use it.
@@ -193,7 +208,7 @@ if [ $run = 1 ]; then
    fi
 
    # Finally, run!
-   python ../source/analysis/share/ATestRun_eljob.py --submission-dir=bogus
+   python $eljob --submission-dir=bogus
 
    # Place the output file where it belongs
    if [ $output_method == "cp" ]; then
@@ -207,4 +222,8 @@ if [ $run = 1 ]; then
       fi
    fi
    $cmd ./bogus/data-ANALYSIS/ANALYSIS.root $destination
+
+   # Leave the build area as we found it
+   cd ..
+   rm -rf $run_dir
 fi
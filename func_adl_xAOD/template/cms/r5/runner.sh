@@ -7,7 +7,7 @@ set -x
 output_method="cp"
 output_dir="/results"
 input_method="filelist"
-input_file=""
+input_files=""
 compile=1
 run=1
 
@@ -15,7 +15,7 @@ while getopts "d:o:cr" opt; do
     case "$opt" in
     d)
         input_method="cmd"
-        input_file=$OPTARG
+        input_files="$input_files $OPTARG"
         ;;
     c)
         run=0
@@ -79,7 +79,10 @@ if [ $run = 1 ]; then
             cp $local/filelist.txt .
         fi
     elif [ "$input_method" == "cmd" ]; then
-        echo $input_file > filelist.txt
+        rm -f filelist.txt
+        for f in $input_files; do
+            echo $f >> filelist.txt
+        done
     fi
 
     # Figure out the output file
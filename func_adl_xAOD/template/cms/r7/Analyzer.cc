@@ -41,8 +41,6 @@ private:
    virtual void beginLuminosityBlock(edm::LuminosityBlock const &, edm::EventSetup const &);
    virtual void endLuminosityBlock(edm::LuminosityBlock const &, edm::EventSetup const &);
    
-   TTree *myTree;
-
    {% for l in class_decl %}
    {{l}} 
    {% endfor %}
@@ -50,6 +48,9 @@ private:
 };
 
 Analyzer::Analyzer(const edm::ParameterSet &iConfig)
+   {% for l in instance_initialization %}
+   {{ ':' if loop.first else ',' }} {{l}}
+   {%- endfor %}
 {
 
    {% for l in book_code %}
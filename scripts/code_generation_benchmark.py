@@ -0,0 +1,78 @@
+# Compare the C++ generated with and without code generation options.
+#
+#   python scripts/code_generation_benchmark.py [option ...]
+#
+# Each query is translated with the options off and then on (by default all of them). For
+# each, the number of member calls (like `->pt()`) and of vectors declared in the generated event
+# code, and the time it took to translate, are printed. The member calls that remain are the ones
+# the C++ will make, and each vector declared there is allocated again for every event (or
+# object) - running the code itself needs the ATLAS release.
+import logging
+import re
+import sys
+import tempfile
+import time
+from dataclasses import fields
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from func_adl.event_dataset import EventDataset
+from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
+from func_adl_xAOD.common.meta_data import CodeGenerationOptions
+
+# Do not time the type warnings
+logging.getLogger('func_adl_xAOD').setLevel(logging.ERROR)
+
+queries = {
+    'where-select': 'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30000.0).Select(lambda j: j.pt()/1000.0)',
+    'expression': 'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()/1000.0 + j.pt()*j.eta())',
+    'delta-r': 'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons")'
+               '.Where(lambda el: DeltaR(j.eta(), j.phi(), el.eta(), el.phi()) < 0.4)'
+               '.Select(lambda el: DeltaR(j.eta(), j.phi(), el.eta(), el.phi())).Sum())',
+    'jagged': 'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles")'
+              '.Where(lambda t: t.pt() > 1000.0).Select(lambda t: t.pt()))',
+}
+
+_member_call = re.compile(r'(->|\.)[A-Za-z_]\w*\(')
+_vector_decl = re.compile(r'^\s*std::vector<.*>\s+\w+( \(.*\))?;')
+
+
+class query_as_ast(EventDataset):
+    async def execute_result_async(self, a, title):
+        return a
+
+
+def translate(query: str, options: Dict[str, bool], n_repeats: int) -> Tuple[List[str], float]:
+    'Translate the query, and return the lines of the execute method and the time per translation'
+    ds = query_as_ast()
+    if len(options) > 0:
+        ds = ds.MetaData(dict(metadata_type='code_generation_options', **options))
+    a = ds.Select(query).value()
+
+    with tempfile.TemporaryDirectory() as d:
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            exe = atlas_xaod_executor()
+            exe.write_cpp_files(exe.apply_ast_transformations(a), Path(d))
+        elapsed = (time.perf_counter() - start) / n_repeats
+        source = (Path(d) / 'query.cxx').read_text()
+
+    body = source[source.index('query :: execute'):source.index('query :: finalize')]
+    return body.splitlines(), elapsed
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv) > 1 else [f.name for f in fields(CodeGenerationOptions)]
+    options = {n: True for n in names}
+    print(f'Options: {", ".join(names)}')
+
+    for name, q in queries.items():
+        off_lines, off_time = translate(q, {}, 20)
+        on_lines, on_time = translate(q, options, 20)
+        off_calls = sum(len(_member_call.findall(ln)) for ln in off_lines)
+        on_calls = sum(len(_member_call.findall(ln)) for ln in on_lines)
+        off_vectors = sum(1 for ln in off_lines if _vector_decl.match(ln))
+        on_vectors = sum(1 for ln in on_lines if _vector_decl.match(ln))
+        print(f'{name:>14}: member calls {off_calls} -> {on_calls}, '
+              f'vectors {off_vectors} -> {on_vectors}, '
+              f'translation {off_time * 1000:.1f} ms -> {on_time * 1000:.1f} ms')
@@ -0,0 +1,63 @@
+# Time the translation of many queries to C++ with different numbers of worker processes.
+#
+#   python scripts/translation_benchmark.py [n_queries] [max_workers]
+#
+# Each translation has its own translation context, so the scaling should be close to linear
+# until the machine runs out of cores.
+import ast
+import logging
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from func_adl import EventDataset
+from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
+
+
+# Do not time the type warnings
+logging.getLogger('func_adl_xAOD').setLevel(logging.ERROR)
+
+
+class ast_ds(EventDataset):
+    async def execute_result_async(self, a: ast.AST, title: str) -> Any:
+        return a
+
+
+queries = [
+    'lambda e: e.EventInfo("EventInfo").runNumber()',
+    'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.eta())',
+    'lambda e: (e.Electrons("Electrons").Select(lambda e: e.pt()), e.Muons("Muons").Select(lambda m: m.eta()))',
+    'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Where(lambda t: t.pt() > 1000.0).Count())',
+]
+
+
+def translate(index: int) -> int:
+    'Translate a query, return the length of the generated code'
+    a = ast_ds().Select(queries[index % len(queries)]).value()
+    exe = atlas_xaod_executor()
+    with tempfile.TemporaryDirectory() as d:
+        exe.write_cpp_files(exe.apply_ast_transformations(a), Path(d))
+        return len((Path(d) / 'query.cxx').read_text())
+
+
+def run(n_queries: int, workers: int) -> float:
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(translate, range(n_queries), chunksize=4))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    base = None
+    workers = 1
+    while workers <= max_workers:
+        t = run(n_queries, workers)
+        base = t if base is None else base
+        print(f'{workers:3d} workers: {t:7.2f} s ({n_queries / t:7.1f} queries/s, speedup {base / t:4.1f})')
+        workers *= 2
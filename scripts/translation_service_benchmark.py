@@ -0,0 +1,47 @@
+# Time requests to the translation service, the way a client would see them.
+#
+#   python scripts/translation_service_benchmark.py [n_requests]
+#
+# A service is started in this process, and each request is sent over http. The cache is
+# turned off so every request is translated.
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+from func_adl_xAOD.common.translation_service import make_server, translation_service
+
+# Do not time the type warnings
+logging.getLogger('func_adl_xAOD').setLevel(logging.ERROR)
+
+queries = [
+    "(call ResultTTree (call Select (call EventDataset 'file.root') (lambda (list e) (call (attr (call (attr e 'EventInfo') 'EventInfo') 'runNumber')))) (list 'run') 'tree' 'out.root')",
+    "(call ResultTTree (call SelectMany (call EventDataset 'file.root') (lambda (list e) (call (attr (call (attr e 'Jets') 'AntiKt4EMTopoJets') 'Select') (lambda (list j) (call (attr j 'pt')))))) (list 'pt') 'tree' 'out.root')",
+    "(call ResultTTree (call SelectMany (call EventDataset 'file.root') (lambda (list e) (call (attr (call (attr (call (attr e 'Jets') 'AntiKt4EMTopoJets') 'Where') (lambda (list j) (> (call (attr j 'pt')) 30.0))) 'Select') (lambda (list j) (call (attr j 'eta')))))) (list 'eta') 'tree' 'out.root')",
+]
+
+
+def request(url: str, query: str) -> float:
+    start = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, data=query.encode('utf-8'))) as r:
+        json.loads(r.read())
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    start = time.perf_counter()
+    server = make_server(translation_service(max_cached_queries=0))
+    print(f'Service start up: {(time.perf_counter() - start) * 1000:.0f} ms')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://{server.server_address[0]}:{server.server_address[1]}/translate/atlas_xaod'
+
+    times = sorted(request(url, queries[i % len(queries)]) for i in range(n_requests))
+    p50 = statistics.median(times)
+    p95 = times[int(0.95 * (len(times) - 1))]
+    print(f'{n_requests} requests: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms')
+    server.shutdown()
@@ -0,0 +1,47 @@
+#ifndef analysis_query_H
+#define analysis_query_H
+
+#include <AnaAlgorithm/AnaAlgorithm.h>
+
+
+#include "vector"
+
+#include "AthContainers/AuxElement.h"
+
+
+
+class query : public EL::AnaAlgorithm
+{
+public:
+  // this is a standard algorithm constructor
+  query (const std::string& name, ISvcLocator* pSvcLocator);
+
+  // these are the functions inherited from Algorithm
+  virtual StatusCode initialize () override;
+  virtual StatusCode execute () override;
+  virtual StatusCode finalize () override;
+
+private:
+  // Class level variables
+
+  
+  SG::AuxElement::ConstAccessor<float> _moment_accessor3;
+
+  
+  SG::AuxElement::ConstAccessor<float> _moment_accessor5;
+
+  
+  float _jvt6;
+
+  
+  float _emf7;
+
+  
+  TTree* _tree8;
+
+  
+
+  
+};
+
+#endif
\ No newline at end of file
@@ -1,3 +1,5 @@
+import ast
+
 from tests.utils.locators import find_line_with
 from tests.utils.general import get_lines_of_code, print_lines
 import pytest
@@ -12,8 +14,15 @@ def test_get_attribute_float():
     # Check to see if there mention of push_back anywhere.
     lines = get_lines_of_code(r)
     print_lines(lines)
-    l_attribute = find_line_with("getAttribute<", lines)
-    assert 'getAttribute<float>("emf")' in lines[l_attribute]
+
+    # The moment is looked up once, by an accessor set up in the constructor
+    init = r.QueryVisitor.instance_initialization()
+    assert len(init) == 1
+    assert init[0].endswith('("emf")')
+    accessor = init[0].split('(')[0]
+    assert any(ln.strip().startswith('SG::AuxElement::ConstAccessor<float> ') for ln in r.QueryVisitor.class_declaration_code())
+    l_attribute = find_line_with(f"{accessor}(*", lines)
+    assert 'getAttribute' not in lines[l_attribute]
 
 
 def test_get_attribute_float_wrong_args():
@@ -34,8 +43,67 @@ def test_get_attribute_vector_float():
     # Check to see if there mention of push_back anywhere.
     lines = get_lines_of_code(r)
     print_lines(lines)
-    l_attribute = find_line_with("getAttribute<", lines)
-    assert 'getAttribute<std::vector<double>>("emf")' in lines[l_attribute]
+
+    init = r.QueryVisitor.instance_initialization()
+    assert len(init) == 1
+    accessor = init[0].split('(')[0]
+    assert any(ln.strip().startswith('SG::AuxElement::ConstAccessor<std::vector<double>> ') for ln in r.QueryVisitor.class_declaration_code())
+    find_line_with(f"{accessor}(*", lines)
+
+
+def test_get_attribute_vector_float_not_copied():
+    'The moment is read from the aux store by reference, and only copied into the output'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.getAttributeVectorFloat("emf"))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_decl = find_line_with("const std::vector<double>* getAttributeFloat", lines)
+    attr = lines[l_decl].strip().split(' ')[-1][:-1]
+    find_line_with("const auto &result = ", lines)
+    find_line_with(f"{attr} = &result;", lines)
+    find_line_with(f"push_back(*{attr});", lines)
+
+
+def test_get_attribute_float_accessor_shared():
+    'Each moment name gets one accessor, no matter how many times it is used'
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.getAttributeFloat("emf"), j.getAttributeFloat("emf")*2, j.getAttributeFloat("JVT"))') \
+        .value()
+
+    init = r.QueryVisitor.instance_initialization()
+    print(init)
+    assert len(init) == 2
+    assert init[0].endswith('("emf")')
+    assert init[1].endswith('("JVT")')
+    assert 'AthContainers/AuxElement.h' in r.QueryVisitor.header_include_files()
+
+
+def test_get_attribute_float_not_constant():
+    'The accessor is made in the constructor, so the moment name must be known then'
+    with pytest.raises(ValueError) as e:
+        atlas_xaod_dataset() \
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+            .Select('lambda j: j.getAttributeFloat(j.name())') \
+            .value()
+
+    assert 'constant' in str(e.value)
+
+
+def test_get_attribute_float_str_node():
+    'Before python 3.8 the moment name is parsed as an `ast.Str`, which is still a constant'
+    select = ast.parse('lambda j: j.getAttributeFloat("JVT")').body[0].value  # type: ignore
+    select.body.args = [ast.Str(s='JVT')]
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select(select) \
+        .value()
+
+    init = r.QueryVisitor.instance_initialization()
+    assert len(init) == 1
+    assert init[0].endswith('("JVT")')
 
 
 def test_get_attribute():
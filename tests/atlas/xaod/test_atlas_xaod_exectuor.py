@@ -1,4 +1,9 @@
 import ast
+import os
+import random
+import re
+from pathlib import Path
+from typing import Union
 
 import pytest
 from func_adl.event_dataset import EventDataset
@@ -29,6 +34,27 @@ def test_xaod_executor(tmp_path):
         assert (tmp_path / name).exists()
 
 
+def test_xaod_executor_timings(tmp_path):
+    'Each phase of the translation is timed'
+    a = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .value()
+
+    exe = atlas_xaod_executor()
+    f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+
+    phases = f_spec.timings.as_dict()
+    assert list(phases.keys()) == ['extract_metadata', 'change_extension_functions_to_calls',
+                                   'simplify_chained_calls', 'push_down_filters',
+                                   'find_known_functions', 'cpp_ast_finder', 'query_ast_visitor',
+                                   'emit', 'render_templates']
+    assert all(p['count'] == 1 for p in phases.values())
+
+    # The next query starts with a clean slate
+    assert exe.timings is not f_spec.timings
+    assert len(exe.timings.phases) == 0
+
+
 def test_xaod_library_there(tmp_path):
     'Make sure a required library is in the link list'
     # Get the ast to play with
@@ -138,3 +164,219 @@ def test_md_replaced_collection(tmp_path):
     query = tmp_path / 'query.cxx'
     assert query.exists()
     assert 'const xAOD::EventInfo_v1 *' in query.read_text()
+
+
+def _translate(query: Union[str, ast.AST], output_dir: Path) -> str:
+    'Translate the query (text or an already built ast) and return the generated source'
+    a = query_as_ast() \
+        .Select(query) \
+        .value() if isinstance(query, str) else query
+
+    output_dir.mkdir()
+    exe = atlas_xaod_executor()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), output_dir)
+    return (output_dir / 'query.cxx').read_text() + (output_dir / 'query.h').read_text()
+
+
+def test_generated_code_is_deterministic(tmp_path):
+    'The same query should generate identical code no matter what was translated before it'
+    query = 'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.eta())'
+    others = [
+        'lambda e: e.EventInfo("EventInfo").runNumber()',
+        'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()*2).Count()',
+        'lambda e: (e.Electrons("Electrons").Select(lambda e: e.pt()), e.Muons("Muons").Select(lambda m: m.eta()))',
+    ]
+
+    rnd = random.Random(42)
+    generated = set()
+    for i in range(100):
+        for j in range(rnd.randint(0, 3)):
+            _translate(rnd.choice(others), tmp_path / f'other_{i}_{j}')
+        generated.add(_translate(query, tmp_path / f'query_{i}'))
+
+    assert len(generated) == 1
+
+
+def test_translate_in_threads(tmp_path):
+    'Translating many queries at once should give the same code as one-by-one'
+    from concurrent.futures import ThreadPoolExecutor
+
+    queries = [
+        'lambda e: e.EventInfo("EventInfo").runNumber()',
+        'lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.eta())',
+        'lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()*2).Count()',
+    ] * 10
+
+    # Build the asts up front: python's `ast.parse`, which func_adl uses to build them, is not
+    # safe to call from several threads at once in some python versions.
+    queries = [query_as_ast().Select(q).value() for q in queries]
+
+    serial = [_translate(q, tmp_path / f'serial_{i}') for i, q in enumerate(queries)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        parallel = list(pool.map(lambda iq: _translate(iq[1], tmp_path / f'parallel_{iq[0]}'), enumerate(queries)))
+
+    assert serial == parallel
+
+
+def test_translate_same_ast_twice(tmp_path):
+    'The ast we are handed should not be altered by the translation'
+    a = query_as_ast() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .value()
+    a_text = ast.dump(a)
+
+    exe = atlas_xaod_executor()
+    (tmp_path / 'one').mkdir()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'one')
+    (tmp_path / 'two').mkdir()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path / 'two')
+
+    assert ast.dump(a) == a_text
+    assert (tmp_path / 'one' / 'query.cxx').read_text() == (tmp_path / 'two' / 'query.cxx').read_text()
+
+
+def test_multi_query_one_event_loop(tmp_path):
+    'Several queries run in a single execute, each to its own tree, sharing the jet retrieval'
+    q1 = query_as_ast() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .value()
+    q2 = query_as_ast() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta())') \
+        .value()
+    q3 = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .value()
+
+    exe = atlas_xaod_executor()
+    f_specs = exe.write_cpp_files_multi([exe.apply_ast_transformations(q) for q in [q1, q2, q3]], tmp_path)
+
+    assert [f.result_rep.treename for f in f_specs] == ['atlas_xaod_tree', 'atlas_xaod_tree_1', 'atlas_xaod_tree_2']
+    assert all(f.result_rep.filename == 'ANALYSIS.root' for f in f_specs)
+
+    query = (tmp_path / 'query.cxx').read_text()
+    assert query.count('StatusCode query :: execute ()') == 1
+    assert query.count('"AntiKt4EMTopoJets"') == 1
+    for name in ['atlas_xaod_tree', 'atlas_xaod_tree_1', 'atlas_xaod_tree_2']:
+        assert f'book (TTree ("{name}"' in query
+    assert query.count('tree (') == 3
+    assert len(re.findall(r'_tree[0-9]+->Fill\(\);', query)) == 3
+
+
+def test_multi_query_same_tree(tmp_path):
+    'Two queries can not write to the same tree'
+    q1 = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .AsROOTTTree('junk.root', 'my_tree', ['run']) \
+        .value()
+    q2 = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").eventNumber()') \
+        .AsROOTTTree('junk.root', 'my_tree', ['event']) \
+        .value()
+
+    exe = atlas_xaod_executor()
+    with pytest.raises(ValueError) as e:
+        exe.write_cpp_files_multi([exe.apply_ast_transformations(q) for q in [q1, q2]], tmp_path)
+
+    assert 'my_tree' in str(e.value)
+
+
+def test_multi_query_no_queries(tmp_path):
+    exe = atlas_xaod_executor()
+    with pytest.raises(ValueError):
+        exe.write_cpp_files_multi([], tmp_path)
+
+
+_golden_dir = Path(__file__).parent / 'golden'
+
+
+def _check_golden(name: str, generated: str):
+    '''Compare generated code to the file `name` in the golden directory. If the code generation
+    is meant to change, set `FUNC_ADL_UPDATE_GOLDEN=1` to re-write the golden files (and
+    check the differences before committing them).
+    '''
+    golden = _golden_dir / name
+    if os.environ.get('FUNC_ADL_UPDATE_GOLDEN') == '1':
+        golden.write_text(generated)
+    assert generated == golden.read_text()
+
+
+def test_collection_retrieved_once(tmp_path):
+    'A collection used in several places (including inside other loops) is retrieved once per event'
+    query = _translate('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Count()), '
+                       'e.Electrons("Electrons").Select(lambda el: el.pt()), '
+                       'e.Muons("Muons").Where(lambda m: e.Electrons("Electrons").Count() > 1).Select(lambda m: m.pt()))',
+                       tmp_path / 'q')
+
+    assert query.count('retrieve(') == 3
+    assert query.count('retrieve(result, "Electrons")') == 1
+    assert query.index('retrieve(result, "Electrons")') < query.index('for (auto ')
+
+
+def test_collection_retrieved_once_str_nodes(tmp_path):
+    'Before python 3.8 collection names are parsed as `ast.Str`, and must still be retrieved once'
+    class as_str(ast.NodeTransformer):
+        def visit_Constant(self, node):
+            return ast.Str(s=node.value) if isinstance(node.value, str) else node
+
+    select = as_str().visit(ast.parse('lambda e: (e.Electrons("Electrons").Select(lambda el: el.pt()), '
+                                      'e.Electrons("Electrons").Count())').body[0].value)  # type: ignore
+    query = _translate(query_as_ast().Select(select).value(), tmp_path / 'q')
+
+    assert query.count('retrieve(result, "Electrons")') == 1
+
+
+def test_code_generation_options(tmp_path):
+    'Options asked for in the metadata change the generated code'
+    a = query_as_ast() \
+        .MetaData({'metadata_type': 'code_generation_options', 'common_subexpression_elimination': True}) \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.pt())') \
+        .value()
+    exe = atlas_xaod_executor()
+    a = exe.apply_ast_transformations(a)
+    assert exe.code_options.common_subexpression_elimination
+    exe.write_cpp_files(a, tmp_path)
+
+    query = (tmp_path / 'query.cxx').read_text()
+    assert query.count('->pt()') == 1
+    assert not exe.code_options.common_subexpression_elimination
+
+
+def test_golden_select(tmp_path):
+    'An event level ntuple'
+    a = query_as_ast() \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .AsROOTTTree('junk.root', 'events', ['run']) \
+        .value()
+    exe = atlas_xaod_executor()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+
+    _check_golden('select_query.cxx', (tmp_path / 'query.cxx').read_text())
+    _check_golden('select_query.h', (tmp_path / 'query.h').read_text())
+
+
+def test_golden_select_many(tmp_path):
+    'An object level ntuple, filled in the jet loop through the cached tree pointer'
+    a = query_as_ast() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.pt(), j.eta())') \
+        .AsROOTTTree('junk.root', 'jets', ['pt', 'eta']) \
+        .value()
+    exe = atlas_xaod_executor()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+
+    _check_golden('select_many_query.cxx', (tmp_path / 'query.cxx').read_text())
+    _check_golden('select_many_query.h', (tmp_path / 'query.h').read_text())
+
+
+def test_golden_jet_moment(tmp_path):
+    'Jet moments are read through accessors made once in the constructor'
+    a = query_as_ast() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.getAttributeFloat("JVT"), j.getAttributeFloat("EMFrac"))') \
+        .AsROOTTTree('junk.root', 'jets', ['jvt', 'emf']) \
+        .value()
+    exe = atlas_xaod_executor()
+    exe.write_cpp_files(exe.apply_ast_transformations(a), tmp_path)
+
+    _check_golden('jet_moment_query.cxx', (tmp_path / 'query.cxx').read_text())
+    _check_golden('jet_moment_query.h', (tmp_path / 'query.h').read_text())
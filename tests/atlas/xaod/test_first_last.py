@@ -1,9 +1,11 @@
 # Code to do the testing starts here.
-from tests.utils.locators import find_line_with, find_open_blocks  # type: ignore
+from tests.utils.locators import find_line_numbers_with, find_line_with, find_open_blocks  # type: ignore
 from tests.utils.general import get_lines_of_code, print_lines  # type: ignore
 from tests.atlas.xaod.utils import atlas_xaod_dataset  # type: ignore
 import re
 
+import pytest
+
 
 def test_first_jet_in_event():
     atlas_xaod_dataset() \
@@ -51,13 +53,14 @@ def test_First_Of_Select_is_not_array():
     assert all("push_back" not in ln for ln in lines)
     l_fill = find_line_with("Fill()", lines)
     active_blocks = find_open_blocks(lines[:l_fill])
-    assert 3 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
+    assert 2 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
     l_set = find_line_with("_FirstJetPt", lines)
     active_blocks = find_open_blocks(lines[:l_set])
-    assert 3 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
-    l_true = find_line_with("(true)", lines)
-    active_blocks = find_open_blocks(lines[:l_true])
-    assert 0 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
+    assert 2 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
+    l_break = find_line_with("break;", lines)
+    assert l_break > l_fill
+    active_blocks = find_open_blocks(lines[:l_break])
+    assert 2 == [(("for" in a) or ("if" in a)) for a in active_blocks].count(True)
 
 
 def test_First_Of_Select_After_Where_is_in_right_place():
@@ -68,8 +71,8 @@ def test_First_Of_Select_After_Where_is_in_right_place():
     lines = get_lines_of_code(r)
     print_lines(lines)
     ln = find_line_with(">10.0", lines)
-    # Look for the "false" that First uses to remember it has gone by one.
-    assert find_line_with("false", lines[ln:], throw_if_not_found=False) > 0
+    # Look for the "break" that First uses to stop once it has found one.
+    assert find_line_with("break;", lines[ln:], throw_if_not_found=False) > 0
 
 
 def test_First_with_dict():
@@ -94,3 +97,107 @@ def test_First_with_dict():
     assert l_eta_r is not None
 
     assert l_pt_r[1] == l_eta_r[1]
+
+
+def test_First_no_loop():
+    'With nothing to skip over, the first jet is used directly'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").First().pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert all("for (" not in ln for ln in lines)
+    l_test = find_line_with(".empty()", lines)
+    assert find_line_with(".front()", lines) == l_test + 2
+    l_pt = find_line_with("->pt()", lines)
+    assert len([a for a in find_open_blocks(lines[:l_pt]) if "if" in a]) == 1
+
+
+def test_First_in_shared_loop():
+    'A loop that is filling another column can not be stopped early'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()), e.Jets("AntiKt4EMTopoJets").First().pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert all("break;" not in ln for ln in lines)
+    assert find_line_with("is_first", lines, throw_if_not_found=False) >= 0
+
+
+def test_First_in_event_filter():
+    'Code that depends on the first item is run before the loop stops'
+    r = atlas_xaod_dataset() \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10).First().pt() > 50') \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_loops = find_line_numbers_with("for (", lines)
+    assert len(l_loops) == 2
+    l_break = find_line_with("break;", lines)
+    assert l_loops[1] < find_line_with("->eta()", lines) < l_break
+    assert len(find_open_blocks(lines[:l_loops[1]])) == 5
+
+
+def test_FirstOrDefault_value():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10).Select(lambda j: j.eta()).FirstOrDefault()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_decl = find_line_with("double first", lines)
+    assert re.search(r'double (first[0-9]+) \(0\);', lines[l_decl])
+    first_var = re.search(r'double (first[0-9]+)', lines[l_decl])[1]  # type: ignore
+    l_set = find_line_with(f"{first_var} = i_obj", lines)
+    assert "break;" in lines[l_set + 1]
+
+    # The value is written out for every event, even if there are no jets
+    l_fill = find_line_with("Fill()", lines)
+    assert len([a for a in find_open_blocks(lines[:l_fill]) if "for" in a or "if" in a]) == 0
+
+
+def test_FirstOrDefault_object():
+    'The object is null if there are no jets, so it can not be used'
+    with pytest.raises(ValueError) as e:
+        atlas_xaod_dataset() \
+            .Select('lambda e: e.Jets("AntiKt4EMTopoJets").FirstOrDefault()') \
+            .Select('lambda j: j.pt()') \
+            .value()
+
+    assert "FirstOrDefault" in str(e.value)
+    assert "pt" in str(e.value)
+
+
+def test_FirstOrDefault_object_cpp_method():
+    with pytest.raises(ValueError) as e:
+        atlas_xaod_dataset() \
+            .Select('lambda e: e.Jets("AntiKt4EMTopoJets").FirstOrDefault()') \
+            .Select('lambda j: j.getAttributeFloat("emf")') \
+            .value()
+
+    assert "FirstOrDefault" in str(e.value)
+
+
+def test_FirstOrDefault_object_value_selected():
+    'Selecting the value before FirstOrDefault gives a default of 0 rather than a null object'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()).FirstOrDefault()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert find_line_with("double first", lines, throw_if_not_found=False) >= 0
+    assert find_line_with("nullptr", lines, throw_if_not_found=False) < 0
+
+
+def test_FirstOrDefault_of_sequences():
+    with pytest.raises(ValueError) as e:
+        atlas_xaod_dataset() \
+            .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InnerTracks")).FirstOrDefault()') \
+            .value()
+
+    assert "FirstOrDefault" in str(e.value)
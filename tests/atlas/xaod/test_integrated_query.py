@@ -290,3 +290,19 @@ def test_2D_nested_where():
     a = training_df['col1']
     assert len(a) == 10
     assert len(a[0]) == 1  # type: ignore
+
+
+def test_loop_invariant_code_motion_same_result():
+    'Moving the jet eta and phi out of the truth particle loop must not change the numbers'
+    def query(ds):
+        return ds.Select(lambda e: e.Jets("AntiKt4EMTopoJets")
+                         .Select(lambda j: e.TruthParticles("TruthParticles")
+                                 .Where(lambda tp: tp.pdgId() == 11)
+                                 .Select(lambda tp: DeltaR(j.eta(), j.phi(), tp.eta(), tp.phi()))
+                                 .Sum()))
+
+    plain = as_awkward(query(f_single))
+    moved = as_awkward(query(f_single.MetaData({'metadata_type': 'code_generation_options',
+                                                'loop_invariant_code_motion': True})))
+
+    assert plain['col1'].tolist() == moved['col1'].tolist()
@@ -1,4 +1,7 @@
+import asyncio
+import sys
 import tempfile
+import time
 from pathlib import Path
 
 import pytest
@@ -161,3 +164,479 @@ def test_alternate_dir(docker_mock):
              .value())
 
         assert str(r[0]).startswith(str(tmpdir))
+
+
+def test_build_cache_miss_then_hit(docker_mock, tmp_path):
+    'The second time an identical query is run we should skip the compile'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+
+    bc = build_cache(tmp_path / 'cache')
+    docker_mock.volume.exists.return_value = False
+
+    def run_query():
+        return (xAODDataset(f_location, build_cache=bc)
+                .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+                .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+                .value())
+
+    run_query()
+    run_query()
+
+    assert docker_mock.run.call_count == 2
+    first_args = docker_mock.run.call_args_list[0][0][1]
+    second_args = docker_mock.run.call_args_list[1][0][1]
+    assert '-r' not in first_args
+    assert '-r' in second_args
+    assert '-b' in first_args and '-b' in second_args
+
+    first_volumes = [v[0] for v in docker_mock.run.call_args_list[0][1]['volumes']]
+    second_volumes = [v[0] for v in docker_mock.run.call_args_list[1][1]['volumes']]
+    build_volumes = [v for v in first_volumes if str(v).startswith('func_adl_build_')]
+    assert len(build_volumes) == 1
+    assert build_volumes[0] in second_volumes
+
+
+def test_build_cache_docker_calls_off_event_loop(docker_mock, tmp_path):
+    'The docker volume calls block, so they are not made on the event loop thread'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+
+    bc = build_cache(tmp_path / 'cache', max_builds=1)
+    bc.mark_used('deadbeef')
+    on_loop = []
+
+    def record(*args):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return True
+
+    docker_mock.volume.exists.side_effect = record
+    docker_mock.volume.remove.side_effect = record
+
+    (xAODDataset(f_location, build_cache=bc)
+     .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+     .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+     .value())
+
+    # A left over volume for this build, and the evicted build, are removed
+    assert on_loop == [False, False, False]
+
+
+def test_build_cache_concurrent_identical_queries(docker_mock, tmp_path):
+    'Two identical queries run at once build once - the second waits and re-uses the build'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+
+    bc = build_cache(tmp_path / 'cache')
+    docker_mock.volume.exists.return_value = False
+    good_run = docker_mock.run.side_effect
+
+    def slow_run(*args, **kwargs):
+        time.sleep(0.5)
+        return good_run(*args, **kwargs)
+
+    docker_mock.run.side_effect = slow_run
+
+    def query(i):
+        out = tmp_path / f'out_{i}'
+        out.mkdir()
+        return (xAODDataset(f_location, build_cache=bc, output_directory=out)
+                .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+                .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+                .value_async())
+
+    async def run_both():
+        return await asyncio.gather(query(0), query(1))
+
+    asyncio.run(run_both())
+
+    runs = [c[0][1] for c in docker_mock.run.call_args_list]
+    assert len(runs) == 2
+    assert sorted('-r' in r for r in runs) == [False, True]
+
+
+def test_build_cache_failure_forgets(docker_mock_fail, tmp_path):
+    'A failed run should not leave a build marked as good'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+    from python_on_whales.exceptions import DockerException
+
+    bc = build_cache(tmp_path / 'cache')
+    with pytest.raises(DockerException):
+        (xAODDataset(f_location, build_cache=bc)
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    assert not (tmp_path / 'cache' / 'build_cache.json').exists() \
+        or (tmp_path / 'cache' / 'build_cache.json').read_text() == '{}'
+
+
+def test_build_cache_eviction_removes_volume(docker_mock, tmp_path):
+    'When the cache is full, the old build volume should be removed'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+
+    bc = build_cache(tmp_path / 'cache', max_builds=1)
+    bc.mark_used('deadbeef')
+    docker_mock.volume.exists.return_value = False
+
+    (xAODDataset(f_location, build_cache=bc)
+     .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+     .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+     .value())
+
+    docker_mock.volume.remove.assert_called_with(bc.volume_name('deadbeef'))
+
+
+def _make_files(directory: Path, sizes):
+    'Make some fake input files of the given sizes'
+    files = []
+    for i, size in enumerate(sizes):
+        f = directory / f'file_{i}.root'
+        f.write_bytes(b'\0' * size)
+        files.append(f)
+    return files
+
+
+def test_balance_files(tmp_path):
+    'Files should be split by size, not by count'
+    from func_adl_xAOD.common.local_dataset import _balance_files
+
+    files = _make_files(tmp_path, [100, 10, 10, 10, 10, 10, 40])
+    groups = _balance_files(files, 2)
+
+    assert len(groups) == 2
+    assert sorted(f for g in groups for f in g) == sorted(files)
+    totals = sorted(sum(f.stat().st_size for f in g) for g in groups)
+    assert totals == [90, 100]
+
+
+def test_balance_files_more_workers_than_files(tmp_path):
+    from func_adl_xAOD.common.local_dataset import _balance_files
+
+    files = _make_files(tmp_path, [10, 20])
+    groups = _balance_files(files, 8)
+    assert sorted(len(g) for g in groups) == [1, 1]
+
+
+def test_parallel_run(docker_mock, tmp_path):
+    'With several workers, compile once, and then run each group of files from that build'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+
+    files = _make_files(tmp_path, [30, 20, 10])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    r = (xAODDataset(files, max_workers=2, output_directory=output_dir)
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    assert sorted(p.name for p in r) == ['ANALYSIS_part0.root', 'ANALYSIS_part1.root']
+    assert all(p.exists() for p in r)
+
+    calls = docker_mock.run.call_args_list
+    assert len(calls) == 3
+    compile_args = calls[0][0][1]
+    assert '-c' in compile_args and '-b' in compile_args
+
+    run_args = [c[0][1] for c in calls[1:]]
+    assert all('-r' in a and '-b' in a for a in run_args)
+    assert sorted(a.count('-d') for a in run_args) == [1, 2]
+    assert sorted(x for a in run_args for x in a if x.startswith('/data/')) == [f'/data/{f.name}' for f in files]
+
+    # Everyone uses the same build volume, and it is removed when done.
+    build_volumes = {v[0] for c in calls for v in c[1]['volumes'] if v[1] == '/func_adl_build'}
+    assert len(build_volumes) == 1
+    docker_mock.volume.remove.assert_called_with(build_volumes.pop())
+
+
+def test_parallel_run_build_cache(docker_mock, tmp_path):
+    'A cached build is used by all workers, and not removed'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.build_cache import build_cache
+
+    bc = build_cache(tmp_path / 'cache')
+    docker_mock.volume.exists.return_value = False
+    files = _make_files(tmp_path, [30, 20])
+
+    def run_query():
+        return (xAODDataset(files, max_workers=2, build_cache=bc)
+                .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+                .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+                .value())
+
+    run_query()
+    assert docker_mock.run.call_count == 3
+    run_query()
+    assert docker_mock.run.call_count == 5
+    assert not any('-c' in c[0][1] for c in docker_mock.run.call_args_list[3:])
+    docker_mock.volume.remove.assert_not_called()
+
+
+def test_parallel_run_failure(docker_mock, tmp_path):
+    'If one of the workers fails, the error is passed on'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from python_on_whales.exceptions import DockerException
+
+    good_run = docker_mock.run.side_effect
+
+    def fail_on_second_file(*args, **kwargs):
+        if '/data/file_1.root' in args[1]:
+            raise DockerException(['docker command failed'], 125)
+        return good_run(*args, **kwargs)
+
+    docker_mock.run.side_effect = fail_on_second_file
+    files = _make_files(tmp_path, [30, 20])
+    with pytest.raises(DockerException):
+        (xAODDataset(files, max_workers=2)
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    # The temporary build area should still be cleaned up.
+    assert docker_mock.volume.remove.call_count == 1
+
+
+def test_bad_max_workers():
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    with pytest.raises(ValueError):
+        xAODDataset(f_location, max_workers=0)
+
+
+_fake_docker_script = """#!{python}
+# Stand in for the docker command line: sleeps rather than running a query.
+import json, os, pathlib, signal, sys, time
+state = pathlib.Path({state!r})
+args = sys.argv[1:]
+if args[:2] == ['image', 'inspect']:
+    print(json.dumps([{{"Id": "sha256:0"}}]))
+elif args[:2] == ['container', 'run']:
+    name = args[args.index('--name') + 1]
+    if (state / 'start_delay').exists():
+        time.sleep(float((state / 'start_delay').read_text()))
+    (state / name).write_text(str(os.getpid()))
+    volumes = [args[i + 1].split(':') for i, a in enumerate(args) if a == '--volume']
+    results = [v[0] for v in volumes if v[1] == '/results'][0]
+    print('running', flush=True)
+    sleeps = [state / f'sleep_{{pathlib.Path(args[i + 1]).name}}' for i, a in enumerate(args) if a == '-d']
+    sleeps = [f for f in sleeps if f.exists()] or [state / 'sleep']
+    time.sleep(max(float(f.read_text()) for f in sleeps))
+    (pathlib.Path(results) / 'ANALYSIS.root').touch()
+elif args[:2] == ['container', 'kill']:
+    if not (state / args[2]).exists():
+        print(f'No such container: {{args[2]}}', file=sys.stderr)
+        sys.exit(1)
+    (state / f'killed_{{args[2]}}').touch()
+    os.kill(int((state / args[2]).read_text()), signal.SIGTERM)
+"""
+
+
+@pytest.fixture()
+def fake_docker(mocker, tmp_path):
+    '''Use a stand-in docker command line. Returns a function to set how many seconds
+    each container runs for, and the directory it keeps its state in.'''
+    from python_on_whales import DockerClient
+
+    state = tmp_path / 'docker_state'
+    state.mkdir()
+    script = tmp_path / 'docker'
+    script.write_text(_fake_docker_script.format(python=sys.executable, state=str(state)))
+    script.chmod(0o755)
+    mocker.patch('func_adl_xAOD.common.local_dataset.docker', DockerClient(client_call=[str(script)]))
+
+    def set_run_time(seconds: float, **file_seconds: float):
+        'Set the run time for all containers, or for those running a given input file'
+        (state / 'sleep').write_text(str(seconds))
+        for name, t in file_seconds.items():
+            (state / f'sleep_{name}.root').write_text(str(t))
+        return state
+
+    return set_run_time
+
+
+def test_concurrent_queries_run_together(fake_docker, tmp_path):
+    '10 queries run at once should take about as long as one'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    run_time = 2.0
+    fake_docker(run_time)
+
+    def query(i):
+        out = tmp_path / f'out_{i}'
+        out.mkdir()
+        return (xAODDataset(f_location, output_directory=out)
+                .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+                .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+                .value_async())
+
+    async def run_all():
+        return await asyncio.gather(*[query(i) for i in range(10)])
+
+    start = time.time()
+    results = asyncio.run(run_all())
+    elapsed = time.time() - start
+
+    assert all(r[0].exists() for r in results)
+    assert elapsed < 3 * run_time
+
+
+def test_query_timeout(fake_docker):
+    'A query that takes too long is stopped, and its container killed'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    state = fake_docker(60)
+
+    start = time.time()
+    with pytest.raises(asyncio.TimeoutError):
+        (xAODDataset(f_location, timeout=1.0)
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    assert time.time() - start < 30
+    assert len(list(state.glob('killed_*'))) == 1
+
+
+def test_query_cancel(fake_docker):
+    'Cancelling a running query kills its container'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    state = fake_docker(60)
+
+    async def run_and_cancel():
+        task = asyncio.ensure_future(
+            xAODDataset(f_location)
+            .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+            .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+            .value_async())
+        while len(list(state.glob('func_adl_*'))) == 0:
+            await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(run_and_cancel(), 30))
+    assert len(list(state.glob('killed_*'))) == 1
+
+
+def test_query_cancel_before_container_starts(fake_docker):
+    'A container that is still starting up when the query is cancelled is killed once it is up'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    state = fake_docker(60)
+    (state / 'start_delay').write_text('1.0')
+
+    async def run_and_cancel():
+        task = asyncio.ensure_future(
+            xAODDataset(f_location)
+            .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+            .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+            .value_async())
+        await asyncio.sleep(0.3)
+        assert len(list(state.glob('func_adl_*'))) == 0
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.time()
+    asyncio.run(asyncio.wait_for(run_and_cancel(), 30))
+    assert time.time() - start < 30
+    assert len(list(state.glob('killed_*'))) == 1
+
+
+def test_iterate_results(fake_docker, tmp_path):
+    'Results from each file should come back as soon as that file is done'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    fake_docker(0.1, file_0=4.0, file_1=0.5, file_2=0.5)
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    files = _make_files(data_dir, [30, 20, 10])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+
+    ds = xAODDataset(files, max_workers=3, output_directory=output_dir)
+    query = ds.Select(lambda e: e.EventInfo("EventInfo").runNumber()) \
+        .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+
+    async def collect():
+        start = time.time()
+        arrivals = []
+        async for f in ds.iterate_results_async(query):
+            arrivals.append((time.time() - start, f))
+        return arrivals
+
+    arrivals = asyncio.run(collect())
+
+    assert len(arrivals) == 3
+    assert all(f.exists() for _, f in arrivals)
+    assert len({f for _, f in arrivals}) == 3
+
+    # The slow file finishes last, well after the others are available.
+    assert arrivals[-1][1].name == 'ANALYSIS_part0.root'
+    assert arrivals[0][0] < arrivals[-1][0] - 2.0
+
+
+def test_iterate_results_failure(docker_mock, tmp_path):
+    'A failed part raises, after which nothing more is returned'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from python_on_whales.exceptions import DockerException
+
+    good_run = docker_mock.run.side_effect
+
+    def fail_on_file(*args, **kwargs):
+        if '/data/file_1.root' in args[1]:
+            raise DockerException(['docker command failed'], 125)
+        return good_run(*args, **kwargs)
+
+    docker_mock.run.side_effect = fail_on_file
+    files = _make_files(tmp_path, [30, 20])
+    ds = xAODDataset(files)
+    query = ds.Select(lambda e: e.EventInfo("EventInfo").runNumber()) \
+        .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+
+    async def collect():
+        return [f async for f in ds.iterate_results_async(query)]
+
+    with pytest.raises(DockerException):
+        asyncio.run(collect())
+
+
+def test_run_timings(docker_mock):
+    'The result carries the time of each translation and run phase'
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    r = (xAODDataset(f_location)
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    phases = r.timings.as_dict()
+    for name in ['extract_metadata', 'simplify_chained_calls', 'cpp_ast_finder', 'query_ast_visitor',
+                 'emit', 'render_templates', 'container_run', 'extract_result']:
+        assert phases[name]['count'] == 1
+        assert phases[name]['wall'] >= 0.0
+
+
+def test_parallel_run_timings_exported(docker_mock, tmp_path):
+    'Each compile and run is exported as a span'
+    import json
+    from func_adl_xAOD.atlas.xaod import xAODDataset
+    from func_adl_xAOD.common.timing import jsonl_span_exporter
+
+    files = _make_files(tmp_path, [30, 20, 10])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    spans_file = tmp_path / 'spans.jsonl'
+    r = (xAODDataset(files, max_workers=2, output_directory=output_dir, span_exporter=jsonl_span_exporter(spans_file))
+         .Select(lambda e: e.EventInfo("EventInfo").runNumber())
+         .AsROOTTTree('junk.root', 'my_tree', ['eventNumber'])
+         .value())
+
+    assert r.timings.as_dict()['container_compile']['count'] == 1
+    assert r.timings.as_dict()['container_run']['count'] == 2
+
+    spans = [json.loads(ln) for ln in spans_file.read_text().splitlines()]
+    assert len({s['trace_id'] for s in spans}) == 1
+    runs = [s for s in spans if s['name'] == 'func_adl_xAOD.container_run']
+    assert sorted(s['attributes']['part'] for s in runs) == [0, 1]
+    assert all(not s['attributes']['compile'] for s in runs)
@@ -1,5 +1,5 @@
 from tests.utils.locators import find_line_numbers_with, find_line_with, find_next_closing_bracket, find_open_blocks
-from tests.utils.general import get_lines_of_code, print_lines
+from tests.utils.general import get_lines_of_book_code, get_lines_of_code, print_lines
 from tests.atlas.xaod.utils import atlas_xaod_dataset
 
 # Test out various things connected to the Aggregate call.
@@ -11,10 +11,16 @@ def test_tree_name():
         .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()/1000).Sum()") \
         .AsROOTTTree('junk.root', 'analysis', ['fork']) \
         .value()
+    book_lines = get_lines_of_book_code(r)
+    print_lines(book_lines)
+    l_sets = find_line_numbers_with('tree ("analysis")', book_lines)
+    assert 1 == len(l_sets)
+
+    # The fill goes through the tree pointer cached when it was booked
+    tree_var = book_lines[l_sets[0]].split('=')[0].strip()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    l_sets = find_line_numbers_with('tree("analysis")', lines)
-    assert 1 == len(l_sets)
+    assert 1 == len(find_line_numbers_with(f'{tree_var}->Fill();', lines))
 
 
 def test_Aggregate_not_initial_const_SUM():
@@ -43,13 +49,9 @@ def test_count_after_single_sequence():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    assert 1 == ["for" in ln for ln in lines].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # A Select does not change the number of jets, so there is no need to loop over them.
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    assert find_line_with("->size()", lines) > 0
 
 
 def test_count_after_single_sequence_with_filter():
@@ -88,13 +90,10 @@ def test_count_after_single_sequence_of_sequence():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    assert 1 == ["for" in ln for ln in lines].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # This is the number of jets
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    l_size = find_line_with("->size()", lines)
+    assert "jets" in lines[l_size]
 
 
 def test_count_after_double_sequence_with_filter():
@@ -133,15 +132,31 @@ def test_count_after_single_sequence_of_sequence_with_useless_where():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
-    # Make sure there is just one for loop in here.
-    l_increment = find_line_with('+1', lines)
-    block_headers = find_open_blocks(lines[:l_increment])
-    assert 1 == ["for" in ln for ln in block_headers].count(True)
-    # Make sure the +1 happens after the for, and before another } bracket.
-    num_for = find_line_with("for", lines)
-    num_inc = find_line_with("+1", lines[num_for:])
-    num_close = find_next_closing_bracket(lines[num_for:])
-    assert num_close > num_inc
+    # The tracks are never looked at
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    assert find_line_with(">10.0", lines, throw_if_not_found=False) == -1
+
+
+def test_count_of_collection():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: len(e.Jets("AllMyJets"))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == ["for" in ln for ln in lines].count(True)
+    assert find_line_with("->size()", lines) > 0
+
+
+def test_count_of_collection_is_signed():
+    'Arithmetic and tests on a count are done with a signed int, not the unsigned size'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AllMyJets").Count() - 2, e.Jets("AllMyJets").Count() - 2 >= 0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    find_line_with("(static_cast<int>(jets0->size())-2)", lines)
+    find_line_with("((static_cast<int>(jets0->size())-2)>=0)", lines)
+    assert all(ln.count('->size()') == ln.count('static_cast<int>(jets0->size())') for ln in lines)
 
 
 def test_first_can_be_iterable_after_where():
@@ -167,7 +182,7 @@ def test_Aggregate_per_jet():
 
 def test_Aggregate_per_jet_int():
     r = atlas_xaod_dataset() \
-        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Count()") \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Where(lambda j: j.pt() > 10).Count()") \
         .value()
 
     lines = get_lines_of_code(r)
@@ -182,6 +197,82 @@ def test_generate_Max():
         .value()
     lines = get_lines_of_code(r)
     print_lines(lines)
+    # Seeded from the first jet, not from 0 (all the jets might have negative values)
+    l_test = find_line_with("if (is_first", lines)
+    assert "|| (i_obj" in lines[l_test]
+    assert "->pt()>aggResult" in lines[l_test]
+
+
+def test_generate_Min():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Min()") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_test = find_line_with("if (is_first", lines)
+    assert "->pt()<aggResult" in lines[l_test]
+    assert find_line_with("double aggResult", lines) < l_test
+
+
+def test_generate_Any():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Any(lambda j: j.pt() > 50.0)") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_decl = find_line_with("bool aggResult", lines)
+    assert "(false)" in lines[l_decl]
+    l_set = find_line_with("= true;", lines)
+    assert ">50.0" in find_open_blocks(lines[:l_set])[-1]
+    assert "break;" in lines[l_set + 1]
+
+
+def test_generate_All():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').All(lambda j: j.pt() > 50.0)") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_decl = find_line_with("bool aggResult", lines)
+    assert "(true)" in lines[l_decl]
+    l_set = find_line_with("= false;", lines)
+    assert "!(" in find_open_blocks(lines[:l_set])[-1]
+    assert "break;" in lines[l_set + 1]
+
+
+def test_Any_in_shared_loop():
+    'The loop is used for the other column too, so it must run to the end'
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: (e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()), e.Jets('AntiKt4EMTopoJets').Any(lambda j: j.pt() > 50.0))") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == ["for" in ln for ln in lines].count(True)
+    assert find_line_with("break;", lines, throw_if_not_found=False) == -1
+
+
+def test_Aggregate_only():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Select(lambda j: j.pt()).Aggregate(lambda acc, v: acc * v)") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_first = find_line_with("if (is_first", lines)
+    assert "aggResult" in lines[l_first + 3] and "= i_obj" in lines[l_first + 3]
+    l_else = find_line_with("else", lines)
+    assert "*i_obj" in lines[l_else + 2]
+
+
+def test_Aggregate_initial_func():
+    r = atlas_xaod_dataset() \
+        .Select("lambda e: e.Jets('AntiKt4EMTopoJets').Aggregate(lambda j: j.pt(), lambda acc, j: acc + j.eta())") \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_first = find_line_with("if (is_first", lines)
+    assert "->pt();" in lines[l_first + 3]
+    l_else = find_line_with("else", lines)
+    assert "->eta()" in lines[l_else + 2]
 
 
 def test_First_selects_collection_count():
@@ -192,7 +283,9 @@ def test_First_selects_collection_count():
     lines = get_lines_of_code(r)
     print_lines(lines)
     ln = find_line_numbers_with("for", lines)
-    assert 2 == len(ln)
+    assert 1 == len(ln)
+    l_size = find_line_with("->size()", lines)
+    assert "is_first" in find_open_blocks(lines[:l_size])[-1]
 
 
 def test_sequence_with_where_first():
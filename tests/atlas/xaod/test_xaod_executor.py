@@ -156,7 +156,52 @@ def test_ifexpr():
     print_lines(lines)
     lines = [ln for ln in lines if '10.0' in ln]
     assert len(lines) == 1
-    assert 'if ' in lines[0]
+    assert '?' in lines[0]
+
+
+def test_ifexpr_int():
+    'Both branches are integers, so the result is too'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: 1 if j.pt() > 10.0 else -999)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_push = find_line_with("push_back", lines)
+    assert "? 1 : (-(999))" in lines[l_push]
+    assert 'std::vector<int>' in str(r.QueryVisitor._gc._class_vars[0].cpp_type())
+
+
+def test_ifexpr_count_and_negative():
+    'A count is signed, so the negative branch of a "?" stays negative'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Muons("Muons").Count() if j.pt() > 10.0 else -999)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_push = find_line_with("push_back", lines)
+    assert re.search(r'\? static_cast<int>\(muons[0-9]+->size\(\)\) : \(-\(999\)\)', lines[l_push])
+    assert 'std::vector<int>' in str(r.QueryVisitor._gc._class_vars[0].cpp_type())
+
+
+def test_ifexpr_most_accurate_type():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt() if j.pt() > 10.0 else -999)') \
+        .value()
+    assert 'std::vector<double>' in str(r.QueryVisitor._gc._class_vars[0].cpp_type())
+
+
+def test_ifexpr_with_prep():
+    'A branch that needs statements of its own is only run if it is picked'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: 0 if j.pt() > 10.0 else e.Tracks("InDetTrackParticles").Where(lambda t: t.pt() > j.pt()).Count())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_decl = find_line_with("int if_else_result", lines)
+    l_if = find_line_with("if ((i_obj1->pt()>10.0))", lines)
+    l_else = [i for i, ln in enumerate(lines) if ln.strip() == 'else']
+    assert l_decl < l_if < l_else[0]
+    assert find_line_numbers_with("?", lines) == []
 
 
 def test_per_jet_item_with_where():
@@ -375,6 +420,67 @@ def test_Select_Multiple_arrays_2_step():
     assert 0 == ["for" in a for a in active_blocks].count(True)
 
 
+def test_reserve_for_collection():
+    'The output has one entry for each jet, so room is made for all of them ahead of the loop'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserve = find_line_with(".reserve(", lines)
+    assert re.search(r'_col[0-9]+\.reserve\(jets[0-9]+->size\(\)\);', lines[l_reserve])
+    assert lines[l_reserve + 1].strip().startswith("for (")
+
+
+def test_reserve_after_event_cut():
+    r = atlas_xaod_dataset() \
+        .Where('lambda e: e.EventInfo("EventInfo").runNumber() > 5') \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserve = find_line_with(".reserve(", lines)
+    assert "runNumber" in find_open_blocks(lines[:l_reserve])[-1]
+
+
+def test_no_reserve_with_filter():
+    'It is not known how many jets will pass'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10).Select(lambda j: j.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert find_line_with(".reserve(", lines, throw_if_not_found=False) == -1
+
+
+def test_no_reserve_for_select_many():
+    'The tracks are added once for each jet'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Tracks("InDetTrackParticles")).Select(lambda t: t.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert find_line_with(".reserve(", lines, throw_if_not_found=False) == -1
+
+
+def test_reserve_for_nested_collection():
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Select(lambda t: t.pt()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserves = find_line_numbers_with(".reserve(", lines)
+    assert len(l_reserves) == 2
+    assert "jets" in lines[l_reserves[0]]
+    assert re.search(r'_ntuple[0-9]+\.reserve\(tracks[0-9]+->size\(\)\);', lines[l_reserves[1]])
+    assert len([ln for ln in find_open_blocks(lines[:l_reserves[1]]) if "for (" in ln]) == 1
+
+
 def test_Select_of_2D_array():
     # This should generate a 2D array.
     r = atlas_xaod_dataset() \
@@ -383,8 +489,11 @@ def test_Select_of_2D_array():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double>", lines)
-    l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
+    # The inner vector is a member of the query, and is cleared for the next jet
+    l_vector_clear = find_line_numbers_with("_ntuple", lines)[-1]
+    assert lines[l_vector_clear].strip().endswith(".clear();")
+    l_vector_active = len(find_open_blocks(lines[:l_vector_clear]))
+    assert find_line_with("vector<double>", lines, throw_if_not_found=False) == -1
 
     l_first_push = find_line_numbers_with("push_back", lines)
     assert len(l_first_push) == 2
@@ -404,8 +513,9 @@ def test_Select_of_2D_with_where():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double>", lines)
-    l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
+    l_vector_clear = find_line_numbers_with("_ntuple", lines)[-1]
+    assert lines[l_vector_clear].strip().endswith(".clear();")
+    l_vector_active = len(find_open_blocks(lines[:l_vector_clear]))
 
     l_first_push = find_line_with("push_back", lines)
     l_first_push_active = len(find_open_blocks(lines[:l_first_push]))
@@ -420,13 +530,15 @@ def test_Select_of_3D_array():
     lines = get_lines_of_code(r)
     print_lines(lines)
 
-    l_vector_decl = find_line_with("vector<double> ", lines)
-    l_vector_active = len(find_open_blocks(lines[:l_vector_decl]))
-
-    l_vector_double_decl = find_line_with("vector<std::vector<double>>", lines)
-    l_vector_double_active = len(find_open_blocks(lines[:l_vector_double_decl]))
+    # Each level is collected in a member of the query, and cleared once it has been saved
+    l_clears = [ln for ln in find_line_numbers_with("_ntuple", lines) if lines[ln].strip().endswith(".clear();")]
+    assert len(l_clears) == 2
+    l_vector_active = len(find_open_blocks(lines[:l_clears[0]]))
+    l_vector_double_active = len(find_open_blocks(lines[:l_clears[1]]))
 
     assert l_vector_active == (l_vector_double_active + 1)
+    class_types = sorted(str(v.cpp_type()) for v in r.QueryVisitor._gc._class_vars if v.as_cpp().startswith("_ntuple"))
+    assert class_types == ["std::vector<double>", "std::vector<std::vector<double>>"]
 
 
 def test_Select_of_2D_array_with_tuple():
@@ -668,8 +780,48 @@ def test_Range_good_call():
     print_lines(lines)
     for_loops = find_line_numbers_with('for (', lines)
     assert len(for_loops) == 2
-    find_line_with('(0)', lines)
-    find_line_with('(10)', lines)
+    assert re.search(r'for \(int (i_obj[0-9]+) = 0, (end[0-9]+) = 10; \1 < \2; \1\+\+\)', lines[for_loops[1]])
+    assert find_line_with('std::iota', lines, throw_if_not_found=False) == -1
+
+
+def test_Range_nested():
+    r = (atlas_xaod_dataset()
+         .Select(lambda e: Range(0, 5).Select(lambda i: Range(i, 10).Select(lambda k: i * k)))
+         .value()
+         )
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    for_loops = find_line_numbers_with('for (', lines)
+    assert len(for_loops) == 2
+    outer_index = re.search(r'for \(int (i_obj[0-9]+) = 0,', lines[for_loops[0]])[1]  # type: ignore
+    assert f'= {outer_index}, ' in lines[for_loops[1]]
+    l_push = find_line_with('push_back((', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_push]) if 'for (' in ln]) == 2
+
+
+def test_Range_to_collection_size():
+    'The number of jets is asked for once per event, not once per item in the range'
+    r = (atlas_xaod_dataset()
+         .Select(lambda e: Range(0, e.Jets("AntiKt4EMTopoJets").Count()).Select(lambda i: i * 2))
+         .value()
+         )
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    for_loops = find_line_numbers_with('for (', lines)
+    assert len(for_loops) == 1
+    assert re.search(r'end[0-9]+ = static_cast<int>\(jets[0-9]+->size\(\)\);', lines[for_loops[0]])
+
+
+def test_Range_to_filtered_count():
+    r = (atlas_xaod_dataset()
+         .Select(lambda e: Range(0, e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10).Count()).Select(lambda i: i * 2))
+         .value()
+         )
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    for_loops = find_line_numbers_with('for (', lines)
+    assert len(for_loops) == 2
+    assert re.search(r'end[0-9]+ = aggResult[0-9]+;', lines[for_loops[1]])
 
 
 def test_metadata_collection():
@@ -690,6 +842,80 @@ def test_metadata_collection():
     assert "double" == str(vs[0].cpp_type())
 
 
+def test_output_column_types():
+    'Columns can be written as narrower types than they are calculated as'
+    r = (atlas_xaod_dataset()
+         .MetaData({
+                   'metadata_type': 'output_column_types',
+                   'columns': {'n_jets': 'int16', 'good': 'bool'},
+                   'double_as_float': True,
+                   })
+         .Select(lambda e: {
+             'run_number': e.EventInfo("EventInfo").runNumber(),
+             'n_jets': e.Jets("AntiKt4EMTopoJets").Count(),
+             'good': e.Jets("AntiKt4EMTopoJets").Count() > 2,
+             'jet_eta': e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()),
+         })
+         .value())
+    vs = {v.as_cpp(): str(v.cpp_type()) for v in r.QueryVisitor._gc._class_vars}
+    assert sorted(t for n, t in vs.items() if not n.startswith('_tree')) \
+        == ['bool', 'float', 'short', 'std::vector<float>']
+
+
+def test_output_column_types_int8_negative():
+    'An int8 column is signed on every platform (a plain char is unsigned on ARM)'
+    r = (atlas_xaod_dataset()
+         .MetaData({
+                   'metadata_type': 'output_column_types',
+                   'columns': {'n_extra': 'int8'},
+                   })
+         .Select(lambda e: {'n_extra': e.Jets("AntiKt4EMTopoJets").Count() - 10})
+         .value())
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    v = next(v for v in r.QueryVisitor._gc._class_vars if 'n_extra' in v.as_cpp())
+    assert str(v.cpp_type()) == 'signed char'
+    l_set = find_line_with(f'{v.as_cpp()} = ', lines)
+    assert 'static_cast<int>' in lines[l_set]
+    assert lines[l_set].endswith('-10);')
+
+
+def test_output_column_types_nested():
+    'The vectors that collect the inner sequences have the narrower type too'
+    r = (atlas_xaod_dataset()
+         .MetaData({
+                   'metadata_type': 'output_column_types',
+                   'double_as_float': True,
+                   })
+         .Select(lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons").Select(lambda el: el.pt() - j.pt())))
+         .value())
+    types = [str(v.cpp_type()) for v in r.QueryVisitor._gc._class_vars]
+    assert 'std::vector<std::vector<float>>' in types
+    assert 'std::vector<float>' in types
+    assert not any('double' in t for t in types)
+
+
+def test_output_column_types_not_a_number():
+    with pytest.raises(ValueError) as e:
+        (atlas_xaod_dataset()
+         .MetaData({
+                   'metadata_type': 'add_method_type_info',
+                   'type_string': 'xAOD::Jet',
+                   'method_name': 'astring',
+                   'return_type': 'string',
+                   })
+         .MetaData({
+                   'metadata_type': 'output_column_types',
+                   'columns': {'name': 'float'},
+                   })
+         .SelectMany(lambda e: e.Jets("AntiKt4EMTopoJets"))
+         .Select(lambda j: {'name': j.astring()})
+         .value())
+
+    assert 'name' in str(e.value)
+
+
 def test_metadata_collection_bad_experiment():
     'This is integration testing - making sure the dict to root conversion works'
     with pytest.raises(ValueError) as e:
@@ -896,3 +1122,270 @@ def test_event_collection_bad_type_arg():
             .value())
 
     assert "is a string" in str(e)
+
+
+_cse = {
+    'metadata_type': 'code_generation_options',
+    'common_subexpression_elimination': True,
+}
+
+
+def test_cse_where_select():
+    'The pt of the jet is used in the Where and the Select, so it should only be fetched once'
+    r = atlas_xaod_dataset() \
+        .MetaData(_cse) \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30000.0).Select(lambda j: j.pt()/1000.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if 'pt()' in ln]) == 1
+    l_pt = find_line_with('->pt();', lines)
+    l_if = find_line_with('if (', lines)
+    assert l_pt < l_if
+    assert re.search(r'\(cse[0-9]+>30000.0\)', lines[l_if])
+    assert re.search(r'= \(cse[0-9]+/1000.0\);', lines[find_line_with('/1000.0', lines)])
+
+
+def test_cse_tuple():
+    'The same value used twice in a tuple'
+    r = atlas_xaod_dataset() \
+        .MetaData(_cse) \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.pt()/1000.0, j.pt() > 30000.0, j.eta())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if 'pt()' in ln]) == 1
+    assert len([ln for ln in lines if 'eta()' in ln]) == 1
+    assert len([ln for ln in lines if 'auto cse' in ln]) == 2
+
+
+def test_cse_off():
+    'Without the option every use evaluates the value again'
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30000.0).Select(lambda j: j.pt()/1000.0)') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if 'pt()' in ln]) == 2
+    assert len([ln for ln in lines if 'cse' in ln]) == 0
+
+
+def test_cse_not_across_loops():
+    'Two loops over the same jets each have their own loop variable, so nothing can be shared'
+    r = atlas_xaod_dataset() \
+        .MetaData(_cse) \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()).Sum(), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()).Max())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if 'pt()' in ln]) == 2
+
+
+def test_cse_deltar():
+    'DeltaR with the same arguments in the Where and the Select is only calculated once'
+    r = atlas_xaod_dataset() \
+        .MetaData(_cse) \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Electrons("Electrons")'
+                '.Where(lambda el: DeltaR(j.eta(), j.phi(), el.eta(), el.phi()) < 0.4)'
+                '.Select(lambda el: DeltaR(j.eta(), j.phi(), el.eta(), el.phi())).Sum())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if 'Phi_mpi_pi' in ln]) == 1
+
+    # The sum must still only include the electrons that pass the cut.
+    l_sum = find_line_with('= (aggResult', lines)
+    assert any('<0.4' in ln for ln in find_open_blocks(lines[:l_sum]))
+
+
+_licm = {
+    'metadata_type': 'code_generation_options',
+    'loop_invariant_code_motion': True,
+}
+
+
+def test_licm_deltar():
+    'The eta and phi of the muon are fetched once per muon, not once per jet'
+    r = atlas_xaod_dataset() \
+        .MetaData(_licm) \
+        .Select('lambda e: e.Muons("Muons").Select(lambda mu: e.Jets("AntiKt4EMTopoJets")'
+                '.Select(lambda j: DeltaR(mu.eta(), mu.phi(), j.eta(), j.phi())))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_mu_eta = find_line_with('i_obj1->eta()', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_mu_eta]) if 'for' in ln]) == 1
+    l_jet_eta = find_line_with('i_obj3->eta()', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_jet_eta]) if 'for' in ln]) == 2
+    assert re.search(r'auto d_eta = inv[0-9]+ - i_obj3->eta\(\);', lines[l_jet_eta])
+
+
+def test_licm_event_level():
+    'An event level value used for each jet is fetched before the loop'
+    r = atlas_xaod_dataset() \
+        .MetaData(_licm) \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()*e.EventInfo("EventInfo").mcEventWeight(0))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_weight = find_line_with('mcEventWeight(0)', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_weight]) if 'for' in ln]) == 0
+    assert l_weight < find_line_with('for (', lines)
+
+
+def test_licm_not_out_of_guard():
+    'A test on the muon inside the jet loop might be guarding the value, so it is not moved past'
+    r = atlas_xaod_dataset() \
+        .MetaData(_licm) \
+        .Select('lambda e: e.Muons("Muons").Select(lambda mu: e.Jets("AntiKt4EMTopoJets")'
+                '.Where(lambda j: mu.pt() > 20000.0).Select(lambda j: mu.eta() + j.eta()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_mu_eta = find_line_with('i_obj1->eta()', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_mu_eta]) if 'if' in ln]) == 1
+
+
+def test_licm_off():
+    'Without the option the value is fetched where it is used'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Muons("Muons").Select(lambda mu: e.Jets("AntiKt4EMTopoJets")'
+                '.Select(lambda j: DeltaR(mu.eta(), mu.phi(), j.eta(), j.phi())))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_mu_eta = find_line_with('i_obj1->eta()', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_mu_eta]) if 'for' in ln]) == 2
+    assert len([ln for ln in lines if re.search(r'\binv[0-9]+', ln)]) == 0
+
+
+def test_loop_fusion_same_collection():
+    'Two columns over the same jets should be filled from one loop'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if ln.strip().startswith('for (')]) == 1
+    l_push_back = find_line_numbers_with("push_back", lines)
+    assert len(l_push_back) == 2
+    assert all([len([ln for ln in find_open_blocks(lines[:pb]) if "for" in ln]) == 1 for pb in l_push_back])
+
+
+def test_loop_fusion_around_other_collection():
+    'A loop over the electrons between two jet columns should not stop the jet loops being joined'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Electrons("Electrons").Select(lambda el: el.pt()), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if ln.strip().startswith('for (')]) == 2
+
+
+def test_loop_fusion_with_where():
+    'A filtered column can share the loop, as long as it is only filled inside its if statement'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30000.0).Select(lambda j: j.eta()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if ln.strip().startswith('for (')]) == 1
+    l_eta = find_line_with("->eta()", lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_eta]) if "if" in ln]) == 1
+    l_pt = find_line_with("->pt())", lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_pt]) if "if" in ln]) == 0
+
+
+def test_loop_fusion_not_after_accumulator():
+    'A count is not known until its loop is done, so a later column needs its own loop'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 10).Count(), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    assert len([ln for ln in lines if ln.strip().startswith('for (')]) == 2
+
+
+def test_loop_fusion_not_nested():
+    'Looping over the jets inside a loop over the jets must still be two loops'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j1: e.Jets("AntiKt4EMTopoJets").Select(lambda j2: j1.pt() + j2.pt()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_add = find_line_with("push_back((", lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_add]) if "for" in ln]) == 2
+
+
+def test_event_cut_out_of_jet_loop():
+    'An event level cut written on each jet is made once, before looping over the jets'
+    r = atlas_xaod_dataset() \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: (j, e))') \
+        .Where('lambda p: p[0].pt() > 20000.0 and p[1].EventInfo("EventInfo").runNumber() > 5') \
+        .Select('lambda p: p[0].pt()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_run = find_line_with('runNumber()', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_run]) if 'for' in ln]) == 0
+    l_pt = find_line_with('->pt()>20000.0', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_pt]) if 'for' in ln]) == 1
+
+
+def test_cheap_cut_first():
+    'The count of the electrons is only done for events that pass the cut on the run number'
+    r = atlas_xaod_dataset() \
+        .Where('lambda e: e.Electrons("Electrons").Where(lambda el: el.pt() > 10).Count() > 1 and e.EventInfo("EventInfo").runNumber() > 5') \
+        .Select('lambda e: e.EventInfo("EventInfo").eventNumber()') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_loop = find_line_with('for (', lines)
+    assert find_line_with('runNumber()', lines) < l_loop
+    assert len([ln for ln in find_open_blocks(lines[:l_loop]) if 'if' in ln]) == 1
+
+
+def test_collection_fetched_after_event_cut():
+    'The truth particles are only read for events that pass the cut on the run number'
+    r = atlas_xaod_dataset() \
+        .Where('lambda e: e.EventInfo("EventInfo").runNumber() > 5') \
+        .Select('lambda e: e.TruthParticles("TruthParticles").Select(lambda t: t.pt())') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_fetch = find_line_with('"TruthParticles"', lines)
+    assert len([ln for ln in find_open_blocks(lines[:l_fetch]) if 'if' in ln]) == 1
+    assert len([ln for ln in find_open_blocks(lines[:l_fetch]) if 'for' in ln]) == 0
+
+
+def test_collection_fetched_once_for_all_uses():
+    'Needed in a test that is not always made, and then again after it, it is fetched before the test'
+    r = atlas_xaod_dataset() \
+        .Select('lambda e: (e.EventInfo("EventInfo").runNumber() > 5 and e.Electrons("Electrons").Count() > 1, '
+                'e.Electrons("Electrons").Select(lambda el: el.pt()))') \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_fetch = find_line_numbers_with('"Electrons"', lines)
+    assert len(l_fetch) == 1
+    assert len([ln for ln in find_open_blocks(lines[:l_fetch[0]]) if 'if' in ln]) == 0
+    assert l_fetch[0] < find_line_with('for (', lines)
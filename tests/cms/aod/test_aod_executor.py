@@ -22,6 +22,18 @@ def test_Select_member_variable():
     assert find_line_with(".sumChargedHadronPt()", lines, throw_if_not_found=False) == -1
 
 
+def test_reserve_for_collection():
+    r = cms_aod_dataset() \
+        .Select(lambda e: e.Muons("muons").Select(lambda m: m.pt())) \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserve = find_line_with(".reserve(", lines)
+    assert "->size()" in lines[l_reserve]
+    assert lines[l_reserve + 1].strip().startswith("for (")
+
+
 def test_complex_dict():
     'Seen to fail in the wild, so a test case to track'
     r = cms_aod_dataset() \
@@ -107,3 +119,30 @@ def test_metadata_collection_bad_experiment():
          .value())
 
     assert "backend; only" in str(e.value)
+
+
+def test_multi_query_one_event_loop(tmp_path):
+    'Several queries run in a single analyze, each to its own tree, sharing the muon retrieval'
+    from func_adl.event_dataset import EventDataset
+    from func_adl_xAOD.cms.aod.executor import cms_aod_executor
+
+    class query_as_ast(EventDataset):
+        async def execute_result_async(self, a, title):
+            return a
+
+    q1 = query_as_ast() \
+        .Select(lambda e: e.Muons("muons").Select(lambda m: m.pt())) \
+        .value()
+    q2 = query_as_ast() \
+        .Select(lambda e: e.Muons("muons").Select(lambda m: m.eta())) \
+        .value()
+
+    exe = cms_aod_executor()
+    f_specs = exe.write_cpp_files_multi([exe.apply_ast_transformations(q) for q in [q1, q2]], tmp_path)
+    assert [f.result_rep.treename for f in f_specs] == ['cms_aod_tree', 'cms_aod_tree_1']
+
+    analyzer = (tmp_path / 'Analyzer.cc').read_text()
+    assert analyzer.count('"muons"') == 1
+    assert analyzer.count('fs->make<TTree>("cms_aod_tree"') == 1
+    assert analyzer.count('fs->make<TTree>("cms_aod_tree_1"') == 1
+    assert analyzer.count('->Fill();') == 2
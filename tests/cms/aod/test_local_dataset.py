@@ -47,3 +47,51 @@ def test_run(docker_mock):
          .value())
 
     assert len(r) == 1
+
+
+def test_parallel_run(docker_mock, tmp_path):
+    'CMS can not share a build, so every container compiles and runs its own files'
+    from func_adl_xAOD.cms.aod.local_dataset import CMSRun1AODDataset
+
+    files = []
+    for i, size in enumerate([30, 20]):
+        f = tmp_path / f'file_{i}.root'
+        f.write_bytes(b'\0' * size)
+        files.append(f)
+
+    r = (CMSRun1AODDataset(files, max_workers=2)
+         .SelectMany('lambda e: e.TrackMuons("globalMuons")')
+         .Select('lambda m: m.pt()')
+         .AsROOTTTree('junk.root', 'my_tree', ['muon_pt'])
+         .value())
+
+    assert len(r) == 2
+    assert docker_mock.run.call_count == 2
+    for c in docker_mock.run.call_args_list:
+        args = c[0][1]
+        assert '-r' not in args and '-c' not in args and '-b' not in args
+        assert args.count('-d') == 1
+
+
+def test_iterate_results(docker_mock, tmp_path):
+    'CMS can not share a build, so results come back one per file group'
+    import asyncio
+    from func_adl_xAOD.cms.aod.local_dataset import CMSRun1AODDataset
+
+    files = []
+    for i, size in enumerate([30, 20, 10]):
+        f = tmp_path / f'file_{i}.root'
+        f.write_bytes(b'\0' * size)
+        files.append(f)
+
+    ds = CMSRun1AODDataset(files, max_workers=2)
+    query = ds.SelectMany('lambda e: e.TrackMuons("globalMuons")') \
+        .Select('lambda m: m.pt()') \
+        .AsROOTTTree('junk.root', 'my_tree', ['muon_pt'])
+
+    async def collect():
+        return [f async for f in ds.iterate_results_async(query)]
+
+    r = asyncio.run(collect())
+    assert len(r) == 2
+    assert docker_mock.run.call_count == 2
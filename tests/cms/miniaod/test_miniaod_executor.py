@@ -22,6 +22,18 @@ def test_Select_member_variable():
     assert find_line_with(".sumChargedHadronPt()", lines, throw_if_not_found=False) == -1
 
 
+def test_reserve_for_collection():
+    r = cms_miniaod_dataset() \
+        .Select(lambda e: e.Muons("slimmedMuons").Select(lambda m: m.pt())) \
+        .value()
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    l_reserve = find_line_with(".reserve(", lines)
+    assert "->size()" in lines[l_reserve]
+    assert lines[l_reserve + 1].strip().startswith("for (")
+
+
 def test_complex_dict():
     'Seen to fail in the wild, so a test case to track'
     r = cms_miniaod_dataset() \
@@ -0,0 +1,105 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from func_adl_xAOD.common.build_cache import build_cache
+
+
+def write_files(d: Path, query_text: str = 'int main() {}'):
+    'Write out a fake set of rendered build files'
+    d.mkdir(parents=True, exist_ok=True)
+    (d / 'query.cxx').write_text(query_text)
+    (d / 'query.h').write_text('class query;')
+    return ['query.cxx', 'query.h']
+
+
+def test_key_is_stable(tmp_path):
+    files = write_files(tmp_path / 'one')
+    write_files(tmp_path / 'two')
+
+    bc = build_cache(tmp_path / 'cache')
+    k1 = bc.build_key(tmp_path / 'one', files, 'atlas/analysisbase:21.2.197')
+    k2 = bc.build_key(tmp_path / 'two', list(reversed(files)), 'atlas/analysisbase:21.2.197')
+
+    assert k1 == k2
+
+
+def test_key_depends_on_source(tmp_path):
+    files = write_files(tmp_path / 'one')
+    write_files(tmp_path / 'two', 'int main() { return 1; }')
+
+    bc = build_cache(tmp_path / 'cache')
+    assert bc.build_key(tmp_path / 'one', files, 'image:1') != bc.build_key(tmp_path / 'two', files, 'image:1')
+
+
+def test_key_depends_on_image(tmp_path):
+    files = write_files(tmp_path / 'one')
+
+    bc = build_cache(tmp_path / 'cache')
+    assert bc.build_key(tmp_path / 'one', files, 'image:1') != bc.build_key(tmp_path / 'one', files, 'image:2')
+
+
+def test_cache_hit(tmp_path):
+    bc = build_cache(tmp_path / 'cache')
+    assert not bc.is_cached('abc')
+    assert bc.mark_used('abc') == []
+    assert bc.is_cached('abc')
+
+
+def test_cache_persists(tmp_path):
+    build_cache(tmp_path / 'cache').mark_used('abc')
+    assert build_cache(tmp_path / 'cache').is_cached('abc')
+
+
+def test_cache_forget(tmp_path):
+    bc = build_cache(tmp_path / 'cache')
+    bc.mark_used('abc')
+    bc.forget('abc')
+    assert not bc.is_cached('abc')
+
+
+def test_cache_lru_eviction(tmp_path):
+    bc = build_cache(tmp_path / 'cache', max_builds=2)
+    bc.mark_used('one')
+    bc.mark_used('two')
+    bc.mark_used('one')
+    evicted = bc.mark_used('three')
+
+    assert evicted == [bc.volume_name('two')]
+    assert bc.is_cached('one')
+    assert not bc.is_cached('two')
+    assert bc.is_cached('three')
+
+
+def test_cache_corrupt_index(tmp_path):
+    (tmp_path / 'build_cache.json').write_text('{bad json')
+    bc = build_cache(tmp_path)
+    assert not bc.is_cached('abc')
+    bc.mark_used('abc')
+    assert bc.is_cached('abc')
+
+
+def test_cache_bad_size(tmp_path):
+    with pytest.raises(ValueError):
+        build_cache(tmp_path, max_builds=0)
+
+
+def test_build_lock_per_key(tmp_path):
+    bc = build_cache(tmp_path)
+
+    async def get_locks():
+        return bc.build_lock('abc'), bc.build_lock('abc'), bc.build_lock('def')
+
+    one, same, other = asyncio.run(get_locks())
+    assert one is same
+    assert one is not other
+
+
+def test_build_lock_per_event_loop(tmp_path):
+    'A lock can only be used in one event loop, so each gets its own'
+    bc = build_cache(tmp_path)
+
+    async def get_lock():
+        return bc.build_lock('abc')
+
+    assert asyncio.run(get_lock()) is not asyncio.run(get_lock())
@@ -2,7 +2,7 @@ import ast
 
 import pytest
 from func_adl_xAOD.common.cpp_ast import (CPPCodeSpecification, CPPCodeValue,
-                                          build_CPPCodeValue)
+                                          _is_constant, build_CPPCodeValue)
 from func_adl_xAOD.common.math_utils import DeltaR
 from tests.atlas.xaod.utils import atlas_xaod_dataset  # type: ignore
 
@@ -39,6 +39,29 @@ def test_build_cpp_cv_function():
     assert r.func.replacement_instance_obj is None
 
 
+def test_build_cpp_cv_reference():
+    'A result bound by reference is held by a const pointer'
+
+    func = CPPCodeSpecification(
+        name='my_func',
+        include_files=['my_include.h'],
+        arguments=['a'],
+        code=['const auto &result = lookup(a);'],
+        result='result',
+        cpp_return_type='double',
+        cpp_return_is_collection=True,
+        cpp_return_is_reference=True,
+    )
+
+    call_node = ast.parse('my_func(1)').body[0].value  # type: ignore
+
+    r = build_CPPCodeValue(func, call_node)
+
+    assert isinstance(r.func, CPPCodeValue)
+    assert r.func.result_is_reference
+    assert str(r.func.result_rep(None).cpp_type()) == 'const std::vector<double>*'  # type: ignore
+
+
 def test_build_cpp_cv_function_bad_method():
     'Test building and modifying a callback function'
 
@@ -101,3 +124,14 @@ def test_build_cpp_cv_method_as_function():
         build_CPPCodeValue(func, call_node)
 
     assert "function" in str(e)
+
+
+@pytest.mark.parametrize("node, constant", [
+    (ast.Constant(value=1), True),
+    (ast.Str(s='JVT'), True),
+    (ast.Num(n=1.5), True),
+    (ast.NameConstant(value=True), True),
+    (ast.Name(id='j', ctx=ast.Load()), False),
+])
+def test_is_constant(node, constant):
+    assert _is_constant(node) == constant
@@ -130,3 +130,20 @@ def test_parse_type_str():
 def test_parse_type_str_ptr():
     t = ctyp.parse_type('string *')
     assert str(t) == 'string*'
+
+
+def test_default_value_number():
+    assert ctyp.terminal('double').default_value() == '0'
+    assert ctyp.terminal('int').default_value() == '0'
+
+
+def test_default_value_bool():
+    assert ctyp.terminal('bool').default_value() == 'false'
+
+
+def test_default_value_pointer():
+    assert ctyp.terminal('xAOD::Jet', p_depth=1).default_value() == 'nullptr'
+
+
+def test_default_value_object():
+    assert ctyp.terminal('TLorentzVector').default_value() == 'TLorentzVector{}'
@@ -42,11 +42,15 @@ def test_metadata_method():
                          '}), lambda e: e + 1)')
     a2 = parse_statement('Select(ds, lambda e: e + 1)')
 
-    new_a1 = do_nothing_executor().apply_ast_transformations(a1)
+    exe = do_nothing_executor()
+    new_a1 = exe.apply_ast_transformations(a1)
 
     assert ast.dump(a2) == ast.dump(new_a1)
 
-    t = method_type_info('my_namespace::obj', 'pT')
+    # The type info should only be known to this executor's translation
+    assert method_type_info('my_namespace::obj', 'pT') is None
+    with exe.translation_context.activate():
+        t = method_type_info('my_namespace::obj', 'pT')
     assert t is not None
     assert t.r_type.type == 'int'
     assert not t.r_type.is_a_pointer
@@ -0,0 +1,80 @@
+# Test moving and ordering filters
+import ast
+
+from func_adl_xAOD.common.filter_pushdown import filter_cost, push_down_filters
+
+
+def _parse(query: str) -> ast.AST:
+    return ast.parse(query, mode='eval').body
+
+
+def _push(query: str) -> str:
+    return ast.dump(push_down_filters().visit(_parse(query)))
+
+
+def _dump(query: str) -> str:
+    return ast.dump(_parse(query))
+
+
+def _cost(test: str) -> int:
+    return filter_cost(_parse(test))
+
+
+def test_cost_member_call():
+    assert _cost('j.pt() > 20.0 and abs(j.eta()) < 2.5') == 1
+    assert _cost('j.pt() > 20.0') == 0
+
+
+def test_cost_sequence():
+    assert _cost('Aggregate(e.Jets("jets"), 0, lambda acc, v: acc + 1) > 2') == 2
+    assert _cost('e.Jets("jets")[0].pt() > 2') == 2
+
+
+def test_cheap_test_first():
+    assert _push('Where(e.Jets("jets"), lambda j: DeltaR(j.eta(), j.phi(), 0, 0) < 0.4 and j.pt() > 20.0)') \
+        == _dump('Where(e.Jets("jets"), lambda j: j.pt() > 20.0 and DeltaR(j.eta(), j.phi(), 0, 0) < 0.4)')
+
+
+def test_same_cost_keeps_order():
+    'A test may guard the one after it'
+    assert _push('Where(e.Jets("jets"), lambda j: j.isValid() and j.pt() > 20.0)') \
+        == _dump('Where(e.Jets("jets"), lambda j: j.isValid() and j.pt() > 20.0)')
+
+
+def test_nested_and_flattened():
+    assert _push('Where(s, lambda j: Count(j.tracks()) > 2 and (j.pt() > 20.0 and j.eta() < 2.5))') \
+        == _dump('Where(s, lambda j: j.pt() > 20.0 and j.eta() < 2.5 and Count(j.tracks()) > 2)')
+
+
+def test_lift_event_test():
+    'A test on the event in a filter on the jets is made once per event'
+    assert _push('SelectMany(EventDataset(), lambda e: Select(Where(e.Jets("jets"), lambda j: j.pt() > 20.0 and e.run() > 5), lambda j: j.pt()))') \
+        == _dump('SelectMany(Where(EventDataset(), lambda e: e.run() > 5), lambda e: Select(Where(e.Jets("jets"), lambda j: j.pt() > 20.0), lambda j: j.pt()))')
+
+
+def test_lift_whole_filter():
+    assert _push('SelectMany(EventDataset(), lambda e: Where(e.Jets("jets"), lambda j: e.run() > 5))') \
+        == _dump('SelectMany(Where(EventDataset(), lambda e: e.run() > 5), lambda e: e.Jets("jets"))')
+
+
+def test_lift_joins_filter():
+    assert _push('SelectMany(Where(EventDataset(), lambda e: e.lumi() > 2), lambda e: Where(e.Jets("jets"), lambda j: e.run() > 5 and j.pt() > 2))') \
+        == _dump('SelectMany(Where(EventDataset(), lambda e: e.lumi() > 2 and e.run() > 5), lambda e: Where(e.Jets("jets"), lambda j: j.pt() > 2))')
+
+
+def test_no_lift_from_select():
+    'An empty list for each event is not the same as no events'
+    q = 'Select(EventDataset(), lambda e: Where(e.Jets("jets"), lambda j: e.run() > 5))'
+    assert _push(q) == _dump(q)
+
+
+def test_no_lift_from_count():
+    'A count of an empty sequence is zero, not an empty sequence'
+    q = 'SelectMany(EventDataset(), lambda e: Select(e.Muons("muons"), lambda m: Count(Where(e.Jets("jets"), lambda j: e.run() > 5))))'
+    assert _push(q) == _dump(q)
+
+
+def test_lift_nested_select_many():
+    'A test on the jet in a filter on the electrons, done for each electron and jet, is done for each jet'
+    assert _push('SelectMany(e.Jets("jets"), lambda j: Where(e.Electrons("els"), lambda el: j.pt() > 20.0 and el.pt() > 5.0))') \
+        == _dump('SelectMany(Where(e.Jets("jets"), lambda j: j.pt() > 20.0), lambda j: Where(e.Electrons("els"), lambda el: el.pt() > 5.0))')
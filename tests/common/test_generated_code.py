@@ -1,4 +1,6 @@
 # Test the generated code object
+import func_adl_xAOD.common.cpp_representation as crep
+import func_adl_xAOD.common.cpp_types as ctyp
 import func_adl_xAOD.common.statement as statement
 from func_adl_xAOD.common.generated_code import generated_code
 
@@ -50,6 +52,94 @@ def test_insert_in_middle():
     assert s3._statements[0] is s2
 
 
+def test_event_statement_ahead_of_loop():
+    'Something that only depends on the event is done once, ahead of the loop it is needed in'
+    g = generated_code()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    _loop(g, 'j1')
+    e1 = statement.block()
+    scope = g.add_event_statement(e1)
+
+    assert s1._statements[0] is e1
+    assert isinstance(s1._statements[1], statement.loop)
+    assert scope.frame_statements(-1) is s1
+
+
+def test_event_statement_used_outside():
+    'Needed outside the if it was first needed in, it is moved ahead of the if'
+    g = generated_code()
+    top = g.current_scope()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    e1 = statement.block()
+    g.add_event_statement(e1)
+    g.set_scope(top)
+    scope = g.use_event_statement(e1)
+
+    assert g._block._statements == [e1, s1]
+    assert len(s1._statements) == 0
+    assert scope.frame_statements(-1) is g._block
+
+
+def test_event_statement_used_inside():
+    'Needed somewhere it can already be seen, it stays put'
+    g = generated_code()
+    e1 = statement.block()
+    g.add_event_statement(e1)
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    g.use_event_statement(e1)
+
+    assert g._block._statements == [e1, s1]
+
+
+def test_event_statement_used_earlier():
+    'Needed in a loop that comes before it, it is moved ahead of the loop'
+    g = generated_code()
+    top = g.current_scope()
+    j1 = _loop(g, 'j1')
+    g.set_scope(top)
+    e1 = statement.block()
+    g.add_event_statement(e1)
+    loop = g._block._statements[0]
+    g.set_scope(j1.scope())
+    g.use_event_statement(e1)
+
+    assert g._block._statements == [e1, loop]
+
+
+def test_move_event_statements_before():
+    g = generated_code()
+    top = g.current_scope()
+    _loop(g, 'j1')
+    g.set_scope(top)
+    e1 = statement.block()
+    g.add_event_statement(e1)
+    s1 = statement.arbitrary_statement('dude')
+    g.add_statement(s1)
+    e2 = statement.block()
+    g.add_event_statement(e2)
+    loop = g._block._statements[0]
+    g.move_event_statements_before(loop)
+
+    assert g._block._statements == [e1, e2, loop, s1]
+    assert g.is_event_statement(e1)
+    assert not g.is_event_statement(s1)
+
+
+def test_current_statements():
+    g = generated_code()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    s2 = statement.set_var("v1", "true")
+    g.add_statement(s2)
+
+    assert g.current_statements() == [s2]
+    g.pop_scope()
+    assert g.current_statements() == [s1]
+
+
 def test_get_rep_null():
     g = generated_code()
     assert None is g.get_rep("hi")
@@ -87,3 +177,141 @@ def test_get_rep_hidden():
     assert 10 == g.get_rep("dude")
     g.pop_scope()
     assert 5 == g.get_rep("dude")
+
+
+def _pt(g: generated_code) -> crep.cpp_value:
+    return crep.cpp_value('j->pt()', g.current_scope(), ctyp.terminal('double'))
+
+
+def test_common_value_reused():
+    g = generated_code()
+    v1 = g.common_value(_pt(g))
+    g.add_statement(statement.iftest(crep.cpp_value(f'{v1.as_cpp()} > 30', g.current_scope(), ctyp.terminal('bool'))))
+    v2 = g.common_value(_pt(g))
+    g.add_statement(statement.arbitrary_statement(f'use({v2.as_cpp()})'))
+
+    assert v1.as_cpp() == v2.as_cpp()
+    lines = dummy_emitter().process(g.emit_query_code).Lines
+    assert lines == ['{', f'auto {v1.as_cpp()} = j->pt();', f'if ({v1.as_cpp()} > 30)', '{', f'use({v1.as_cpp()});', '}', '}']
+
+
+def test_common_value_used_once():
+    'A value is held in a variable from its first use - how often it is used later is not known then'
+    g = generated_code()
+    v1 = g.common_value(_pt(g))
+    g.add_statement(statement.arbitrary_statement(f'use({v1.as_cpp()})'))
+
+    lines = dummy_emitter().process(g.emit_query_code).Lines
+    assert lines == ['{', f'auto {v1.as_cpp()} = j->pt();', f'use({v1.as_cpp()});', '}']
+
+
+def test_common_value_declaration_is_a_statement():
+    'The variable is declared by a statement in the block, not by re-writing the emitted code'
+    g = generated_code()
+    v1 = g.common_value(_pt(g))
+
+    declarations = [s for s in g.current_statements() if isinstance(s, statement.declare_value)]
+    assert len(declarations) == 1
+    assert declarations[0]._var.as_cpp() == v1.as_cpp()
+
+
+def test_common_value_used_in_another():
+    'A value used in the definition of another is declared ahead of it'
+    g = generated_code()
+    v1 = g.common_value(_pt(g))
+    v2 = g.common_value(crep.cpp_value(f'f({v1.as_cpp()})', g.current_scope(), ctyp.terminal('double')))
+    g.add_statement(statement.arbitrary_statement(f'use({v2.as_cpp()}, {v2.as_cpp()})'))
+
+    lines = dummy_emitter().process(g.emit_query_code).Lines
+    assert lines == ['{', f'auto {v1.as_cpp()} = j->pt();', f'auto {v2.as_cpp()} = f({v1.as_cpp()});',
+                     f'use({v2.as_cpp()}, {v2.as_cpp()});', '}']
+
+
+def test_common_value_not_seen_from_sibling():
+    'A value declared in a block can not be used from outside it'
+    g = generated_code()
+    top = g.current_scope()
+    g.add_statement(statement.iftest(crep.cpp_value('true', top, ctyp.terminal('bool'))))
+    v1 = g.common_value(_pt(g))
+    g.set_scope(top)
+    v2 = g.common_value(_pt(g))
+
+    assert v1.as_cpp() != v2.as_cpp()
+
+
+def test_common_value_deeper_scope():
+    'When the value is used deeper down, that is where it is valid'
+    g = generated_code()
+    v1 = g.common_value(_pt(g))
+    g.add_statement(statement.iftest(crep.cpp_value('true', g.current_scope(), ctyp.terminal('bool'))))
+    v2 = g.common_value(_pt(g))
+
+    assert v1.as_cpp() == v2.as_cpp()
+    assert v2.scope().starts_with(g.current_scope())
+    assert not v1.scope().starts_with(g.current_scope())
+
+
+def _loop(g: generated_code, name: str) -> crep.cpp_value:
+    'Start a loop over the jets, and return the loop variable'
+    v = crep.cpp_value(name, None, ctyp.terminal('xAOD::Jet*'))
+    g.add_statement(statement.loop(v, crep.cpp_value('jets', None, ctyp.terminal('xAOD::JetContainer'))))
+    v.reset_scope(g.current_scope())
+    return v
+
+
+def _member(obj: crep.cpp_value, name: str) -> crep.cpp_value:
+    return crep.cpp_value(f'{obj.as_cpp()}->{name}()', obj.scope(), ctyp.terminal('double'))
+
+
+def test_invariant_value_moved():
+    'A value that depends only on the outer loop is moved out of the inner one'
+    g = generated_code()
+    j1 = _loop(g, 'j1')
+    _loop(g, 'j2')
+    v = g.invariant_value(_member(j1, 'eta'))
+    assert v is not None
+    g.add_statement(statement.arbitrary_statement(f'use({v.as_cpp()})'))
+
+    lines = dummy_emitter().process(g.emit_query_code).Lines
+    assert lines == ['{', 'for (auto &&j1 : jets)', '{', f'auto {v.as_cpp()} = j1->eta();',
+                     'for (auto &&j2 : jets)', '{', f'use({v.as_cpp()});', '}', '}', '}']
+
+
+def test_invariant_value_reused():
+    g = generated_code()
+    j1 = _loop(g, 'j1')
+    _loop(g, 'j2')
+    v1 = g.invariant_value(_member(j1, 'eta'))
+    v2 = g.invariant_value(_member(j1, 'eta'))
+
+    assert v1 is not None and v2 is not None
+    assert v1.as_cpp() == v2.as_cpp()
+
+
+def test_invariant_value_in_loop():
+    'A value that depends on the innermost loop can not be moved'
+    g = generated_code()
+    _loop(g, 'j1')
+    j2 = _loop(g, 'j2')
+
+    assert g.invariant_value(_member(j2, 'eta')) is None
+
+
+def test_invariant_value_past_filter():
+    'An if that tests the inner loop variable is a filter, and the value can be moved out of it'
+    g = generated_code()
+    j1 = _loop(g, 'j1')
+    j2 = _loop(g, 'j2')
+    g.add_statement(statement.iftest(crep.cpp_value(f'{j2.as_cpp()}->pt() > 30', g.current_scope(), ctyp.terminal('bool'))))
+
+    assert g.invariant_value(_member(j1, 'eta')) is not None
+
+
+def test_invariant_value_not_past_guard():
+    'An if that does not test the inner loop variable might guard the value, so it stays put'
+    g = generated_code()
+    j1 = _loop(g, 'j1')
+    _loop(g, 'j2')
+    g.add_statement(statement.iftest(crep.cpp_value(f'{j1.as_cpp()}->isValid()', g.current_scope(), ctyp.terminal('bool'))))
+
+    assert g.invariant_value(_member(j1, 'eta')) is None
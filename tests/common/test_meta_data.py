@@ -18,8 +18,10 @@ from func_adl_xAOD.common.event_collections import (
     EventCollectionSpecification, event_collection_coder,
     event_collection_container)
 from func_adl_xAOD.common.executor import executor
-from func_adl_xAOD.common.meta_data import (InjectCodeBlock,
+from func_adl_xAOD.common.meta_data import (CodeGenerationOptions,
+                                            InjectCodeBlock,
                                             JobScriptSpecification,
+                                            OutputColumnTypes,
                                             generate_script_block,
                                             process_metadata)
 from tests.utils.base import dataset, dummy_executor  # type: ignore
@@ -289,6 +291,83 @@ def test_md_code_block_bad_item():
     assert "link_libraries_f" in str(e)
 
 
+def test_md_code_generation_options():
+    metadata = [
+        {
+            'metadata_type': 'code_generation_options',
+            'common_subexpression_elimination': True,
+        }
+    ]
+    result = process_metadata(metadata)
+    assert result == [CodeGenerationOptions(common_subexpression_elimination=True)]
+
+
+def test_md_code_generation_options_bad_item():
+    metadata = [
+        {
+            'metadata_type': 'code_generation_options',
+            'common_subexpression_eliminator': True,
+        }
+    ]
+
+    with pytest.raises(ValueError) as e:
+        process_metadata(metadata)
+
+    assert "common_subexpression_eliminator" in str(e)
+
+
+def test_code_generation_options_merge():
+    off = CodeGenerationOptions()
+    on = CodeGenerationOptions(common_subexpression_elimination=True)
+
+    assert not off.merge(off).common_subexpression_elimination
+    assert off.merge(on).common_subexpression_elimination
+    assert on.merge(off).common_subexpression_elimination
+
+
+def test_md_output_column_types():
+    metadata = [
+        {
+            'metadata_type': 'output_column_types',
+            'columns': {'jet_pt': 'float', 'n_jets': 'int8'},
+        }
+    ]
+    result = process_metadata(metadata)
+    assert result == [OutputColumnTypes(columns={'jet_pt': 'float', 'n_jets': 'int8'})]
+
+
+def test_md_output_column_types_bad_type():
+    metadata = [
+        {
+            'metadata_type': 'output_column_types',
+            'columns': {'jet_pt': 'half'},
+        }
+    ]
+
+    with pytest.raises(ValueError) as e:
+        process_metadata(metadata)
+
+    assert "half" in str(e.value)
+
+
+def test_output_column_types_cpp_type():
+    types = OutputColumnTypes(columns={'n_jets': 'int16'}, double_as_float=True)
+
+    assert types.cpp_type('n_jets', 'int') == 'short'
+    assert types.cpp_type('jet_pt', 'double') == 'float'
+    assert types.cpp_type('run', 'int') is None
+    assert OutputColumnTypes().cpp_type('jet_pt', 'double') is None
+
+
+def test_output_column_types_merge():
+    merged = OutputColumnTypes(columns={'a': 'float'}).merge(OutputColumnTypes(columns={'b': 'bool'}, double_as_float=True))
+    assert merged == OutputColumnTypes(columns={'a': 'float', 'b': 'bool'}, double_as_float=True)
+
+    with pytest.raises(ValueError) as e:
+        OutputColumnTypes(columns={'a': 'float'}).merge(OutputColumnTypes(columns={'a': 'int'}))
+    assert "a" in str(e.value)
+
+
 def test_md_code_block_empty():
     metadata = [
         {
@@ -648,6 +727,57 @@ def test_md_method_call():
     assert spec.instance_object == 'obj_j'
 
 
+def test_md_method_call_instance_fields():
+    'Class variables set up in the constructor'
+    metadata = [
+        {
+            'metadata_type': 'add_cpp_function',
+            'name': 'getAttributeFloat',
+            'include_files': ['AthContainers/AuxElement.h'],
+            'arguments': ['name'],
+            'instance_object': 'obj_j',
+            'method_object': 'xAOD::Jet_v1',
+            'code': [
+                'auto result = acc(*obj_j);'
+            ],
+            'instance_fields': [['acc', 'SG::AuxElement::ConstAccessor<float>', 'name']],
+            'return_type': 'double'
+        }
+    ]
+
+    specs = process_metadata(metadata)
+    spec = specs[0]
+    assert isinstance(spec, CPPCodeSpecification)
+    assert spec.instance_fields == [('acc', 'SG::AuxElement::ConstAccessor<float>', 'name')]
+
+
+def test_md_function_call_reference():
+    'A result that is a reference'
+    metadata = [
+        {
+            'metadata_type': 'add_cpp_function',
+            'name': 'getAttributeVector',
+            'include_files': ['AthContainers/AuxElement.h'],
+            'arguments': ['name'],
+            'instance_object': 'obj_j',
+            'method_object': 'xAOD::Jet_v1',
+            'code': [
+                'const auto &result = acc(*obj_j);'
+            ],
+            'instance_fields': [['acc', 'SG::AuxElement::ConstAccessor<std::vector<float>>', 'name']],
+            'return_type': 'float',
+            'return_is_collection': True,
+            'return_is_reference': True,
+        }
+    ]
+
+    specs = process_metadata(metadata)
+    spec = specs[0]
+    assert isinstance(spec, CPPCodeSpecification)
+    assert spec.cpp_return_is_collection
+    assert spec.cpp_return_is_reference
+
+
 def test_md_function_call_renamed_result():
     'Check result name is properly set'
     metadata = [
@@ -0,0 +1,64 @@
+import json
+import time
+
+from func_adl_xAOD.common.timing import jsonl_span_exporter, query_timings
+
+
+def test_phase_recorded():
+    t = query_timings()
+    with t.phase('sleepy'):
+        time.sleep(0.05)
+
+    assert len(t.phases) == 1
+    assert t.phases[0].name == 'sleepy'
+    assert t.wall('sleepy') >= 0.05
+    assert t.cpu('sleepy') < 0.05
+    assert t.phases[0].end_ns > t.phases[0].start_ns
+
+
+def test_phase_recorded_on_exception():
+    t = query_timings()
+    try:
+        with t.phase('bad'):
+            raise ValueError('bad')
+    except ValueError:
+        pass
+
+    assert t.as_dict()['bad']['count'] == 1
+
+
+def test_phases_added_up():
+    t = query_timings()
+    with t.phase('one'):
+        pass
+    with t.phase('two'):
+        pass
+    with t.phase('one'):
+        pass
+
+    d = t.as_dict()
+    assert list(d.keys()) == ['one', 'two']
+    assert d['one']['count'] == 2
+    assert d['one']['wall'] == t.wall('one')
+    assert t.wall('three') == 0.0
+
+
+def test_export_jsonl(tmp_path):
+    t = query_timings()
+    with t.phase('one', part=1):
+        pass
+    with t.phase('two'):
+        pass
+
+    f = tmp_path / 'spans.jsonl'
+    e = jsonl_span_exporter(f)
+    t.export(e)
+    t.export(e)
+
+    spans = [json.loads(ln) for ln in f.read_text().splitlines()]
+    assert len(spans) == 4
+    assert spans[0]['name'] == 'func_adl_xAOD.one'
+    assert spans[0]['trace_id'] == t.trace_id
+    assert spans[0]['attributes']['part'] == 1
+    assert 'cpu_time_s' in spans[1]['attributes']
+    assert spans[0]['start_time_unix_nano'] <= spans[0]['end_time_unix_nano']
@@ -0,0 +1,68 @@
+import func_adl_xAOD.common.cpp_types as ctyp
+from func_adl_xAOD.common.cpp_vars import unique_name
+from func_adl_xAOD.common.translation_context import translation_context
+
+
+def test_types_stay_in_context():
+    ctx = translation_context()
+    with ctx.activate():
+        ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('double'))
+        assert ctyp.method_type_info("bogus", "pt") is not None
+
+    assert ctyp.method_type_info("bogus", "pt") is None
+    assert "bogus" in ctx.method_types
+
+
+def test_contexts_are_independent():
+    ctx1 = translation_context()
+    ctx2 = translation_context()
+    with ctx1.activate():
+        ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('double'))
+
+    with ctx2.activate():
+        assert ctyp.method_type_info("bogus", "pt") is None
+
+
+def test_global_types_seen():
+    ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('double'))
+    with translation_context().activate():
+        assert ctyp.method_type_info("bogus", "pt") is not None
+
+
+def test_context_types_override_global():
+    ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('double'))
+    with translation_context().activate():
+        ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('int'))
+        t = ctyp.method_type_info("bogus", "pt")
+        assert t is not None
+        assert t.r_type.type == 'int'
+
+
+def test_context_names():
+    ctx = translation_context()
+    with ctx.activate():
+        n1 = unique_name('jet')
+    with translation_context().activate():
+        n2 = unique_name('jet')
+    with ctx.activate():
+        n3 = unique_name('jet')
+
+    assert n1 == 'jet0'
+    assert n2 == 'jet0'
+    assert n3 == 'jet1'
+
+
+def test_context_copy():
+    ctx = translation_context()
+    with ctx.activate():
+        ctyp.add_method_type_info("bogus", "pt", ctyp.terminal('double'))
+        unique_name('jet')
+
+    ctx_copy = ctx.copy()
+    with ctx_copy.activate():
+        assert ctyp.method_type_info("bogus", "pt") is not None
+        ctyp.add_method_type_info("bogus", "eta", ctyp.terminal('double'))
+        assert unique_name('jet') == 'jet0'
+
+    with ctx.activate():
+        assert ctyp.method_type_info("bogus", "eta") is None
@@ -0,0 +1,114 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from func_adl_xAOD.atlas.xaod.executor import atlas_xaod_executor
+from func_adl_xAOD.cms.aod.executor import cms_aod_executor
+from func_adl_xAOD.common.translation_service import make_server, translation_service
+
+atlas_query = "(call ResultTTree (call Select (call EventDataset 'file.root') " \
+    "(lambda (list e) (call (attr (call (attr e 'EventInfo') 'EventInfo') 'runNumber')))) " \
+    "(list 'run') 'forkme' 'dude.root')"
+
+cms_query = "(call ResultTTree (call SelectMany (call EventDataset 'file.root') " \
+    "(lambda (list e) (call (attr e 'Muons') 'muons'))) (list 'mu') 'forkme' 'dude.root')"
+
+
+@pytest.fixture(scope='module')
+def service():
+    return translation_service({'atlas_xaod': atlas_xaod_executor, 'cms_aod': cms_aod_executor},
+                               max_cached_queries=2)
+
+
+@pytest.fixture(scope='module')
+def server_url(service):
+    server = make_server(service)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield f'http://{server.server_address[0]}:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_translate_atlas(service):
+    bundle = service.translate(atlas_query, 'atlas_xaod')
+
+    assert bundle['main_script'] == 'runner.sh'
+    assert set(bundle['files'].keys()) == {'ATestRun_eljob.py', 'package_CMakeLists.txt', 'query.cxx', 'query.h', 'runner.sh'}
+    assert 'runNumber()' in bundle['files']['query.cxx']
+    assert bundle['result'] == {'filename': 'ANALYSIS.root', 'treename': 'forkme'}
+
+
+def test_translate_cms(service):
+    bundle = service.translate(cms_query, 'cms_aod')
+
+    assert 'Analyzer.cc' in bundle['files']
+    assert 'muons' in bundle['files']['Analyzer.cc']
+
+
+def test_translate_is_repeatable():
+    'Names in the code should not depend on what was translated before'
+    s = translation_service({'atlas_xaod': atlas_xaod_executor}, max_cached_queries=0)
+    b1 = s.translate(atlas_query, 'atlas_xaod')
+    s.translate(atlas_query.replace('runNumber', 'eventNumber'), 'atlas_xaod')
+    b2 = s.translate(atlas_query, 'atlas_xaod')
+
+    assert b1 is not b2
+    assert b1 == b2
+
+
+def test_translate_cached(service):
+    b1 = service.translate(atlas_query, 'atlas_xaod')
+    b2 = service.translate(atlas_query, 'atlas_xaod')
+    assert b1 is b2
+
+
+def test_translate_cache_evicts(service):
+    b1 = service.translate(atlas_query, 'atlas_xaod')
+    service.translate(atlas_query.replace('runNumber', 'eventNumber'), 'atlas_xaod')
+    service.translate(cms_query, 'cms_aod')
+    b2 = service.translate(atlas_query, 'atlas_xaod')
+    assert b1 is not b2
+    assert b1 == b2
+
+
+def test_translate_unknown_backend(service):
+    with pytest.raises(ValueError) as e:
+        service.translate(atlas_query, 'lhcb')
+    assert 'lhcb' in str(e.value)
+
+
+def test_bad_cache_size():
+    with pytest.raises(ValueError):
+        translation_service({}, max_cached_queries=-1)
+
+
+def test_http_backends(server_url):
+    with urllib.request.urlopen(f'{server_url}/backends') as r:
+        assert json.loads(r.read()) == ['atlas_xaod', 'cms_aod']
+
+
+def test_http_translate(server_url):
+    req = urllib.request.Request(f'{server_url}/translate/atlas_xaod', data=atlas_query.encode('utf-8'))
+    with urllib.request.urlopen(req) as r:
+        bundle = json.loads(r.read())
+
+    assert 'runNumber()' in bundle['files']['query.cxx']
+    assert bundle['result']['treename'] == 'forkme'
+
+
+def test_http_translate_unknown_backend(server_url):
+    req = urllib.request.Request(f'{server_url}/translate/lhcb', data=atlas_query.encode('utf-8'))
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(req)
+    assert e.value.code == 404
+
+
+def test_http_translate_bad_query(server_url):
+    req = urllib.request.Request(f'{server_url}/translate/atlas_xaod', data=b'(call Select')
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(req)
+    assert e.value.code == 400
+    assert 'error' in json.loads(e.value.read())
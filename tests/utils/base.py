@@ -149,8 +149,11 @@ class dummy_executor(ABC):
         self.QueryVisitor = self.get_visitor_obj()
         # TODO: #126 query_ast_visitor needs proper arguments
         a_transformed = rnr.apply_ast_transformations(a)
-        self.ResultRep = \
-            self.QueryVisitor.get_as_ROOT(a_transformed)
+        self.QueryVisitor.code_options = rnr.code_options
+        self.QueryVisitor.column_types = rnr.column_types
+        with rnr.translation_context.activate():
+            self.ResultRep = \
+                self.QueryVisitor.get_as_ROOT(a_transformed)
         self._job_option_blocks = rnr._job_option_blocks
 
     def get_result(self, q_visitor, result_rep):